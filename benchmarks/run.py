@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(_root, 'benchmarks'))
+sys.path.insert(0, _root)
+from ci_release_publisher.__version__ import __version__
+from servers import FakeGitHub, FakeTravis
+
+# Runs the ci-release-publisher commands of a whole build against local GitHub and Travis-CI stand-ins and records how
+# long each command takes, how many requests it makes, how many bytes it moves and its peak memory use.
+#
+# Each command runs in its own process through `python -m ci_release_publisher`, the same as in a CI job, so that the
+# startup cost is measured too and the peak memory use is that of the command alone.
+
+_repo_slug = 'owner/repo'
+_branch = 'master'
+
+def _seed(github, releases, assets_per_release, build_number):
+    # Numbered releases of the previous builds, the oldest created first
+    now = datetime.datetime.utcnow()
+    for n in range(releases):
+        build = build_number - releases + n
+        github.add_release('ci-{}-{}'.format(_branch, build), created_at=now - datetime.timedelta(hours=releases - n + 1),
+                           assets={'artifact-{}'.format(i): b'x' * 1024 for i in range(assets_per_release)})
+
+def _env(home, github, travis, build_number, job_number):
+    env = dict(os.environ)
+    for name in list(env):
+        if name.startswith('TRAVIS_') or name.startswith('CIRP_'):
+            del env[name]
+    env.update({
+        'HOME': home,
+        'GITHUB_ACCESS_TOKEN': 'github-token',
+        'TRAVIS_REPO_SLUG': _repo_slug,
+        'TRAVIS_BRANCH': _branch,
+        'TRAVIS_COMMIT': 'abcdef',
+        'TRAVIS_BUILD_NUMBER': str(build_number),
+        'TRAVIS_BUILD_ID': '1000',
+        'TRAVIS_BUILD_WEB_URL': '{}/build/1000'.format(travis.url),
+        'TRAVIS_JOB_NUMBER': '{}.{}'.format(build_number, job_number),
+        'TRAVIS_JOB_ID': str(2000 + job_number),
+        'TRAVIS_JOB_WEB_URL': '{}/job/{}'.format(travis.url, 2000 + job_number),
+        'TRAVIS_TEST_RESULT': '0',
+        'TRAVIS_ALLOW_FAILURE': 'false',
+        'PYTHONPATH': os.pathsep.join([_root] + ([env['PYTHONPATH']] if 'PYTHONPATH' in env else [])),
+    })
+    return env
+
+# Runs a command and returns its measurements
+def _run(name, args, env, github, travis, options):
+    github.take_stats()
+    travis.take_stats()
+    metrics_file = os.path.join(env['HOME'], 'metrics.json')
+    command = [sys.executable, '-m', 'ci_release_publisher', '--github-api-url', github.url, '--travis-api-url', travis.url, '--metrics-file', metrics_file] + options + args
+    start = time.time()
+    process = subprocess.Popen(command, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.stdout.read()
+    # wait4() gives the resource usage of this very process, unlike getrusage(RUSAGE_CHILDREN) summing up all children
+    _, status, rusage = os.wait4(process.pid, 0)
+    wall_time = time.time() - start
+    process.returncode = os.waitstatus_to_exitcode(status) if hasattr(os, 'waitstatus_to_exitcode') else status >> 8
+    if process.returncode != 0:
+        sys.stderr.write(output.decode('utf-8', 'replace'))
+        raise RuntimeError('"{}" command has failed with exit code {}.'.format(' '.join(args), process.returncode))
+    github_stats = github.take_stats()
+    travis_stats = travis.take_stats()
+    with open(metrics_file, 'r') as f:
+        metrics = json.load(f)
+    return {
+        'command': name,
+        'wall_time': wall_time,
+        'github_requests': github_stats['requests'],
+        'travis_requests': travis_stats['requests'],
+        'bytes_sent': github_stats['bytes_received'] + travis_stats['bytes_received'],
+        'bytes_received': github_stats['bytes_sent'] + travis_stats['bytes_sent'],
+        # Kilobytes on Linux, bytes on macOS
+        'peak_rss': rusage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024),
+        # As seen by the command itself
+        'endpoints': {endpoint: {name: m[name] for name in ['requests', 'time', 'retries']} for endpoint, m in metrics['endpoints'].items()},
+    }
+
+def run(releases=100, assets_per_release=2, jobs=2, artifacts=10, artifact_size=1024*1024, latency=0, bandwidth=0, bundle=False, dedupe=False, shared_artifacts=0,
+        previous_latest_release=False, incremental=False, options=None):
+    options = options or []
+    build_number = releases + 1
+    github = FakeGitHub(_repo_slug, latency, bandwidth).start()
+    travis = FakeTravis(build_number, latency, bandwidth).start()
+    results = []
+    try:
+        _seed(github, releases, assets_per_release, build_number)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # The same in every job
+            shared = [os.urandom(artifact_size) for i in range(shared_artifacts)]
+            previous = {}
+            for job_number in range(1, jobs + 1):
+                artifact_dir = os.path.join(tmp_dir, 'artifacts-{}'.format(job_number))
+                os.makedirs(artifact_dir)
+                for i in range(artifacts):
+                    with open(os.path.join(artifact_dir, 'job-{}-artifact-{}'.format(job_number, i)), 'wb') as f:
+                        data = os.urandom(artifact_size) if i >= shared_artifacts else shared[i]
+                        f.write(data)
+                    # The previous build had all but the first artifact of each job the same
+                    previous['job-{}-artifact-{}'.format(job_number, i)] = data if i > 0 else os.urandom(artifact_size)
+                env = _env(tmp_dir, github, travis, build_number, job_number)
+                store_options = (['--bundle'] if bundle else []) + (['--dedupe'] if dedupe else [])
+                results.append(_run('store', ['store'] + store_options + [artifact_dir], env, github, travis, options))
+            if previous_latest_release:
+                github.add_release('ci-{}-latest'.format(_branch), created_at=datetime.datetime.utcnow() - datetime.timedelta(hours=1), assets=previous)
+            # The publishing job runs after the storing jobs
+            env = _env(tmp_dir, github, travis, build_number, jobs + 1)
+            collect_dir = os.path.join(tmp_dir, 'collected')
+            os.makedirs(collect_dir)
+            results.append(_run('collect', ['collect', collect_dir], env, github, travis, options))
+            results.append(_run('publish', ['publish', '--latest-release'] + (['--latest-release-incremental'] if incremental else []) + ['--numbered-release', '--numbered-release-keep-count', str(releases), collect_dir],
+                                env, github, travis, options))
+            results.append(_run('cleanup_store', ['cleanup_store', '--scope', 'current-build', 'previous-finished-builds', '--release', 'complete', 'incomplete'],
+                                env, github, travis, options))
+            results.append(_run('cleanup_publish', ['cleanup_publish'], env, github, travis, options))
+    finally:
+        github.stop()
+        travis.stop()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the ci-release-publisher commands of a build against local GitHub and Travis-CI stand-ins.')
+    parser.add_argument('--releases', type=int, default=100, help='Number of numbered releases the repo already has.')
+    parser.add_argument('--assets-per-release', type=int, default=2, help='Number of artifacts each of the existing releases has.')
+    parser.add_argument('--jobs', type=int, default=2, help='Number of jobs storing artifacts.')
+    parser.add_argument('--artifacts', type=int, default=10, help='Number of artifacts each job stores.')
+    parser.add_argument('--artifact-size', type=int, default=1024*1024, help='Size of each artifact, in bytes.')
+    parser.add_argument('--latency', type=float, default=0, help='Latency added to every request, in seconds.')
+    parser.add_argument('--bandwidth', type=int, default=0, help='Bandwidth of the connection to each API, in bytes per second. 0 means unlimited.')
+    parser.add_argument('--bundle', default=False, action='store_true', help='Store the artifacts of each job as a single bundle.')
+    parser.add_argument('--dedupe', default=False, action='store_true', help='Store only the artifacts with content not stored by another job yet.')
+    parser.add_argument('--shared-artifacts', type=int, default=0, help='Number of the artifacts of each job that are the same in every job.')
+    parser.add_argument('--previous-latest-release', default=False, action='store_true',
+                        help='Have the latest release of the previous build in the repo, with all but the first artifact of each job the same.')
+    parser.add_argument('--incremental', default=False, action='store_true', help='Update the latest release in place.')
+    parser.add_argument('--output', type=str, help='File to write the results into as JSON. Printed out if not specified.')
+    parser.add_argument('options', nargs=argparse.REMAINDER, help='Extra global ci-release-publisher options to run the commands with, after "--".')
+    args = parser.parse_args()
+
+    options = args.options[1:] if args.options[:1] == ['--'] else args.options
+    parameters = {name: getattr(args, name) for name in ['releases', 'assets_per_release', 'jobs', 'artifacts', 'artifact_size', 'latency', 'bandwidth', 'bundle', 'dedupe', 'shared_artifacts', 'previous_latest_release', 'incremental']}
+    commands = run(options=options, **parameters)
+    result = {
+        'version': __version__,
+        'python': platform.python_version(),
+        'parameters': parameters,
+        'options': options,
+        'commands': commands,
+        'total': {name: sum(c[name] for c in commands) for name in ['wall_time', 'github_requests', 'travis_requests', 'bytes_sent', 'bytes_received']},
+    }
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
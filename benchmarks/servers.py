@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, quote, unquote, urlsplit
+import datetime
+import hashlib
+import json
+import re
+import threading
+import time
+
+# Local stand-ins for the GitHub and Travis-CI APIs, implementing just enough of them for ci-release-publisher to run
+# against. Each server can simulate the network latency and bandwidth, and counts the requests and bytes moved.
+
+# Handles the pooled keep-alive connections in their own threads, so that they don't block the shutdown
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    # The default backlog of 5 makes the connections opened at once past it wait on a SYN retransmit for a second
+    request_queue_size = 128
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    # Sleeps for as long as moving `size` bytes would take with the simulated bandwidth
+    def _throttle(self, size):
+        if self.server.fake.bandwidth:
+            time.sleep(size / self.server.fake.bandwidth)
+
+    def _read_body(self):
+        size = int(self.headers.get('Content-Length', 0))
+        chunks = []
+        while size > 0:
+            chunk = self.rfile.read(min(size, 64*1024))
+            if not chunk:
+                break
+            self._throttle(len(chunk))
+            size -= len(chunk)
+            chunks.append(chunk)
+        data = b''.join(chunks)
+        self.server.fake.count(received=len(data))
+        return data
+
+    def _reply(self, status, body=None, headers=None, data=None):
+        if data is None:
+            data = json.dumps(body).encode('utf-8') if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8' if body is not None else 'application/octet-stream')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        for i in range(0, len(data), 64*1024):
+            self._throttle(len(data[i:i + 64*1024]))
+            self.wfile.write(data[i:i + 64*1024])
+        self.server.fake.count(sent=len(data))
+
+    def _handle(self):
+        fake = self.server.fake
+        fake.count(requests=1)
+        if fake.latency:
+            time.sleep(fake.latency)
+        parts = urlsplit(self.path)
+        query = {name: values[0] for name, values in parse_qs(parts.query).items()}
+        data = self._read_body() if self.command in ['POST', 'PATCH'] else b''
+        with fake.lock:
+            result = fake.route(self.command, parts.path, query, data, dict(self.headers))
+        self._reply(*result)
+
+    do_GET = do_POST = do_PATCH = do_DELETE = _handle
+
+class _Fake:
+    def __init__(self, latency=0, bandwidth=0):
+        self.latency = latency
+        # Bytes per second, 0 means unlimited
+        self.bandwidth = bandwidth
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'bytes_received': 0, 'bytes_sent': 0}
+        self._stats_lock = threading.Lock()
+        self._server = None
+
+    def count(self, requests=0, received=0, sent=0):
+        with self._stats_lock:
+            self.stats['requests'] += requests
+            self.stats['bytes_received'] += received
+            self.stats['bytes_sent'] += sent
+
+    # Returns the stats counted since the last call
+    def take_stats(self):
+        with self._stats_lock:
+            stats = self.stats
+            self.stats = {'requests': 0, 'bytes_received': 0, 'bytes_sent': 0}
+        return stats
+
+    def start(self):
+        self._server = _Server(('127.0.0.1', 0), _Handler)
+        self._server.fake = self
+        self.url = 'http://127.0.0.1:{}'.format(self._server.server_port)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+def _iso(date):
+    return date.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+# GitHub REST API (releases, assets, git refs and commits) and the release listing part of the GraphQL API
+class FakeGitHub(_Fake):
+    def __init__(self, repo_slug, latency=0, bandwidth=0):
+        super().__init__(latency, bandwidth)
+        self.repo_slug = repo_slug
+        self.releases = {}
+        self.tags = set()
+        self._next_id = 1
+
+    def _id(self):
+        self._next_id += 1
+        return self._next_id
+
+    def _repo_url(self):
+        return '{}/repos/{}'.format(self.url, self.repo_slug)
+
+    def add_release(self, tag_name, draft=False, prerelease=False, created_at=None, assets=None):
+        release_id = self._id()
+        self.releases[release_id] = {
+            'id': release_id,
+            'tag_name': tag_name,
+            'name': tag_name,
+            'body': '',
+            'draft': draft,
+            'prerelease': prerelease,
+            'target_commitish': 'master',
+            'created_at': _iso(created_at or datetime.datetime.utcnow()),
+            'assets': [],
+        }
+        if not draft:
+            self.tags.add(tag_name)
+        for name, data in (assets or {}).items():
+            self._add_asset(self.releases[release_id], name, data)
+        return release_id
+
+    def _add_asset(self, release, name, data, content_type='application/octet-stream'):
+        release['assets'] = [a for a in release['assets'] if a['name'] != name]
+        release['assets'].append({'id': self._id(), 'name': name, 'data': data, 'content_type': content_type})
+
+    def _release_json(self, release):
+        url = '{}/releases/{}'.format(self._repo_url(), release['id'])
+        result = {name: value for name, value in release.items() if name != 'assets'}
+        result.update({
+            'url': url,
+            'html_url': url,
+            'assets_url': '{}/assets'.format(url),
+            'upload_url': '{}/api/uploads/repos/{}/releases/{}/assets{{?name,label}}'.format(self.url, self.repo_slug, release['id']),
+            'assets': [self._asset_json(asset) for asset in release['assets']],
+        })
+        return result
+
+    def _asset_json(self, asset):
+        url = '{}/releases/assets/{}'.format(self._repo_url(), asset['id'])
+        # GitHub reports the digests of the assets, without them PyGithub would fetch every asset to look for one
+        return {'id': asset['id'], 'name': asset['name'], 'size': len(asset['data']), 'state': 'uploaded', 'url': url,
+                'browser_download_url': url, 'content_type': asset['content_type'], 'digest': 'sha256:{}'.format(hashlib.sha256(asset['data']).hexdigest())}
+
+    def _listing(self):
+        # Newest first, the same as GitHub
+        return sorted(self.releases.values(), key=lambda r: (r['created_at'], r['id']), reverse=True)
+
+    def _page(self, path, items, query):
+        per_page = int(query.get('per_page', 30))
+        page = int(query.get('page', 1))
+        headers = {}
+        if page * per_page < len(items):
+            headers['Link'] = '<{}{}?per_page={}&page={}>; rel="next"'.format(self.url, path, per_page, page + 1)
+        return 200, items[(page - 1) * per_page:page * per_page], headers
+
+    def route(self, method, path, query, data, headers):
+        repo = '/repos/{}'.format(self.repo_slug)
+        if method == 'POST' and path == '/graphql':
+            return self._graphql(json.loads(data.decode('utf-8')))
+        m = re.match(r'^/api/uploads/repos/[^/]+/[^/]+/releases/(\d+)/assets$', path)
+        if method == 'POST' and m:
+            release = self.releases.get(int(m.group(1)))
+            if not release:
+                return 404, {'message': 'Not Found'}
+            self._add_asset(release, query['name'], data, headers.get('Content-Type', 'application/octet-stream'))
+            return 201, self._asset_json(release['assets'][-1])
+        if not path.startswith(repo):
+            return 404, {'message': 'Not Found'}
+        path = path[len(repo):]
+        if method == 'GET' and path == '':
+            return 200, {'id': 1, 'name': self.repo_slug.split('/')[1], 'full_name': self.repo_slug, 'url': self._repo_url(),
+                         'owner': {'login': self.repo_slug.split('/')[0]}}
+        if method == 'GET' and path == '/releases':
+            return self._page('{}/releases'.format(repo), [self._release_json(r) for r in self._listing()], query)
+        if method == 'POST' and path == '/releases':
+            body = json.loads(data.decode('utf-8'))
+            release_id = self.add_release(body['tag_name'], body.get('draft', False), body.get('prerelease', False))
+            self.releases[release_id].update({'name': body.get('name') or body['tag_name'], 'body': body.get('body') or ''})
+            return 201, self._release_json(self.releases[release_id])
+        m = re.match(r'^/releases/tags/(.+)$', path)
+        if method == 'GET' and m:
+            for release in self._listing():
+                if release['tag_name'] == unquote(m.group(1)) and not release['draft']:
+                    return 200, self._release_json(release)
+            return 404, {'message': 'Not Found'}
+        m = re.match(r'^/releases/assets/(\d+)$', path)
+        if m:
+            for release in self.releases.values():
+                for asset in release['assets']:
+                    if asset['id'] == int(m.group(1)):
+                        if method == 'DELETE':
+                            release['assets'].remove(asset)
+                            return 204, None
+                        if method == 'PATCH':
+                            asset['name'] = json.loads(data.decode('utf-8'))['name']
+                            return 200, self._asset_json(asset)
+                        if headers.get('Accept') == 'application/octet-stream':
+                            start = int(headers['Range'][len('bytes='):-1]) if headers.get('Range') else 0
+                            return 200 if not start else 206, None, {}, asset['data'][start:]
+                        return 200, self._asset_json(asset)
+            return 404, {'message': 'Not Found'}
+        m = re.match(r'^/releases/(\d+)(/assets)?$', path)
+        if m:
+            release = self.releases.get(int(m.group(1)))
+            if not release:
+                return 404, {'message': 'Not Found'}
+            if m.group(2):
+                return self._page('{}/releases/{}/assets'.format(repo, release['id']), [self._asset_json(a) for a in release['assets']], query)
+            if method == 'GET':
+                return 200, self._release_json(release)
+            if method == 'PATCH':
+                body = json.loads(data.decode('utf-8'))
+                release.update({name: body[name] for name in ['tag_name', 'name', 'draft', 'prerelease', 'target_commitish'] if name in body})
+                release['body'] = body.get('body', release['body'])
+                if not release['draft']:
+                    self.tags.add(release['tag_name'])
+                return 200, self._release_json(release)
+            if method == 'DELETE':
+                del self.releases[release['id']]
+                return 204, None
+        m = re.match(r'^/git/refs?/tags/(.+)$', path)
+        if m:
+            tag_name = unquote(m.group(1))
+            if tag_name not in self.tags:
+                return 404, {'message': 'Not Found'}
+            if method == 'DELETE':
+                self.tags.remove(tag_name)
+                return 204, None
+            # Moving the tag gets the ref back too, the commit it points to doesn't matter here
+            url = '{}/git/refs/tags/{}'.format(self._repo_url(), quote(tag_name))
+            return 200, {'ref': 'refs/tags/{}'.format(tag_name), 'url': url, 'object': {'sha': '0' * 40, 'type': 'commit', 'url': url}}
+        m = re.match(r'^/commits/(\w+)$', path)
+        if method == 'GET' and m:
+            date = _iso(datetime.datetime.utcnow() - datetime.timedelta(hours=1))
+            return 200, {'sha': m.group(1), 'url': '{}/commits/{}'.format(self._repo_url(), m.group(1)),
+                         'commit': {'committer': {'name': 'Committer', 'email': 'committer@example.com', 'date': date}}}
+        return 404, {'message': 'Not Found'}
+
+    def _graphql(self, request):
+        releases = self._listing()
+        start = int(request['variables'].get('cursor') or 0)
+        page = releases[start:start + 100]
+        nodes = [{'databaseId': r['id'], 'tagName': r['tag_name'], 'isDraft': r['draft'], 'createdAt': r['created_at'],
+                  'releaseAssets': {'totalCount': len(r['assets'])}} for r in page]
+        has_next_page = start + 100 < len(releases)
+        return 200, {'data': {'repository': {'releases': {'pageInfo': {'hasNextPage': has_next_page, 'endCursor': str(start + 100) if has_next_page else None},
+                                                         'nodes': nodes}}}}
+
+# Travis-CI API v3, with a single branch whose only unfinished build is `build_number`
+class FakeTravis(_Fake):
+    def __init__(self, build_number, latency=0, bandwidth=0):
+        super().__init__(latency, bandwidth)
+        self.build_number = build_number
+
+    def route(self, method, path, query, data, headers):
+        if method == 'POST' and path == '/auth/github':
+            return 200, {'access_token': 'travis-token'}
+        if re.match(r'^/repo/[^/]+/branch/[^/]+$', path):
+            return 200, {'last_build': {'number': str(self.build_number)}}
+        if re.match(r'^/repo/[^/]+/builds$', path):
+            offset = int(query.get('offset', 0))
+            limit = int(query.get('limit', 100))
+            if 'finished_at' in query.get('sort_by', ''):
+                builds = [{'number': str(n), 'event_type': 'push', 'finished_at': None if n == self.build_number else '2020-01-01T00:00:00Z'}
+                          for n in range(self.build_number, 0, -1)]
+            else:
+                builds = [{'number': str(self.build_number), 'event_type': 'push'}]
+            return 200, {'@pagination': {'limit': limit, 'count': len(builds)}, 'builds': builds[offset:offset + limit]}
+        if re.match(r'^/build/\d+$', path):
+            return 200, {'jobs': [{'state': 'passed', 'allow_failure': False}]}
+        return 404, {'error_message': 'Not Found'}
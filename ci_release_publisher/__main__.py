@@ -8,59 +8,154 @@ import sys
 from . import config
 from . import env
 from . import exception
-from . import github
-from . import latest_release, numbered_release, tag_release
-from . import temporary_store_release
-from . import travis
+from . import metrics
+from . import serve
 from .__version__ import __description__, __version__
 
-def main():
-    try:
-        logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO, datefmt='%H:%M:%S')
+# The modules talking to GitHub and Travis-CI import PyGithub and requests, which take longer to import than the rest of
+# the start up, so they are imported only once the command that needs them is known. --version, --help, argument errors
+# and the commands forwarded to a server don't import them at all.
 
-        release_kinds = [latest_release, numbered_release, tag_release]
+# A parser of a command, which adds the arguments of the command only once the command is being parsed
+class _CommandParser(argparse.ArgumentParser):
+    add_args = None
 
-        parser = argparse.ArgumentParser(description=__description__)
-        parser.add_argument('--version', action='version', version='{}'.format(__version__))
+    def parse_known_args(self, args=None, namespace=None):
+        if self.add_args:
+            add_args, self.add_args = self.add_args, None
+            add_args(self)
+        return super().parse_known_args(args, namespace)
+
+def _release_kinds():
+    from . import latest_release, numbered_release, tag_release
+    return [latest_release, numbered_release, tag_release]
+
+def _store_args(parser):
+    from . import temporary_store_release
+    parser.add_argument('artifact_dir', metavar='ARTIFACT_DIR', help='Path to a directory containing artifacts that need to be stored.')
+    parser.add_argument('--upload-concurrency', type=int, default=config.upload_concurrency, help='Number of artifacts to upload in parallel.')
+    temporary_store_release.publish_args(parser)
+
+def _cleanup_store_args(parser):
+    from . import temporary_store_release
+    temporary_store_release.cleanup_args(parser)
 
-        parser.add_argument('--travis-api-url', type=str, default='',
-                            help='Use a custom Travis-CI API URL, e.g. for self-hosted Travis-CI Enterprise instance. Should be an URL to the API endpoint, e.g. "https://travis.example.com/api".')
+def _collect_args(parser):
+    parser.add_argument('artifact_dir', metavar='ARTIFACT_DIR', help='Path to a directory where artifacts should be collected to.')
+    parser.add_argument('--download-concurrency', type=int, default=config.download_concurrency, help='Number of artifacts to download in parallel.')
+    parser.add_argument('--download-buffer-size', type=int, default=config.download_buffer_size, help='Size of the buffer used when writing downloaded artifacts to disk, in bytes.')
 
-        parser.add_argument('--github-api-url', type=str, default='',
-                            help='Use a custom GitHib API URL, e.g. for self-hosted GitHub Enterprise instance. Should be an URL to the API endpoint, e.g. "https://api.github.com".')
+def _publish_args(parser):
+    parser.add_argument('artifact_dir', metavar='ARTIFACT_DIR', nargs='?', help='Path to a directory containing build artifacts to publish.')
+    parser.add_argument('--from-store', action='store_true',
+                        help='Publish the artifacts stored by the "store" command during the current build instead of the artifacts from a directory. '
+                             'The artifacts are copied between releases on GitHub without being downloaded first, and one of the temporary store releases is turned into the published release when possible.')
+    parser.add_argument('--upload-concurrency', type=int, default=config.upload_concurrency, help='Number of artifacts to upload in parallel.')
+    for r in _release_kinds():
+        r.publish_args(parser)
 
-        parser.add_argument('--tag-prefix', type=str, default=config.tag_prefix, help='git tag prefix to use when creating releases.')
-        parser.add_argument('--tag-prefix-incomplete-releases', type=str, default=config.tag_prefix_tmp, dest='tag_prefix_tmp',
-                            help='An additional git tag prefix, on top of the existing one, to use for indicating incomplete, in-progress releases.')
+def _serve_args(parser):
+    parser.add_argument('--idle-timeout', type=int, default=3600, help='Stop once no command has been run for this many seconds.')
 
-        subparsers = parser.add_subparsers(dest='command')
+def _global_args(parser):
+    parser.add_argument('--travis-api-url', type=str, default='',
+                        help='Use a custom Travis-CI API URL, e.g. for self-hosted Travis-CI Enterprise instance. Should be an URL to the API endpoint, e.g. "https://travis.example.com/api".')
 
-        # store subparser
-        parser_store = subparsers.add_parser('store', help='Store artifacts of the current job in a draft release for the later collection by a job calling the "publish" command.')
-        parser_store.add_argument('artifact_dir', metavar='ARTIFACT_DIR', help='Path to a directory containing artifacts that need to be stored.')
-        temporary_store_release.publish_args(parser_store)
+    parser.add_argument('--github-api-url', type=str, default='',
+                        help='Use a custom GitHib API URL, e.g. for self-hosted GitHub Enterprise instance. Should be an URL to the API endpoint, e.g. "https://api.github.com".')
 
-        # cleanup store subparser
-        parser_cleanup_store = subparsers.add_parser('cleanup_store', help='Delete the releases created by the "store" command.')
-        temporary_store_release.cleanup_args(parser_cleanup_store)
+    parser.add_argument('--tag-prefix', type=str, default=config.tag_prefix, help='git tag prefix to use when creating releases.')
+    parser.add_argument('--tag-prefix-incomplete-releases', type=str, default=config.tag_prefix_tmp, dest='tag_prefix_tmp',
+                        help='An additional git tag prefix, on top of the existing one, to use for indicating incomplete, in-progress releases.')
 
-        # collect subparser
-        parser_collect = subparsers.add_parser('collect', help='Collect artifacts from all draft releases created by the "store" command during the current build in a directory.')
-        parser_collect.add_argument('artifact_dir', metavar='ARTIFACT_DIR', help='Path to a directory where artifacts should be collected to.')
+    parser.add_argument('--connection-pool-size', type=int, default=config.pool_size, dest='pool_size',
+                        help='Maximum number of connections to keep open per API host for re-use.')
+    parser.add_argument('--delete-concurrency', type=int, default=config.delete_concurrency,
+                        help='Number of releases to delete in parallel when cleaning up releases or enforcing a retention policy.')
+    parser.add_argument('--http-cache-dir', type=str, default=config.http_cache_dir,
+                        help='Directory to cache the GitHub release listing in, e.g. a directory cached by Travis-CI. Unchanged pages of the listing are then '
+                             're-validated instead of re-downloaded, which doesn\'t count against the GitHub API rate limit. Can be shared by several jobs at once.')
+    parser.add_argument('--http-cache-size', type=int, default=config.http_cache_max_size, dest='http_cache_max_size',
+                        help='Maximum size of the --http-cache-dir directory, in bytes. The least recently used pages are removed once it\'s exceeded.')
+    parser.add_argument('--release-listing', type=str, choices=['rest', 'graphql'], default=config.release_listing,
+                        help='API to list the releases over. The GraphQL API fetches only the few fields of the releases that are needed, which makes the listing '
+                             'much smaller and faster for repos with many releases or long release notes. The full release is fetched only for the releases that get used.')
+    parser.add_argument('--metrics-file', type=str,
+                        help='File to write the metrics of the API requests made into, as JSON: the number of requests, their latency histogram, the bytes sent and received, '
+                             'the retries and the time spent waiting on the API rate limit, for each API endpoint.')
+    parser.add_argument('--engine', type=str, choices=['threads', 'asyncio'], default=config.engine,
+                        help='How to run the operations made of many small API requests: deleting releases and tags, listing and downloading the artifacts '
+                             'of many releases, paging through Travis-CI builds. "threads" runs them in threads, "asyncio" runs them all on a single thread '
+                             'with asyncio, with the concurrency bounded by the --*-concurrency options.')
+    parser.add_argument('--dry-run', default=False, action='store_true',
+                        help='Only log the changes that would be made on GitHub -- the releases that would be created, renamed and deleted, the artifacts that would '
+                             'be uploaded -- without making them. Useful to check what a changed retention policy would delete.')
+    parser.add_argument('--no-cache', action='store_false', dest='cache',
+                        help='Don\'t use the Travis-CI token cached by the previous invocations in the same job, and don\'t cache it.')
 
-        # publish subparser
-        parser_publish = subparsers.add_parser('publish', help='Publish releases with artifacts from a directory.')
-        parser_publish.add_argument('artifact_dir', metavar='ARTIFACT_DIR', help='Path to a directory containing build artifacts to publish.')
+class _ForwardParserError(Exception):
+    pass
 
-        # cleanup publish subparser
-        parser_cleanup_publish = subparsers.add_parser('cleanup_publish', help='Delete incomplete releases left over by the "publish" command by the current and previous builds.')
+# A parser that raises an error instead of exiting, so that the arguments with an error are left to the full parser
+class _ForwardParser(argparse.ArgumentParser):
+    def error(self, message):
+        raise _ForwardParserError(message)
 
-        for r in release_kinds:
-            r.publish_args(parser_publish)
+# Returns the command to forward to the server, or None if the arguments should be handled locally: the "serve" command
+# itself, --help, --version and the arguments with an error. Only the global options are parsed, the options of the
+# commands aren't known without importing the release modules.
+def _forwarded_command(argv):
+    parser = _ForwardParser(add_help=False)
+    parser.add_argument('-h', '--help', action='store_true')
+    parser.add_argument('--version', action='store_true')
+    _global_args(parser)
+    parser.add_argument('command', nargs='?')
+    parser.add_argument('command_args', nargs=argparse.REMAINDER)
+    try:
+        args, _ = parser.parse_known_args(argv)
+    except _ForwardParserError:
+        return None
+    if args.help or args.version or args.command == 'serve' or any(arg in ['-h', '--help'] for arg in args.command_args):
+        return None
+    return args.command
+
+# Runs the command given by `argv`, the command line arguments by default. Unless `forward` is unset, the command is
+# run by the server started with the "serve" command if there is one.
+def main(argv=None, forward=True):
+    argv = sys.argv[1:] if argv is None else argv
+    if forward and _forwarded_command(argv):
+        exit_code = serve.forward(argv)
+        if exit_code is not None:
+            sys.exit(exit_code)
+    metrics_file = None
+    try:
+        logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO, datefmt='%H:%M:%S')
+
+        parser = argparse.ArgumentParser(description=__description__)
+        parser.add_argument('--version', action='version', version='{}'.format(__version__))
 
-        args = parser.parse_args()
+        _global_args(parser)
+
+        subparsers = parser.add_subparsers(dest='command', parser_class=_CommandParser)
+        subparsers.add_parser('store', help='Store artifacts of the current job in a draft release for the later collection by a job calling the "publish" command.').add_args = _store_args
+        subparsers.add_parser('cleanup_store', help='Delete the releases created by the "store" command.').add_args = _cleanup_store_args
+        subparsers.add_parser('collect', help='Collect artifacts from all draft releases created by the "store" command during the current build in a directory.').add_args = _collect_args
+        subparsers.add_parser('publish', help='Publish releases with artifacts from a directory.').add_args = _publish_args
+        subparsers.add_parser('cleanup_publish', help='Delete incomplete releases left over by the "publish" command by the current and previous builds.')
+        subparsers.add_parser('serve', help='Keep running in the background, running the commands of the rest of the current job, so that they re-use the connections, '
+                                            'the Travis-CI token and the release listing of the previous commands instead of starting from scratch. '
+                                            'The commands are forwarded to it on their own, and run on their own if it\'s not running.').add_args = _serve_args
+
+        args = parser.parse_args(argv)
+        metrics_file = args.metrics_file
 
         try:
+            if args.command == 'serve':
+                if args.idle_timeout < 1:
+                    raise exception.CIReleasePublisherError('--idle-timeout can\'t be less than 1.')
+                serve.serve(lambda argv: main(argv, forward=False), args.idle_timeout)
+                return
+
             # Sanity-check arguments
 
             if not args.travis_api_url:
@@ -81,43 +176,113 @@ def main():
                 raise exception.CIReleasePublisherError('--tag-prefix-incomplete-releases can\'t be empty.')
             config.tag_prefix = args.tag_prefix
             config.tag_prefix_tmp = args.tag_prefix_tmp
+            if args.pool_size < 1:
+                raise exception.CIReleasePublisherError('--connection-pool-size can\'t be less than 1.')
+            config.pool_size = args.pool_size
+            if args.delete_concurrency < 1:
+                raise exception.CIReleasePublisherError('--delete-concurrency can\'t be less than 1.')
+            config.delete_concurrency = args.delete_concurrency
+            config.cache = args.cache
+            config.release_listing = args.release_listing
+            config.dry_run = args.dry_run
+            config.engine = args.engine
+            if args.http_cache_max_size < 0:
+                raise exception.CIReleasePublisherError('--http-cache-size can\'t be negative.')
+            config.http_cache_dir = args.http_cache_dir
+            config.http_cache_max_size = args.http_cache_max_size
+
+            if args.command in ['store', 'publish']:
+                if args.upload_concurrency < 1:
+                    raise exception.CIReleasePublisherError('--upload-concurrency can\'t be less than 1.')
+                config.upload_concurrency = args.upload_concurrency
+            if args.command == 'collect':
+                if args.download_concurrency < 1:
+                    raise exception.CIReleasePublisherError('--download-concurrency can\'t be less than 1.')
+                config.download_concurrency = args.download_concurrency
+                if args.download_buffer_size < 1:
+                    raise exception.CIReleasePublisherError('--download-buffer-size can\'t be less than 1.')
+                config.download_buffer_size = args.download_buffer_size
+
+            if args.command not in ['store', 'cleanup_store', 'collect', 'publish', 'cleanup_publish']:
+                raise exception.CIReleasePublisherError('Specify one of "store", "cleanup_store", "collect", "publish" or "cleanup_publish" commands.')
+
+            from . import github
+            from . import rate_limit
+            from . import release_index
+            from . import temporary_store_release
 
             github_token     = env.required('CIRP_GITHUB_ACCESS_TOKEN') if env.optional('CIRP_GITHUB_ACCESS_TOKEN') else env.required('GITHUB_ACCESS_TOKEN')
             github_repo_slug = env.required('CIRP_GITHUB_REPO_SLUG') if env.optional('CIRP_GITHUB_REPO_SLUG') else env.required('TRAVIS_REPO_SLUG')
             travis_token     = env.optional('CIRP_TRAVIS_ACCESS_TOKEN')
 
             if args.command == 'store':
+                if args.bundle and args.dedupe:
+                    raise exception.CIReleasePublisherError('--bundle and --dedupe can\'t be used together.')
                 if not os.path.isdir(args.artifact_dir):
                     raise exception.CIReleasePublisherError('Directory "{}" doesn\'t exist.'.format(args.artifact_dir))
                 if len(os.listdir(args.artifact_dir)) <= 0:
                     raise exception.CIReleasePublisherError('No artifacts found in "{}" directory.'.format(args.artifact_dir))
-                releases = github.github(github_token, args.github_api_url).get_repo(github_repo_slug).get_releases()
-                temporary_store_release.publish_with_args(args, releases, args.artifact_dir, args.github_api_url, args.travis_api_url)
+                repo = github.repo(github_token, args.github_api_url, github_repo_slug)
+                index = release_index.ReleaseIndex(github.releases(github_token, args.github_api_url, github_repo_slug), repo)
+                temporary_store_release.publish_with_args(args, index, args.artifact_dir, args.github_api_url, args.travis_api_url)
             elif args.command == 'cleanup_store':
-                releases = github.github(github_token, args.github_api_url).get_repo(github_repo_slug).get_releases()
-                temporary_store_release.cleanup_with_args(args, releases, args.github_api_url, args.travis_api_url)
+                repo = github.repo(github_token, args.github_api_url, github_repo_slug)
+                index = release_index.ReleaseIndex(github.releases(github_token, args.github_api_url, github_repo_slug), repo)
+                temporary_store_release.cleanup_with_args(args, index, args.github_api_url, args.travis_api_url)
             elif args.command == 'collect':
                 if not os.path.isdir(args.artifact_dir):
                     raise exception.CIReleasePublisherError('Directory "{}" doesn\'t exist.'.format(args.artifact_dir))
-                releases = github.github(github_token, args.github_api_url).get_repo(github_repo_slug).get_releases()
-                temporary_store_release.download(releases, args.artifact_dir)
+                repo = github.repo(github_token, args.github_api_url, github_repo_slug)
+                index = release_index.ReleaseIndex(github.releases(github_token, args.github_api_url, github_repo_slug), repo)
+                temporary_store_release.download(index, args.artifact_dir)
             elif args.command == 'publish':
-                if not os.path.isdir(args.artifact_dir):
-                    raise exception.CIReleasePublisherError('Directory "{}" doesn\'t exist.'.format(args.artifact_dir))
-                if len(os.listdir(args.artifact_dir)) <= 0:
-                    raise exception.CIReleasePublisherError('No artifacts found in "{}" directory.'.format(args.artifact_dir))
+                if args.from_store == bool(args.artifact_dir):
+                    raise exception.CIReleasePublisherError('Specify either ARTIFACT_DIR or --from-store.')
+                if args.artifact_dir:
+                    if not os.path.isdir(args.artifact_dir):
+                        raise exception.CIReleasePublisherError('Directory "{}" doesn\'t exist.'.format(args.artifact_dir))
+                    if len(os.listdir(args.artifact_dir)) <= 0:
+                        raise exception.CIReleasePublisherError('No artifacts found in "{}" directory.'.format(args.artifact_dir))
+                from . import tag_release
+                release_kinds = _release_kinds()
                 if not any(r.publish_validate_args(args) for r in release_kinds):
                     raise exception.CIReleasePublisherError('You must specify what kind of release you would like to publish.')
-                releases = github.github(github_token, args.github_api_url).get_repo(github_repo_slug).get_releases()
-                for r in release_kinds:
-                    r.publish_with_args(args, releases, args.artifact_dir, args.github_api_url, args.travis_api_url)
+                repo = github.repo(github_token, args.github_api_url, github_repo_slug)
+                index = release_index.ReleaseIndex(github.releases(github_token, args.github_api_url, github_repo_slug), repo)
+                # Tag releases are published only in tag builds, while the latest and numbered releases only in non-tag builds
+                release_kinds_to_publish = [r for r in release_kinds if r.publish_validate_args(args) and (r == tag_release) == bool(env.optional('TRAVIS_TAG'))]
+                if args.from_store:
+                    releases_stored = temporary_store_release.stored_releases(index, env.required('TRAVIS_BRANCH'), env.required('TRAVIS_BUILD_NUMBER'))
+                    if not releases_stored:
+                        raise exception.CIReleasePublisherError('Couldn\'t find any temporary store releases for this build.')
+                    artifacts = github.ReleaseArtifacts(github_token, [r.release for r in releases_stored])
+                    for r in release_kinds:
+                        if r in release_kinds_to_publish and r == release_kinds_to_publish[-1]:
+                            # The last release kind to publish can take over a temporary store release, as nothing needs it afterwards
+                            artifacts.adoptable = True
+                        r.publish_with_args(args, index, artifacts, args.github_api_url, args.travis_api_url)
+                elif len(release_kinds_to_publish) > 1:
+                    # Publish all of the release kinds at once, reading each artifact only once for all of them
+                    artifacts = github.SharedArtifacts(github_token, args.artifact_dir, len(release_kinds_to_publish))
+                    def publish(r):
+                        participant = artifacts.participant()
+                        try:
+                            r.publish_with_args(args, index, participant, args.github_api_url, args.travis_api_url)
+                        finally:
+                            participant.leave()
+                    from . import parallel
+                    parallel.run_until_error(publish, release_kinds_to_publish, len(release_kinds_to_publish))
+                else:
+                    for r in release_kinds:
+                        r.publish_with_args(args, index, args.artifact_dir, args.github_api_url, args.travis_api_url)
             elif args.command == 'cleanup_publish':
-                releases = github.github(github_token, args.github_api_url).get_repo(github_repo_slug).get_releases()
+                repo = github.repo(github_token, args.github_api_url, github_repo_slug)
+                index = release_index.ReleaseIndex(github.releases(github_token, args.github_api_url, github_repo_slug), repo)
+                from . import travis
                 branch_unfinished_build_numbers = travis.Travis(args.travis_api_url, travis_token, github_token).branch_unfinished_build_numbers(env.required('TRAVIS_REPO_SLUG'), env.required('TRAVIS_BRANCH'))
-                for r in release_kinds:
-                    r.cleanup(releases, branch_unfinished_build_numbers, args.github_api_url)
-            else:
-                raise exception.CIReleasePublisherError('Specify one of "store", "cleanup_store", "collect", "publish" or "cleanup_publish" commands.')
+                for r in _release_kinds():
+                    r.cleanup(index, branch_unfinished_build_numbers, args.github_api_url)
+            rate_limit.log_budgets()
         except exception.CIReleasePublisherError as e:
             logging.error('Error: {}'.format(str(e)))
             sys.exit(1)
@@ -125,6 +290,9 @@ def main():
         # We are removing stack traces from all uncaught exceptions, which should prevent API key leakage
         logging.error('{}: {}'.format(type(e).__name__, e))
         sys.exit(1)
+    finally:
+        # Also for the failed runs, as those are the ones worth looking into
+        metrics.log_and_write(metrics_file)
 
 if __name__ == '__main__':
     main()
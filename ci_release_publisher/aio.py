@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+
+from requests.structures import CaseInsensitiveDict
+from urllib.parse import unquote, urlencode, urljoin, urlsplit
+import asyncio
+import base64
+import json
+import logging
+import requests.utils
+import socket
+import ssl
+import time
+
+from . import config
+from . import exception
+from . import metrics
+from . import rate_limit
+
+# The asyncio engine, selected with --engine asyncio. Runs the operations made of many small API requests -- deletions
+# of releases and tags, listing and downloading the assets of many releases, paging through Travis-CI builds -- all on
+# a single thread, with the concurrency bounded by semaphores instead of by the number of threads.
+#
+# The requests are made with a small HTTP/1.1 client built on asyncio streams, so that no extra dependencies are needed.
+# It pools keep-alive connections per origin, follows redirects, goes through the proxies set in HTTP_PROXY/HTTPS_PROXY
+# the same way requests does, retries the same way config.retries() does, waits on the same rate limit governors as
+# the threaded engine and records the same metrics.
+
+_redirect_statuses = [301, 302, 303, 307, 308]
+_max_redirects = 10
+_chunk_size = 64*1024
+
+class Response:
+    def __init__(self, url, status, reason, headers, content):
+        self.url = url
+        self.status_code = status
+        self.reason = reason
+        self.headers = headers
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content.decode('utf-8'))
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise exception.CIReleasePublisherError('"{}" request has failed with {} {}. {}'.format(
+                                                    self.url, self.status_code, self.reason, self.content.decode('utf-8', 'replace')[:1000]))
+
+# The connection was closed by the server before it has sent a response, e.g. a pooled keep-alive connection timing out
+class _ConnectionClosed(Exception):
+    pass
+
+# The server has sent something that isn't a valid HTTP/1.1 response. Retried like the connection errors are, unlike a
+# ValueError, which would be a bug here rather than a network issue.
+class _ProtocolError(Exception):
+    pass
+
+def _port(parts):
+    return parts.port if parts.port else {'http': 80, 'https': 443}[parts.scheme]
+
+def _int(value, base=10):
+    try:
+        return int(value, base)
+    except ValueError:
+        raise _ProtocolError('Malformed response: {!r}.'.format(value))
+
+# Parses "HTTP/1.1 200 OK" status line into the status code and the reason
+def _status_line(line):
+    version, _, rest = line.decode('latin-1').rstrip('\r\n').partition(' ')
+    status, _, reason = rest.partition(' ')
+    if not version.startswith('HTTP/') or len(status) != 3:
+        raise _ProtocolError('Malformed status line: {!r}.'.format(line))
+    return _int(status), reason
+
+async def _read_headers(reader):
+    headers = CaseInsensitiveDict()
+    while True:
+        line = (await asyncio.wait_for(reader.readline(), config.timeout)).decode('latin-1').rstrip('\r\n')
+        if not line:
+            return headers
+        name, _, value = line.partition(':')
+        headers[name.strip()] = value.strip()
+
+# Returns the URL of the proxy to make the requests to `url` through, or None if there is none or NO_PROXY excludes
+# the host, the same way requests does
+def _proxy(url):
+    proxy = requests.utils.select_proxy(url, requests.utils.get_environ_proxies(url))
+    return urlsplit(requests.utils.prepend_scheme_if_needed(proxy, 'http')) if proxy else None
+
+def _proxy_headers(proxy):
+    if not proxy.username:
+        return []
+    credentials = '{}:{}'.format(unquote(proxy.username), unquote(proxy.password or ''))
+    return ['Proxy-Authorization: Basic {}'.format(base64.b64encode(credentials.encode('utf-8')).decode('ascii'))]
+
+class Client:
+    def __init__(self):
+        self._idle = {}
+        self._proxies = {}
+        self._ssl = None
+
+    # Opens a tunnel through the proxy to host:port with CONNECT, for the TLS connection to be made over it. Done on a
+    # bare socket rather than on a stream, as asyncio can't start TLS on an existing stream connection before Python
+    # 3.11.
+    async def _tunnel(self, proxy, host, port):
+        loop = asyncio.get_event_loop()
+        family, type_, proto, _, address = (await loop.getaddrinfo(proxy.hostname, _port(proxy), type=socket.SOCK_STREAM))[0]
+        sock = socket.socket(family, type_, proto)
+        sock.setblocking(False)
+        try:
+            await loop.sock_connect(sock, address)
+            authority = '{}:{}'.format('[{}]'.format(host) if ':' in host else host, port)
+            lines = ['CONNECT {} HTTP/1.1'.format(authority), 'Host: {}'.format(authority)] + _proxy_headers(proxy)
+            await loop.sock_sendall(sock, '\r\n'.join(lines + ['', '']).encode('latin-1'))
+            # The proxy sends nothing after its response until the TLS handshake starts, so nothing is read past it
+            response = b''
+            while b'\r\n\r\n' not in response:
+                data = await loop.sock_recv(sock, 4096)
+                if not data:
+                    raise ConnectionError('Proxy "{}" has closed the connection to "{}".'.format(proxy.netloc, authority))
+                response += data
+            status, reason = _status_line(response.split(b'\r\n', 1)[0])
+            if status != 200:
+                raise exception.CIReleasePublisherError('Proxy "{}" has refused to connect to "{}" with {} {}.'
+                                                        .format(proxy.hostname, authority, status, reason))
+        except BaseException:
+            sock.close()
+            raise
+        return sock
+
+    async def _connect(self, parts, proxy):
+        if proxy and proxy.scheme != 'http':
+            raise exception.CIReleasePublisherError('Proxy "{}" is not supported by the asyncio engine, only http:// proxies '
+                                                    'are. Use the threads engine instead.'.format(proxy.hostname))
+        if parts.scheme == 'http':
+            host, port = (proxy.hostname, _port(proxy)) if proxy else (parts.hostname, _port(parts))
+            return await asyncio.wait_for(asyncio.open_connection(host, port), config.timeout)
+        if self._ssl is None:
+            self._ssl = ssl.create_default_context()
+        if not proxy:
+            return await asyncio.wait_for(asyncio.open_connection(parts.hostname, _port(parts), ssl=self._ssl), config.timeout)
+        sock = await asyncio.wait_for(self._tunnel(proxy, parts.hostname, _port(parts)), config.timeout)
+        return await asyncio.wait_for(asyncio.open_connection(sock=sock, ssl=self._ssl, server_hostname=parts.hostname),
+                                      config.timeout)
+
+    # Reads the body into `sink`, or into the returned content if there is no sink. Also returns whether the end of the
+    # body is known without the connection getting closed, i.e. whether the connection could be reused.
+    async def _read_body(self, reader, headers, sink):
+        content = []
+        def write(data):
+            if sink:
+                sink.write(data)
+            else:
+                content.append(data)
+        # Writes out whatever has been received before the connection got dropped, so that a download can be resumed
+        async def read(size):
+            while size:
+                data = await asyncio.wait_for(reader.read(min(size, _chunk_size)), config.timeout)
+                if not data:
+                    raise asyncio.IncompleteReadError(b'', size)
+                write(data)
+                size -= len(data)
+        if 'chunked' in headers.get('Transfer-Encoding', '').lower():
+            while True:
+                size = _int((await asyncio.wait_for(reader.readline(), config.timeout)).split(b';')[0].strip(), 16)
+                if size == 0:
+                    # Trailers
+                    while (await asyncio.wait_for(reader.readline(), config.timeout)).strip():
+                        pass
+                    break
+                await read(size)
+                await asyncio.wait_for(reader.readexactly(2), config.timeout)
+            return b''.join(content), True
+        if 'Content-Length' in headers:
+            await read(_int(headers['Content-Length']))
+            return b''.join(content), True
+        # Delimited by the connection closing
+        while True:
+            data = await asyncio.wait_for(reader.read(_chunk_size), config.timeout)
+            if not data:
+                break
+            write(data)
+        return b''.join(content), False
+
+    # Makes a single request, without retries or redirects
+    async def _send(self, method, url, headers, body, sink):
+        parts = urlsplit(url)
+        origin = '{}://{}'.format(parts.scheme, parts.netloc)
+        if origin not in self._proxies:
+            self._proxies[origin] = _proxy(url)
+        proxy = self._proxies[origin]
+        idle = self._idle.setdefault(origin, [])
+        reused = bool(idle)
+        reader, writer = idle.pop() if idle else await self._connect(parts, proxy)
+        try:
+            target = '{}{}'.format(parts.path or '/', '?{}'.format(parts.query) if parts.query else '')
+            lines = ['Host: {}'.format(parts.netloc)]
+            if proxy and parts.scheme == 'http':
+                # Plain HTTP requests go to the proxy itself, with the full URL as the target
+                target = '{}://{}{}'.format(parts.scheme, parts.netloc, target)
+                lines += _proxy_headers(proxy)
+            lines = ['{} {} HTTP/1.1'.format(method, target)] + lines
+            lines += ['{}: {}'.format(name, value) for name, value in headers.items()]
+            if body is not None or method in ['POST', 'PUT', 'PATCH']:
+                lines.append('Content-Length: {}'.format(len(body or b'')))
+            writer.write('\r\n'.join(lines + ['', '']).encode('latin-1') + (body or b''))
+            await writer.drain()
+            status_line = await asyncio.wait_for(reader.readline(), config.timeout)
+            if not status_line:
+                raise _ConnectionClosed()
+            while True:
+                status, reason = _status_line(status_line)
+                response_headers = await _read_headers(reader)
+                # Interim responses, e.g. 100 Continue or 103 Early Hints, are followed by the final one
+                if not 100 <= status < 200:
+                    break
+                status_line = await asyncio.wait_for(reader.readline(), config.timeout)
+            response = Response(url, status, reason, response_headers, b'')
+            keep_alive = response_headers.get('Connection', '').lower() != 'close'
+            if method == 'HEAD' or status in [204, 304]:
+                pass
+            elif sink and 200 <= status < 300:
+                # Only the body of a successful response goes into the sink, e.g. not the error message of a failed download
+                with sink(response) as f:
+                    _, delimited = await self._read_body(reader, response_headers, f)
+                keep_alive = keep_alive and delimited
+            else:
+                response.content, delimited = await self._read_body(reader, response_headers, None)
+                keep_alive = keep_alive and delimited
+        except _ConnectionClosed:
+            writer.close()
+            if reused:
+                # Try again on a new connection, the request has never reached the server
+                return await self._send(method, url, headers, body, sink)
+            raise ConnectionError('Connection to "{}" was closed without a response.'.format(origin))
+        except BaseException:
+            writer.close()
+            raise
+        if keep_alive:
+            idle.append((reader, writer))
+        else:
+            writer.close()
+        return response
+
+    # Makes a request, retrying it and following redirects the same way the sessions of requests_retry do. If `sink` is
+    # set, the body of a successful response is written into the file object sink(response) returns, instead of being
+    # kept in memory. Requests with a sink are not retried on connection errors, as part of the body might have been
+    # written already.
+    async def request(self, method, url, headers=None, params=None, body=None, sink=None):
+        headers = dict(headers or {})
+        headers.setdefault('User-Agent', config.user_agent)
+        if params:
+            url = '{}{}{}'.format(url, '&' if urlsplit(url).query else '?', urlencode(params))
+        retry = config.retries()
+        retries = 0
+        redirects = 0
+        while True:
+            endpoint = metrics.endpoint(method, url)
+            governor = rate_limit.governor(urlsplit(url).hostname)
+            start = time.time()
+            wait = governor.try_acquire()
+            if wait > 0:
+                while wait > 0:
+                    await asyncio.sleep(wait)
+                    wait = governor.try_acquire()
+                metrics.rate_limit_wait(endpoint, time.time() - start)
+            start = time.time()
+            try:
+                response = await self._send(method, url, headers, body, sink)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, _ProtocolError) as e:
+                metrics.request(endpoint, time.time() - start, None, len(body or b''), 0)
+                if sink is not None or retries >= retry.total:
+                    raise
+                retries += 1
+                metrics.retry(endpoint)
+                logging.debug('Retrying "{}" request after {}: {}'.format(url, type(e).__name__, e))
+                await asyncio.sleep(retry.backoff_factor * (2 ** (retries - 1)))
+                continue
+            governor.update(response.headers, response.status_code)
+            metrics.request(endpoint, time.time() - start, response.status_code, len(body or b''), len(response.content))
+            if response.status_code in retry.status_forcelist and retries < retry.total:
+                retries += 1
+                metrics.retry(endpoint)
+                # The governor has seen the response, so a Retry-After or an exhausted rate limit is waited out above
+                await asyncio.sleep(retry.backoff_factor * (2 ** (retries - 1)))
+                continue
+            if response.status_code in _redirect_statuses and 'Location' in response.headers and redirects < _max_redirects:
+                redirects += 1
+                location = urljoin(url, response.headers['Location'])
+                # Don't leak the token to other hosts, e.g. to the storage GitHub redirects the asset downloads to
+                if urlsplit(location).hostname != urlsplit(url).hostname:
+                    headers.pop('Authorization', None)
+                if response.status_code == 303 or (response.status_code in [301, 302] and method == 'POST'):
+                    method = 'GET'
+                    body = None
+                url = location
+                continue
+            return response
+
+    def close(self):
+        for connections in self._idle.values():
+            for _, writer in connections:
+                writer.close()
+        self._idle.clear()
+
+# Runs `fn(client)` coroutine on a new event loop and returns its result
+def run(fn):
+    loop = asyncio.new_event_loop()
+    client = Client()
+    try:
+        return loop.run_until_complete(fn(client))
+    finally:
+        client.close()
+        # Lets the closed connections finish closing before the loop is gone
+        loop.run_until_complete(asyncio.sleep(0))
+        loop.close()
+
+# Async parallel.run_until_error(). Awaits fn(item) for every item with at most `workers` running at once, stopping
+# at the first failure. Returns a list of fn(item) results in the order of `items`.
+async def run_until_error(fn, items, workers):
+    semaphore = asyncio.Semaphore(workers)
+    async def run_item(item):
+        async with semaphore:
+            return await fn(item)
+    futures = [asyncio.ensure_future(run_item(item)) for item in items]
+    try:
+        return await asyncio.gather(*futures)
+    except Exception:
+        for future in futures:
+            future.cancel()
+        await asyncio.gather(*futures, return_exceptions=True)
+        raise
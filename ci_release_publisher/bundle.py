@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import os
+import shutil
+import stat
+import tarfile
+
+from . import exception
+
+# Bundles of artifacts, made by "store --bundle", for the jobs producing many small artifacts. All of the artifacts of a
+# job are stored as a single tar asset, so that storing and collecting them takes a single API request instead of one
+# per artifact. The tar is generated while it's being uploaded and extracted while it's being downloaded, it's never
+# written to disk as a whole.
+#
+# The tar is not compressed, as GitHub needs to know the size of an asset before it's uploaded, which for a compressed
+# archive is known only once the whole archive is made.
+
+suffix = '.cirp-bundle.tar'
+
+def is_bundle(name):
+    return name.endswith(suffix)
+
+def _padded(size):
+    return (size + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE * tarfile.BLOCKSIZE
+
+# File-like object reading a tar of the artifacts as it's generated, with the size of the tar known upfront. Can be
+# rewound to the start, so that a failed upload can be retried.
+class Reader:
+    _chunk_size = 1024*1024
+
+    def __init__(self, src_dir, artifacts):
+        self._members = []
+        size = 0
+        for artifact in artifacts:
+            path = os.path.join(src_dir, artifact)
+            st = os.stat(path)
+            info = tarfile.TarInfo(artifact)
+            info.size = st.st_size
+            info.mtime = int(st.st_mtime)
+            info.mode = stat.S_IMODE(st.st_mode)
+            header = info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+            self._members.append((path, info, header))
+            size += len(header) + _padded(info.size)
+        # The end of archive marker, padded to a whole record the same way tarfile does it
+        end = size + 2 * tarfile.BLOCKSIZE
+        self.size = (end + tarfile.RECORDSIZE - 1) // tarfile.RECORDSIZE * tarfile.RECORDSIZE
+        self._trailer = self.size - size
+        self.seek(0)
+
+    def _generate(self):
+        for path, info, header in self._members:
+            yield header
+            with open(path, 'rb') as f:
+                remaining = info.size
+                while remaining > 0:
+                    chunk = f.read(min(self._chunk_size, remaining))
+                    if not chunk:
+                        raise exception.CIReleasePublisherError('"{}" artifact got truncated while bundling it.'.format(info.name))
+                    remaining -= len(chunk)
+                    yield chunk
+            if _padded(info.size) != info.size:
+                yield tarfile.NUL * (_padded(info.size) - info.size)
+        yield tarfile.NUL * self._trailer
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset):
+        if offset != 0:
+            raise ValueError('A bundle can be rewound only to the start.')
+        self._chunks = self._generate()
+        self._buffer = b''
+        self._position = 0
+
+    def read(self, size):
+        while len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        self._position += len(data)
+        return data
+
+    # Returns the sha256 hex digest of the tar, leaving the reader rewound to the start
+    def sha256(self):
+        sha256 = hashlib.sha256()
+        self.seek(0)
+        for chunk in iter(lambda: self.read(self._chunk_size), b''):
+            sha256.update(chunk)
+        self.seek(0)
+        return sha256.hexdigest()
+
+# Extracts the artifacts out of a tar read from the file object, reading it front to back without seeking.
+# Returns the names of the extracted artifacts.
+def extract(fileobj, dst_dir, buffer_size):
+    artifacts = []
+    with tarfile.open(fileobj=fileobj, mode='r|') as tar:
+        for member in tar:
+            # Bundles hold only the files of a single directory, don't let anything else write outside of dst_dir
+            if not member.isfile() or member.name in ['', '.', '..'] or os.path.basename(member.name) != member.name:
+                raise exception.CIReleasePublisherError('Unexpected "{}" entry in the bundle.'.format(member.name))
+            with open(os.path.join(dst_dir, member.name), 'wb') as f:
+                shutil.copyfileobj(tar.extractfile(member), f, buffer_size)
+            artifacts.append(member.name)
+    return artifacts
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from . import config
+from . import env
+
+# On-disk cache for the Travis-CI token exchanged for the GitHub token, so that the several invocations made during the
+# same CI job, e.g. "cleanup_store" followed by "publish" and "cleanup_publish", don't exchange it again. Lives in
+# $HOME/.cache and is scoped to the job: outside of a CI job, without $TRAVIS_JOB_ID, nothing is cached, and the
+# directories of the other jobs are removed once they are older than the longest a job can run. The entries are keyed
+# by the API URL and a hash of the token used, so that a result obtained with one token is never returned for another.
+# Any failure to use the cache is treated as a cache miss.
+class Cache:
+    # Well past the 3 hours after which Travis-CI stops a job
+    _max_age = 24*60*60
+
+    def __init__(self, api_url, token):
+        key = hashlib.sha256('{}\n{}'.format(api_url, token).encode('utf-8')).hexdigest()
+        self._job_id = env.optional('TRAVIS_JOB_ID')
+        self._root = os.path.join(os.path.expanduser('~'), '.cache', 'ci-release-publisher')
+        self._dir = os.path.join(self._root, self._job_id or '', key)
+
+    def _enabled(self):
+        return config.cache and bool(self._job_id)
+
+    # Removes the directories of the jobs that are over
+    def _prune(self):
+        try:
+            for job_id in os.listdir(self._root):
+                path = os.path.join(self._root, job_id)
+                if job_id != self._job_id and time.time() - os.path.getmtime(path) > self._max_age:
+                    shutil.rmtree(path, ignore_errors=True)
+        except OSError:
+            pass
+
+    def _path(self, name):
+        return os.path.join(self._dir, '{}.json'.format(hashlib.sha256(name.encode('utf-8')).hexdigest()))
+
+    # Returns the cached value, or None if there is none or it's older than `ttl` seconds
+    def get(self, name, ttl=None):
+        if not self._enabled():
+            return None
+        try:
+            with open(self._path(name), 'r') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry.get('name') != name:
+            return None
+        if ttl is not None and time.time() - entry['time'] > ttl:
+            return None
+        return entry['value']
+
+    def set(self, name, value):
+        if not self._enabled():
+            return
+        self._prune()
+        try:
+            # The cache might hold tokens, keep it private
+            os.makedirs(self._dir, mode=0o700, exist_ok=True)
+            # Write atomically, so that a concurrent reader never sees a partially written entry
+            fd, tmp_path = tempfile.mkstemp(dir=self._dir, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump({'name': name, 'time': time.time(), 'value': value}, f)
+                os.replace(tmp_path, self._path(name))
+            except Exception:
+                os.remove(tmp_path)
+                raise
+        except OSError:
+            pass
+
+    def invalidate(self, name):
+        try:
+            os.remove(self._path(name))
+        except OSError:
+            pass
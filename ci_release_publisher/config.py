@@ -1,13 +1,38 @@
 # -*- coding: utf-8 -*-
 
-from urllib3.util.retry import Retry
-
 from .__version__ import __title__, __version__
 
 user_agent = '{} {}'.format(__title__, __version__)
 tag_prefix = 'ci'
 tag_prefix_tmp = '_'
 timeout = 15
+pool_size = 10
+delete_concurrency = 1
+upload_concurrency = 1
+download_concurrency = 1
+download_attempts = 5
+download_buffer_size = 1024*1024
+# Number of pages of API results to fetch in parallel
+page_concurrency = 4
+cache = True
+# Directory of the HTTP cache for the release listing, None disables it
+http_cache_dir = None
+http_cache_max_size = 64*1024*1024
+# API to list the releases over, "rest" or "graphql"
+release_listing = 'rest'
+# Runs the operations made of many small API requests in threads, "threads", or on a single thread, "asyncio"
+engine = 'threads'
+# Only log the changes that would be made on GitHub, without making them
+dry_run = False
+# How far off the clock of a committer can be, in seconds
+clock_skew = 24*60*60
 
 def retries():
-    return Retry(total=7, backoff_factor=0.1, status_forcelist=[403, 500, 502, 503, 504], method_whitelist=list(Retry.DEFAULT_METHOD_WHITELIST)+['POST'])
+    # Imported here, as urllib3 is slow to import and isn't needed by the commands that are forwarded to a server
+    from . import rate_limit
+    # urllib3 1.26 has renamed method_whitelist to allowed_methods and urllib3 2.0 has removed the old name
+    if hasattr(rate_limit.Retry, 'DEFAULT_ALLOWED_METHODS'):
+        methods = {'allowed_methods': list(rate_limit.Retry.DEFAULT_ALLOWED_METHODS)+['POST']}
+    else:
+        methods = {'method_whitelist': list(rate_limit.Retry.DEFAULT_METHOD_WHITELIST)+['POST']}
+    return rate_limit.Retry(total=7, backoff_factor=0.1, status_forcelist=[403, 429, 500, 502, 503, 504], **methods)
@@ -1,72 +1,1211 @@
 # -*- coding: utf-8 -*-
 
-from github import Github
-import cgi
+from concurrent.futures import ThreadPoolExecutor
+from github import Github, Requester
+import asyncio
+import datetime
+import hashlib
+import inspect
+import io
+import json
 import logging
+import mimetypes
 import os
+import queue
+import re
+import requests
 import shutil
+import tarfile
+import threading
+import time
+import urllib3
 
+from . import aio
+from . import bundle
 from . import config
+from . import exception
+from . import manifest
+from . import parallel
+from . import plan
 from .requests_retry import requests_retry
 
 # Various GitHub helpers
 
+# The base __init__() is not called, as it would create a session and an adapter on every request only for them to be
+# thrown away in favor of our session.
+def _init_connection(connection, protocol, default_port, host, port=None, strict=False, timeout=None, retry=None, pool_size=None, **kwargs):
+    connection.port = port if port else default_port
+    connection.host = host
+    connection.protocol = protocol
+    connection.timeout = timeout
+    connection.verify = kwargs.get('verify', True)
+    connection.retry = retry
+    connection.pool_size = pool_size
+    connection.session = requests_retry('{}://{}:{}'.format(protocol, connection.host, connection.port))
+
+# By default PyGithub re-uses a single connection object for all requests, which is not thread-safe as the request
+# state is stored on the connection object itself. We make PyGithub create a new connection object for each request
+# instead, allowing us to make requests from several threads at once, with the connection objects being just thin
+# wrappers around our pooled sessions, so no actual connections are re-established.
+class _HTTPRequestsConnectionClass(Requester.HTTPRequestsConnectionClass):
+    def __init__(self, *args, **kwargs):
+        _init_connection(self, 'http', 80, *args, **kwargs)
+
+    def close(self):
+        # The session is shared, keep its connections open
+        pass
+
+class _HTTPSRequestsConnectionClass(Requester.HTTPSRequestsConnectionClass):
+    def __init__(self, *args, **kwargs):
+        _init_connection(self, 'https', 443, *args, **kwargs)
+
+    def close(self):
+        # The session is shared, keep its connections open
+        pass
+
+Requester.Requester.injectConnectionClasses(_HTTPRequestsConnectionClass, _HTTPSRequestsConnectionClass)
+
+_github = {}
+_repo = {}
+_lock = threading.Lock()
+
 def github(github_token, github_api_url):
-    # 100 items per page is the max https://developer.github.com/v3/guides/traversing-with-pagination/#changing-the-number-of-items-received
-    return Github(login_or_token=github_token, base_url=github_api_url, per_page=100, timeout=config.timeout, retry=config.retries(), user_agent=config.user_agent)
+    with _lock:
+        if (github_token, github_api_url) not in _github:
+            kwargs = {}
+            # Newer PyGithub versions wait between requests on their own, a second between writes, which serializes the
+            # parallel deletions and uploads. The requests are paced according to the rate limits by rate_limit instead.
+            if 'seconds_between_writes' in inspect.signature(Github.__init__).parameters:
+                kwargs = {'seconds_between_requests': None, 'seconds_between_writes': None}
+            # 100 items per page is the max https://developer.github.com/v3/guides/traversing-with-pagination/#changing-the-number-of-items-received
+            _github[(github_token, github_api_url)] = Github(login_or_token=github_token, base_url=github_api_url, per_page=100, timeout=config.timeout, retry=config.retries(), user_agent=config.user_agent, **kwargs)
+        return _github[(github_token, github_api_url)]
+
+# Returns a Repository object, fetching it only once per repo, as every get_repo() call is a separate GET request.
+def repo(github_token, github_api_url, github_repo_slug):
+    gh = github(github_token, github_api_url)
+    with _lock:
+        if (github_token, github_api_url, github_repo_slug) not in _repo:
+            _repo[(github_token, github_api_url, github_repo_slug)] = gh.get_repo(github_repo_slug)
+        return _repo[(github_token, github_api_url, github_repo_slug)]
 
-def download_artifact(github_token, src_url, dst_dir):
+# Only the fields the release modules look at when picking releases and the number of the assets, everything else is
+# fetched over the REST API once a release is picked. The assets themselves are not listed here, as GraphQL doesn't
+# tell the upload state or the digest of an asset. Releases are ordered newest first, the same as in the REST API
+# listing.
+_graphql_releases_query = """
+query($owner: String!, $name: String!, $cursor: String) {
+  repository(owner: $owner, name: $name) {
+    releases(first: 100, after: $cursor, orderBy: {field: CREATED_AT, direction: DESC}) {
+      pageInfo { hasNextPage endCursor }
+      nodes { databaseId tagName isDraft createdAt releaseAssets { totalCount } }
+    }
+  }
+}
+"""
+
+def _graphql_url(github_api_url):
+    # GitHub Enterprise has the REST API at /api/v3 and the GraphQL API at /api/graphql
+    if github_api_url.rstrip('/').endswith('/v3'):
+        return '{}/graphql'.format(github_api_url.rstrip('/')[:-len('/v3')])
+    return '{}/graphql'.format(github_api_url.rstrip('/'))
+
+# A release listed over the GraphQL API. Has the fields the release modules use to pick releases, and deletes the
+# release and lists its assets by the release id, which is all that most of the releases are listed for. The rest of
+# the attributes and methods are those of the full release, which is fetched on the first use of any of them.
+class _GraphQLRelease:
+    def __init__(self, github_token, github_api_url, github_repo_slug, node):
+        self.id = node['databaseId']
+        self.tag_name = node['tagName']
+        self.draft = node['isDraft']
+        self._asset_count = node['releaseAssets']['totalCount']
+        # Timezone-aware, the same as PyGithub's
+        self.created_at = datetime.datetime.strptime(node['createdAt'], '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=datetime.timezone.utc)
+        # The REST API URL of the release, the same as PyGithub's
+        self.url = '{}/repos/{}/releases/{}'.format(github_api_url.rstrip('/'), github_repo_slug, self.id)
+        self._github_token = github_token
+        self._repo = (github_token, github_api_url, github_repo_slug)
+        self._release = None
+        self._lock = threading.Lock()
+
+    def delete_release(self):
+        r = requests_retry(self.url).delete(self.url, headers=_rest_headers(self._github_token), timeout=config.timeout)
+        r.raise_for_status()
+        return True
+
+    def get_assets(self):
+        if not self._asset_count:
+            return []
+        return _release_assets(self._github_token, self)
+
+    def __getattr__(self, name):
+        # Called only for the attributes not set in __init__()
+        if name.startswith('_'):
+            raise AttributeError(name)
+        with self._lock:
+            if self._release is None:
+                self._release = repo(*self._repo).get_release(self.id)
+        return getattr(self._release, name)
+
+def _graphql_releases(github_token, github_api_url, github_repo_slug):
+    url = _graphql_url(github_api_url)
+    headers = {
+        'Authorization': 'bearer {}'.format(github_token),
+        'User-Agent': config.user_agent,
+    }
+    owner, name = github_repo_slug.split('/', 1)
+    cursor = None
+    while True:
+        r = requests_retry(url).post(url, json={'query': _graphql_releases_query, 'variables': {'owner': owner, 'name': name, 'cursor': cursor}},
+                                     headers=headers, timeout=config.timeout)
+        r.raise_for_status()
+        result = r.json()
+        if result.get('errors'):
+            raise exception.CIReleasePublisherError('GitHub GraphQL API error: {}'.format('; '.join(e.get('message', '') for e in result['errors'])))
+        releases = result['data']['repository']['releases']
+        for node in releases['nodes']:
+            yield _GraphQLRelease(github_token, github_api_url, github_repo_slug, node)
+        if not releases['pageInfo']['hasNextPage']:
+            return
+        cursor = releases['pageInfo']['endCursor']
+
+# Returns an iterable of the releases of the repo, listed newest first over the API selected by config.release_listing.
+# The releases are listed lazily, page by page.
+def releases(github_token, github_api_url, github_repo_slug):
+    if config.release_listing == 'graphql':
+        return _graphql_releases(github_token, github_api_url, github_repo_slug)
+    return repo(github_token, github_api_url, github_repo_slug).get_releases()
+
+# Headers of the REST API requests made by the asyncio engine
+def _api_headers(github_token):
+    return {
+        'Authorization': 'token {}'.format(github_token),
+        'Accept': 'application/vnd.github.v3+json',
+    }
+
+# Headers of the REST API requests made with requests rather than with PyGithub
+def _rest_headers(github_token):
+    return dict(_api_headers(github_token), **{'User-Agent': config.user_agent})
+
+def _download_headers(github_token):
     # API doc: https://developer.github.com/v3/repos/releases/#get-a-single-release-asset
     # In order to download draft artifacts you need a GitHub token with write access to that repo,
     # otherwise you can't download those artifacts, the download URLs are "private" in a sense.
-    headers = {
+    return {
         'Authorization': 'token {}'.format(github_token),
         'Accept': 'application/octet-stream',
         'User-Agent': config.user_agent,
     }
-    r = requests_retry().get(src_url, headers=headers, allow_redirects=True, stream=True, timeout=config.timeout)
-    filename = ''
-    # Figure out filename
-    # 1. Proper way of doing it
-    cd = r.headers.get('Content-Disposition')
-    if cd:
-        _, params = cgi.parse_header(cd)
-        if 'filename' in params:
-            filename = params['filename']
-    # 2. Last resort way of doing it
-    if not filename:
-        filename = src_url.split('/')[-1]
-    filepath = os.path.join(dst_dir, filename)
-    with open(filepath, 'wb') as f:
-        shutil.copyfileobj(r.raw, f)
+
+# What a partially downloaded file is checked against before the download is resumed: the asset it's a part of, along
+# with the time the asset was last updated, as an asset can be deleted and uploaded again under the same name
+def _asset_identity(artifact):
+    return {'url': artifact.url, 'size': artifact.size, 'updated_at': str(getattr(artifact, 'updated_at', None)), 'digest': asset_sha256(artifact)}
+
+# The state of a partially downloaded file is kept next to it: the identity of the asset and the validator of the
+# response, the ETag or the Last-Modified date, which a resumed download sends in If-Range
+def _download_state_filepath(part_filepath):
+    return '{}.json'.format(part_filepath)
+
+def _read_download_state(part_filepath):
+    try:
+        with open(_download_state_filepath(part_filepath), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _write_download_state(part_filepath, state):
+    with open(_download_state_filepath(part_filepath), 'w') as f:
+        json.dump(state, f)
+
+# Download into a separate file, so that an interrupted download never leaves a truncated artifact behind
+# and can be resumed from where it has stopped, even by a later run
+def _download_part_filepath(artifact, dst_dir):
+    part_filepath = '{}.part'.format(os.path.join(dst_dir, artifact.name))
+    state = _read_download_state(part_filepath)
+    if not os.path.isfile(part_filepath) or not state or state.get('asset') != _asset_identity(artifact):
+        if os.path.isfile(part_filepath) and os.path.getsize(part_filepath):
+            logging.info('\tDiscarding the partially downloaded "{}" artifact as it\'s a part of a different asset.'.format(artifact.name))
+        # Also makes an empty artifact end up as an empty file without downloading anything
+        open(part_filepath, 'wb').close()
+        _write_download_state(part_filepath, {'asset': _asset_identity(artifact), 'validator': None})
+    return part_filepath
+
+# Returns the offset to resume the download from and sets the Range header for it, or returns None if it's done
+def _download_offset(artifact, part_filepath, headers):
+    offset = os.path.getsize(part_filepath)
+    validator = (_read_download_state(part_filepath) or {}).get('validator')
+    # Without a validator there is no telling whether the rest of the artifact would be of the same content
+    if offset > artifact.size or (offset < artifact.size and not validator):
+        open(part_filepath, 'wb').close()
+        offset = 0
+    if offset == artifact.size:
+        return None
+    headers.pop('Range', None)
+    headers.pop('If-Range', None)
+    if offset:
+        headers['Range'] = 'bytes={}-'.format(offset)
+        # The server sends the whole artifact instead if it has changed since
+        headers['If-Range'] = validator
+        logging.info('\tResuming download of "{}" artifact from byte {}.'.format(artifact.name, offset))
+    return offset
+
+# Opens the partially downloaded file to write the body of the response into. It's appended to only if the server has
+# sent the requested range, otherwise the whole artifact is being sent, the validator of which is recorded.
+def _open_part(part_filepath, offset, response):
+    if offset and response.status_code == 206:
+        return open(part_filepath, 'ab')
+    etag = response.headers.get('ETag')
+    state = _read_download_state(part_filepath) or {}
+    # A weak ETag can't be used in If-Range
+    state['validator'] = etag if etag and not etag.startswith('W/') else response.headers.get('Last-Modified')
+    _write_download_state(part_filepath, state)
+    return open(part_filepath, 'wb')
+
+def _download_finish(artifact, part_filepath, dst_dir):
+    size = os.path.getsize(part_filepath)
+    if size != artifact.size:
+        raise exception.CIReleasePublisherError('Downloaded {} out of {} bytes of "{}" artifact.'.format(size, artifact.size, artifact.name))
+    sha256 = asset_sha256(artifact)
+    if sha256 and sha256 != file_sha256(part_filepath):
+        os.remove(part_filepath)
+        os.remove(_download_state_filepath(part_filepath))
+        raise exception.CIReleasePublisherError('Downloaded "{}" artifact doesn\'t match its sha256 digest.'.format(artifact.name))
+    filepath = os.path.join(dst_dir, artifact.name)
+    os.replace(part_filepath, filepath)
+    os.remove(_download_state_filepath(part_filepath))
     return filepath
 
-def download_artifcats(github_token, release, dst_dir):
-    logging.info('Downloading artifacts from "{}" release.'.format(release.tag_name))
+def download_artifact(github_token, artifact, dst_dir):
+    headers = _download_headers(github_token)
+    part_filepath = _download_part_filepath(artifact, dst_dir)
+    for attempt in range(config.download_attempts):
+        offset = _download_offset(artifact, part_filepath, headers)
+        if offset is None:
+            break
+        r = None
+        try:
+            r = requests_retry(artifact.url).get(artifact.url, headers=headers, allow_redirects=True, stream=True, timeout=config.timeout)
+            r.raise_for_status()
+            # The server is free to ignore the range and send the whole file
+            with _open_part(part_filepath, offset, r) as f:
+                shutil.copyfileobj(r.raw, f, config.download_buffer_size)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, urllib3.exceptions.HTTPError) as e:
+            logging.warning('\tDownload of "{}" artifact got interrupted. {}: {}'.format(artifact.name, type(e).__name__, e))
+        finally:
+            # Releases the connection of an interrupted download instead of leaving it to the garbage collector
+            if r is not None:
+                r.close()
+    return _download_finish(artifact, part_filepath, dst_dir)
+
+async def _download_artifact_async(client, github_token, artifact, dst_dir):
+    headers = _download_headers(github_token)
+    part_filepath = _download_part_filepath(artifact, dst_dir)
+    for attempt in range(config.download_attempts):
+        offset = _download_offset(artifact, part_filepath, headers)
+        if offset is None:
+            break
+        try:
+            # The server is free to ignore the range and send the whole file
+            r = await client.request('GET', artifact.url, headers=headers,
+                                     sink=lambda r, offset=offset: _open_part(part_filepath, offset, r))
+            r.raise_for_status()
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+            logging.warning('\tDownload of "{}" artifact got interrupted. {}: {}'.format(artifact.name, type(e).__name__, e))
+    return _download_finish(artifact, part_filepath, dst_dir)
+
+# File-like object hashing and counting the bytes read from the underlying one
+class _HashingReader:
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self._fileobj.read(size)
+        self.sha256.update(data)
+        self.size += len(data)
+        return data
+
+# Downloads the bundle while extracting it into a directory next to where the artifacts go, from which they are moved
+# into place by _move_bundles() once everything is downloaded. Returns the names of the extracted artifacts.
+def _download_bundle(github_token, artifact, dst_dir):
+    headers = _download_headers(github_token)
+    bundle_dir = '{}.part'.format(os.path.join(dst_dir, artifact.name))
+    for attempt in range(config.download_attempts):
+        # A tar stream can't be resumed in the middle, so an interrupted download starts over
+        shutil.rmtree(bundle_dir, ignore_errors=True)
+        os.makedirs(bundle_dir)
+        r = None
+        try:
+            r = requests_retry(artifact.url).get(artifact.url, headers=headers, allow_redirects=True, stream=True, timeout=config.timeout)
+            r.raise_for_status()
+            reader = _HashingReader(r.raw)
+            artifacts = bundle.extract(reader, bundle_dir, config.download_buffer_size)
+            # The padding after the end of the archive, which tarfile doesn't read
+            while reader.read(config.download_buffer_size):
+                pass
+            break
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, urllib3.exceptions.HTTPError, tarfile.ReadError) as e:
+            logging.warning('\tDownload of "{}" bundle got interrupted. {}: {}'.format(artifact.name, type(e).__name__, e))
+        finally:
+            if r is not None:
+                r.close()
+    else:
+        raise exception.CIReleasePublisherError('Failed to download "{}" bundle.'.format(artifact.name))
+    if reader.size != artifact.size:
+        raise exception.CIReleasePublisherError('Downloaded {} out of {} bytes of "{}" bundle.'.format(reader.size, artifact.size, artifact.name))
+    sha256 = asset_sha256(artifact)
+    if sha256 and sha256 != reader.sha256.hexdigest():
+        raise exception.CIReleasePublisherError('Downloaded "{}" bundle doesn\'t match its sha256 digest.'.format(artifact.name))
+    logging.info('\tExtracted {} artifact(s) out of "{}" bundle.'.format(len(artifacts), artifact.name))
+    return artifacts
+
+# Moves the artifacts extracted out of the bundles into place, in the order of the releases, so that an artifact of
+# a latter release takes the place of the same named artifact of a former release, the same as with the other assets
+def _move_bundles(artifacts, bundles_artifacts, dst_dir):
+    for release, artifact in artifacts.values():
+        if artifact.name not in bundles_artifacts:
+            continue
+        bundle_dir = '{}.part'.format(os.path.join(dst_dir, artifact.name))
+        for name in bundles_artifacts[artifact.name]:
+            os.replace(os.path.join(bundle_dir, name), os.path.join(dst_dir, name))
+        shutil.rmtree(bundle_dir)
+
+# An asset listed without PyGithub, by the asyncio engine or for a release listed over the GraphQL API, with the fields
+# of PyGithub's asset that the release modules use. Can be deleted only if listed with a token.
+class _Asset:
+    def __init__(self, raw, github_token=None):
+        self.id = raw['id']
+        self.name = raw['name']
+        self.size = raw['size']
+        self.state = raw['state']
+        self.url = raw['url']
+        self.content_type = raw.get('content_type')
+        self.digest = raw.get('digest')
+        # Timezone-aware, the same as PyGithub's
+        self.updated_at = datetime.datetime.strptime(raw['updated_at'], '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=datetime.timezone.utc) if raw.get('updated_at') else None
+        self._github_token = github_token
+
+    def delete_asset(self):
+        r = requests_retry(self.url).delete(self.url, headers=_rest_headers(self._github_token), timeout=config.timeout)
+        r.raise_for_status()
+        return True
+
+# Returns the assets of the release, listed page by page the same as release.get_assets() does
+def _release_assets(github_token, release):
+    assets = []
+    url = '{}/assets?per_page=100'.format(release.url)
+    while url:
+        r = requests_retry(url).get(url, headers=_rest_headers(github_token), timeout=config.timeout)
+        r.raise_for_status()
+        assets.extend(_Asset(raw, github_token) for raw in r.json())
+        url = r.links.get('next', {}).get('url')
+    return assets
+
+# Returns the assets of the release, listed page by page the same as release.get_assets() does
+async def _release_assets_async(client, github_token, release):
+    headers = _api_headers(github_token)
+    assets = []
+    url = '{}/assets?per_page=100'.format(release.url)
+    while url:
+        r = await client.request('GET', url, headers=headers)
+        r.raise_for_status()
+        assets.extend(_Asset(raw) for raw in r.json())
+        url = next((link['url'] for link in requests.utils.parse_header_links(r.headers.get('Link', '')) if link.get('rel') == 'next'), None)
+    return assets
+
+# An asset standing in for an artifact with the same content but a different name, e.g. for an artifact that
+# "store --dedupe" hasn't uploaded as another store release has the same content already
+class _NamedAsset:
+    def __init__(self, asset, name):
+        self.asset = asset
+        self.name = name
+
+    def __getattr__(self, name):
+        return getattr(self.asset, name)
+
+# Returns the manifest asset out of the assets of a release, or None if there is none
+def _manifest_asset(assets):
+    return next((asset for asset in assets if manifest.is_manifest(asset.name)), None)
+
+# Returns the name -> sha256 dict of the manifest out of the assets of a release, or None if there is no manifest
+def _release_manifest(github_token, assets):
+    asset = _manifest_asset(assets)
+    if not asset:
+        return None
+    r = requests_retry(asset.url).get(asset.url, headers=_download_headers(github_token), allow_redirects=True, timeout=config.timeout)
+    r.raise_for_status()
+    return manifest.loads(asset.name, r.content)
+
+async def _release_manifest_async(client, github_token, assets):
+    asset = _manifest_asset(assets)
+    if not asset:
+        return None
+    r = await client.request('GET', asset.url, headers=_download_headers(github_token))
+    r.raise_for_status()
+    return manifest.loads(asset.name, r.content)
+
+# Returns the sha256 -> asset dict of the content stored in the releases, going by the manifests of the releases, or by
+# the digests GitHub reports for the releases without a manifest
+def _stored_content(releases_assets, manifests):
+    content = {}
+    for assets, hashes in zip(releases_assets, manifests):
+        for asset in assets:
+            sha256 = hashes.get(asset.name) if hashes is not None else asset_sha256(asset)
+            if sha256 and asset.state == 'uploaded' and not manifest.is_manifest(asset.name):
+                content.setdefault(sha256, asset)
+    return content
+
+# Returns the assets of the releases with the manifests resolved: the manifests themselves are left out, while the
+# artifacts a manifest lists but the release doesn't store are stood in for by an asset with the same content
+def _resolve_manifests(releases, releases_assets, manifests):
+    content = _stored_content(releases_assets, manifests)
+    resolved = []
+    for release, assets, hashes in zip(releases, releases_assets, manifests):
+        stored = {asset.name: asset for asset in assets if not manifest.is_manifest(asset.name)}
+        if hashes is None:
+            resolved.append(list(stored.values()))
+            continue
+        release_assets = []
+        for name, sha256 in sorted(hashes.items()):
+            if name in stored:
+                release_assets.append(stored[name])
+            elif sha256 in content:
+                release_assets.append(_NamedAsset(content[sha256], name))
+            else:
+                raise exception.CIReleasePublisherError('Couldn\'t find the content of "{}" artifact of "{}" release in any of the store releases.'.format(name, release.tag_name))
+        resolved.append(release_assets)
+    return resolved
+
+# Returns a name -> (release, asset) dict of the assets of the releases. An asset of a latter release takes the place of
+# the same named asset of a former release, the same way it would if the assets were downloaded into a directory.
+def _assets_by_name(releases, releases_assets):
+    assets = {}
+    for release, release_assets in zip(releases, releases_assets):
+        logging.info('Found {} artifact(s) in "{}" release.'.format(len(release_assets), release.tag_name))
+        for asset in release_assets:
+            if asset.name in assets:
+                logging.info('\tArtifact "{}" of "{}" release will be overwritten by the one in "{}" release.'.format(asset.name, assets[asset.name][0].tag_name, release.tag_name))
+                del assets[asset.name]
+            assets[asset.name] = (release, asset)
+    return assets
+
+# Returns a name -> [names] dict of the artifacts to download, each along with the other artifacts stood in for by the
+# same asset, which are copied from the downloaded artifact instead of being downloaded again
+def _same_content(artifacts):
+    copies = {}
+    by_url = {}
+    for name, (release, asset) in artifacts.items():
+        if asset.url in by_url:
+            copies[by_url[asset.url]].append(name)
+            continue
+        by_url[asset.url] = name
+        copies[name] = []
+    return copies
+
+def _copy_same_content(copies, dst_dir):
+    for name, other_names in copies.items():
+        for other_name in other_names:
+            logging.info('\tCopying "{}" artifact from "{}" artifact as they have the same content.'.format(other_name, name))
+            shutil.copyfile(os.path.join(dst_dir, name), os.path.join(dst_dir, other_name))
+
+def download_artifacts(github_token, releases, dst_dir):
+    logging.info('Downloading artifacts from {} release(s).'.format(len(releases)))
+    if config.engine == 'asyncio':
+        aio.run(lambda client: _download_artifacts_async(client, github_token, releases, dst_dir))
+        return
     # This might look dumb but get_assets() returns a custom type that is a lazy list which doesn't support len(),
     # so we eagerly load everything as we want to get len() and we'd load all of the assets later anyway.
-    artifacts = [asset for asset in release.get_assets()]
-    logging.info('Found {} artifact(s) in the release.'.format(len(artifacts)))
+    releases_artifacts = parallel.run_until_error(lambda release: [asset for asset in release.get_assets()], releases, config.download_concurrency)
+    manifests = parallel.run_until_error(lambda assets: _release_manifest(github_token, assets), releases_artifacts, config.download_concurrency)
+    # Put artifacts of all releases in a single queue, so that the download workers don't idle waiting on the slowest
+    # artifact of a release before moving on to the next release. There is no point in downloading the artifacts that
+    # would be overwritten, plus writing into the same file from several threads at once would corrupt it.
+    artifacts = _assets_by_name(releases, _resolve_manifests(releases, releases_artifacts, manifests))
+    copies = _same_content(artifacts)
+    bundles_artifacts = {}
+    def download(release_artifact):
+        release, artifact = release_artifact
+        logging.info('\tDownloading artifact "{}" ({} bytes) from "{}" release.'.format(artifact.name, artifact.size, release.tag_name))
+        if bundle.is_bundle(artifact.name):
+            bundles_artifacts[artifact.name] = _download_bundle(github_token, artifact, dst_dir)
+        else:
+            download_artifact(github_token, artifact, dst_dir)
+        return artifact.size
+    start_time = time.time()
+    sizes = parallel.run_until_error(download, [artifacts[name] for name in copies], config.download_concurrency)
+    _move_bundles(artifacts, bundles_artifacts, dst_dir)
+    _copy_same_content(copies, dst_dir)
+    logging.info('All {} artifact(s) are downloaded, {} bytes in {:.1f} seconds.'.format(len(sizes), sum(sizes), time.time() - start_time))
+
+async def _download_artifacts_async(client, github_token, releases, dst_dir):
+    releases_artifacts = await aio.run_until_error(lambda release: _release_assets_async(client, github_token, release), releases, config.download_concurrency)
+    manifests = await aio.run_until_error(lambda assets: _release_manifest_async(client, github_token, assets), releases_artifacts, config.download_concurrency)
+    artifacts = _assets_by_name(releases, _resolve_manifests(releases, releases_artifacts, manifests))
+    copies = _same_content(artifacts)
+    bundles_artifacts = {}
+    async def download(release_artifact):
+        release, artifact = release_artifact
+        logging.info('\tDownloading artifact "{}" ({} bytes) from "{}" release.'.format(artifact.name, artifact.size, release.tag_name))
+        if bundle.is_bundle(artifact.name):
+            # tarfile reads the stream, so the bundle is extracted in a thread
+            bundles_artifacts[artifact.name] = await asyncio.get_event_loop().run_in_executor(None, _download_bundle, github_token, artifact, dst_dir)
+        else:
+            await _download_artifact_async(client, github_token, artifact, dst_dir)
+        return artifact.size
+    start_time = time.time()
+    sizes = await aio.run_until_error(download, [artifacts[name] for name in copies], config.download_concurrency)
+    _move_bundles(artifacts, bundles_artifacts, dst_dir)
+    _copy_same_content(copies, dst_dir)
+    logging.info('All {} artifact(s) are downloaded, {} bytes in {:.1f} seconds.'.format(len(sizes), sum(sizes), time.time() - start_time))
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024*1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+# Returns the sha256 hex digest of the asset, or None if it's not known
+def asset_sha256(asset):
+    # GitHub reports a "sha256:<hex>" digest for assets, but older GitHub Enterprise and PyGithub versions don't have it
+    digest = getattr(asset, 'digest', None)
+    if digest and digest.startswith('sha256:'):
+        return digest[len('sha256:'):]
+    return None
+
+# Returns True if the asset is a fully uploaded copy of the other asset
+def _is_same_asset(asset, other_asset):
+    if asset.state != 'uploaded' or asset.size != other_asset.size:
+        return False
+    sha256 = asset_sha256(asset)
+    other_sha256 = asset_sha256(other_asset)
+    if sha256 and other_sha256:
+        return sha256 == other_sha256
+    return True
+
+# Returns True if the asset is a fully uploaded copy of the file
+def _is_same_artifact(asset, artifact_path):
+    if asset.state != 'uploaded' or asset.size != os.path.getsize(artifact_path):
+        return False
+    sha256 = asset_sha256(asset)
+    if sha256:
+        return sha256 == file_sha256(artifact_path)
+    return True
+
+# Deletes the assets of the release that don't match the artifacts and returns the artifacts that still need uploading
+def _resume_upload(src_dir, release, artifacts):
+    assets = {asset.name: asset for asset in release.get_assets()}
+    logging.info('Found {} artifact(s) already in the release.'.format(len(assets)))
+    artifacts_to_upload = []
     for artifact in artifacts:
-        logging.info('\tDownloading artifact "{}" ({} bytes).'.format(artifact.name, artifact.size))
-        download_artifact(github_token, artifact.url, dst_dir)
-    logging.info('All artifacts from "{}" release are downloaded.'.format(release.tag_name))
+        asset = assets.pop(artifact, None)
+        if asset and _is_same_artifact(asset, os.path.join(src_dir, artifact)):
+            logging.info('\tSkipping "{}" artifact as it\'s already stored in the release.'.format(artifact))
+            continue
+        if asset:
+            logging.info('\tDeleting "{}" artifact from the release as it differs from the one in "{}" directory.'.format(artifact, src_dir))
+            asset.delete_asset()
+        artifacts_to_upload.append(artifact)
+    for asset in assets.values():
+        logging.info('\tDeleting "{}" artifact from the release as it\'s not in "{}" directory.'.format(asset.name, src_dir))
+        asset.delete_asset()
+    return artifacts_to_upload
+
+# Returns the most recently created draft release out of the releases, or None if there are none
+def latest_draft_release(releases):
+    drafts = [r for r in releases if r.draft]
+    if not drafts:
+        return None
+    return max(drafts, key=lambda r: r.created_at)
+
+# Request body that streams `size` bytes out of a file object, so that only one chunk at a time is held in memory no
+# matter how large the artifact is. Having the length set makes requests send it as the Content-Length instead of using
+# the chunked transfer encoding, which GitHub doesn't accept for asset uploads.
+class _UploadBody:
+    _chunk_size = 1024*1024
 
-def upload_artifacts(src_dir, release):
+    def __init__(self, fileobj, size):
+        self._fileobj = fileobj
+        self._size = size
+        self._sent = False
+        # A retried request re-sends the body, for which a file gets rewound, while a stream can't be
+        self._start = fileobj.tell() if getattr(fileobj, 'seekable', None) and fileobj.seekable() else None
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        if self._sent:
+            if self._start is None:
+                raise exception.CIReleasePublisherError('Can\'t send the artifact again as it\'s being streamed.')
+            self._fileobj.seek(self._start)
+        self._sent = True
+        remaining = self._size
+        while remaining > 0:
+            chunk = self._fileobj.read(min(self._chunk_size, remaining))
+            if not chunk:
+                raise exception.CIReleasePublisherError('Got {} bytes less than expected when reading the artifact.'.format(remaining))
+            remaining -= len(chunk)
+            yield chunk
+
+def _upload_asset(github_token, release, name, size, fileobj, content_type=None):
+    # API doc: https://developer.github.com/v3/repos/releases/#upload-a-release-asset
+    upload_url = release.upload_url.split('{')[0]
+    headers = {
+        'Authorization': 'token {}'.format(github_token),
+        'Content-Type': content_type or mimetypes.guess_type(name)[0] or 'application/octet-stream',
+        'User-Agent': config.user_agent,
+    }
+    start = time.time()
+    # requests would send an empty iterable body using the chunked transfer encoding
+    data = _UploadBody(fileobj, size) if size else b''
+    r = requests_retry(upload_url).post(upload_url, headers=headers, params={'name': name}, data=data, timeout=config.timeout)
+    r.raise_for_status()
+    elapsed = max(time.time() - start, 0.001)
+    logging.info('\tUploaded "{}" artifact to "{}" release, {} bytes in {:.1f} seconds ({:.1f} MiB/s).'.format(name, release.tag_name, size, elapsed, size / elapsed / (1024*1024)))
+
+# Uploads the file as an asset named after the file. Unlike PyGithub's upload_asset(), the file is streamed in chunks
+# with a fixed memory use rather than having the memory use grow with the file size.
+def upload_artifact(github_token, release, path):
+    with open(path, 'rb') as f:
+        _upload_asset(github_token, release, os.path.basename(path), os.path.getsize(path), f)
+
+# Copies the asset into the release, streaming it from the download straight into the upload
+def _copy_asset(github_token, asset, release):
+    headers = {
+        'Authorization': 'token {}'.format(github_token),
+        'Accept': 'application/octet-stream',
+        'User-Agent': config.user_agent,
+    }
+    r = requests_retry(asset.url).get(asset.url, headers=headers, allow_redirects=True, stream=True, timeout=config.timeout)
+    r.raise_for_status()
+    _upload_asset(github_token, release, asset.name, asset.size, r.raw, asset.content_type)
+
+# Artifacts stored in releases, e.g. in the temporary store releases, that are published by copying them from release to
+# release instead of downloading them first. One of the releases can be taken over as the release to publish, in which
+# case its artifacts don't need copying at all.
+class ReleaseArtifacts:
+    def __init__(self, github_token, releases):
+        self.github_token = github_token
+        self.releases = releases
+        # Only the last release kind to use the artifacts can take over a release, as the release kinds using the
+        # artifacts before it need the release to stay around to copy from it, and might delete their draft release
+        self.adoptable = False
+        self._assets = None
+        self._adopted = None
+
+    # Returns a name -> (release, asset) dict of the artifacts
+    def assets(self):
+        if self._assets is None:
+            # This might look dumb but get_assets() returns a custom type that is a lazy list which doesn't support len()
+            releases_assets = parallel.run_until_error(lambda release: [asset for asset in release.get_assets()], self.releases, config.upload_concurrency)
+            manifests = parallel.run_until_error(lambda assets: _release_manifest(self.github_token, assets), releases_assets, config.upload_concurrency)
+            assets = _assets_by_name(self.releases, _resolve_manifests(self.releases, releases_assets, manifests))
+            bundles = [name for name in assets if bundle.is_bundle(name)]
+            if bundles:
+                raise exception.CIReleasePublisherError('Artifacts stored with --bundle can\'t be published with --from-store, collect them and publish them from a directory instead. '
+                                                        'Found "{}" bundle.'.format(bundles[0]))
+            self._assets = assets
+        return self._assets
+
+    # Turns the release holding the most of the artifact bytes into a draft release with the given information.
+    # Returns the release, or None if no release can be taken over.
+    def adopt(self, tag, name, message, prerelease, target_commitish):
+        if not self.adoptable or self._adopted:
+            return None
+        sizes = {}
+        for release, asset in self.assets().values():
+            # The bytes of an artifact stood in for by another asset are not in the release listing the artifact
+            if not isinstance(asset, _NamedAsset):
+                sizes[release.id] = sizes.get(release.id, 0) + asset.size
+        release = max(self.releases, key=lambda r: sizes.get(r.id, 0))
+        logging.info('Turning "{}" release into a draft release with the tag name "{}" instead of creating a new one, as it already contains {} bytes of the artifacts.'
+                     .format(release.tag_name, tag, sizes.get(release.id, 0)))
+        # PyGithub returns the updated release as a new object, leaving the old one as it was
+        release = release.update_release(name=name, message=message, draft=True, prerelease=prerelease, target_commitish=target_commitish, tag_name=tag)
+        self._adopted = release
+        return release
+
+# Creates a draft release to upload the artifacts to, taking over one of the releases the artifacts are stored in if possible
+def create_draft_release(repo, artifacts, tag, name, message, prerelease, target_commitish):
+    if isinstance(artifacts, ReleaseArtifacts):
+        release = artifacts.adopt(tag, name, message, prerelease, target_commitish)
+        if release:
+            return release
+    return repo.create_git_release(tag=tag, name=name, message=message, draft=True, prerelease=prerelease, target_commitish=target_commitish)
+
+def _copy_artifacts(artifacts, release, resume):
+    logging.info('Copying artifacts from {} release(s) to "{}" release.'.format(len(artifacts.releases), release.tag_name))
+    assets = artifacts.assets()
+    existing_assets = {}
+    if resume or release is artifacts._adopted:
+        existing_assets = {asset.name: asset for asset in release.get_assets()}
+    # The assets of the release that other artifacts with the same content get copied from are deleted only once the
+    # copying is done
+    sources = {asset.url for src_release, asset in assets.values() if isinstance(asset, _NamedAsset)}
+    deferred = []
+    assets_to_copy = []
+    for name, (src_release, asset) in sorted(assets.items()):
+        existing_asset = existing_assets.pop(name, None)
+        # Already in place, unless it's stood in for by an asset of another artifact
+        if src_release.id == release.id and not isinstance(asset, _NamedAsset):
+            continue
+        if existing_asset and _is_same_asset(existing_asset, asset):
+            logging.info('\tSkipping "{}" artifact as it\'s already stored in the release.'.format(name))
+            continue
+        if existing_asset and existing_asset.url in sources:
+            deferred.append(existing_asset)
+        elif existing_asset:
+            logging.info('\tDeleting "{}" artifact from the release as it differs from the one in "{}" release.'.format(name, src_release.tag_name))
+            existing_asset.delete_asset()
+        assets_to_copy.append((src_release, asset))
+    for asset in existing_assets.values():
+        logging.info('\tDeleting "{}" artifact from the release as it\'s not among the artifacts.'.format(asset.name))
+        asset.delete_asset()
+    def copy(src_release_asset):
+        src_release, asset = src_release_asset
+        logging.info('\tCopying "{}" ({} bytes) artifact from "{}" release.'.format(asset.name, asset.size, src_release.tag_name))
+        _copy_asset(artifacts.github_token, asset, release)
+    deferred_names = {asset.name for asset in deferred}
+    failures = parallel.run_all(copy, [a for a in assets_to_copy if a[1].name not in deferred_names], config.upload_concurrency)
+    if deferred and not failures:
+        for asset in deferred:
+            logging.info('\tDeleting "{}" artifact from the release as it differs from the one being copied into the release.'.format(asset.name))
+            asset.delete_asset()
+        failures = parallel.run_all(copy, [a for a in assets_to_copy if a[1].name in deferred_names], config.upload_concurrency)
+    if failures:
+        for (src_release, asset), e in failures:
+            logging.error('\tFailed to copy "{}" artifact into the release. {}: {}'.format(asset.name, type(e).__name__, e))
+        raise exception.CIReleasePublisherError('Failed to copy {} out of {} artifact(s) to "{}" release.'.format(len(failures), len(assets_to_copy), release.tag_name))
+    logging.info('All artifacts for "{}" release are copied.'.format(release.tag_name))
+
+# File-like object reading the chunks put into a queue, with None put into the queue signaling a read error
+class _QueueReader:
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._buffer = b''
+
+    def read(self, size):
+        if not self._buffer:
+            chunk = self._chunks.get()
+            if chunk is None:
+                raise exception.CIReleasePublisherError('Failed to read the artifact.')
+            self._buffer = chunk
+        chunk, self._buffer = self._buffer[:size], self._buffer[size:]
+        return chunk
+
+# Artifacts from a directory that are uploaded to several releases at once. Each artifact file is read only once, with
+# the read chunks streamed into the uploads to all of the releases in parallel, instead of every release reading and
+# uploading all of the files on its own one after another.
+#
+# Meant to be shared by `participants` release kinds, each getting its own participant() handle to pass to
+# upload_artifacts() in place of the directory, and calling leave() on the handle once it's done, no matter if it has
+# uploaded anything or not. The uploads start once all of the participants have either started uploading or left.
+class SharedArtifacts:
+    # Number of chunks an upload can fall behind the fastest upload of the same artifact before holding up the reading
+    _queue_size = 8
+    _chunk_size = 1024*1024
+
+    def __init__(self, github_token, src_dir, participants):
+        self.github_token = github_token
+        self.src_dir = src_dir
+        self._cond = threading.Condition()
+        self._pending = participants
+        self._targets = []
+        self._started = False
+        self._failures = None
+
+    def participant(self):
+        return _SharedArtifactsParticipant(self)
+
+    def _leave(self, participant):
+        with self._cond:
+            if not participant.joined and not participant.left:
+                participant.left = True
+                self._pending -= 1
+                self._cond.notify_all()
+
+    def _upload(self, participant, release, artifacts):
+        with self._cond:
+            if participant.joined or participant.left:
+                raise exception.CIReleasePublisherError('A participant can upload the shared artifacts only once.')
+            participant.joined = True
+            self._targets.append((release, set(artifacts)))
+            self._pending -= 1
+            self._cond.notify_all()
+            while self._pending > 0:
+                self._cond.wait()
+            # The first participant to get here does the uploading for all of them
+            leader = not self._started
+            self._started = True
+        if leader:
+            # Report everything as failed if the uploading gets aborted, the other participants must not wait forever
+            failures = [(r, artifact, exception.CIReleasePublisherError('Uploading got aborted.')) for r, r_artifacts in self._targets for artifact in r_artifacts]
+            try:
+                failures = self._upload_all()
+            except Exception as e:
+                failures = [(r, artifact, e) for r, r_artifacts in self._targets for artifact in r_artifacts]
+            finally:
+                with self._cond:
+                    self._failures = failures
+                    self._cond.notify_all()
+        with self._cond:
+            while self._failures is None:
+                self._cond.wait()
+            return [(artifact, e) for r, artifact, e in self._failures if r is release]
+
+    def _upload_all(self):
+        artifacts = sorted(set.union(*[artifacts for release, artifacts in self._targets]))
+        logging.info('Uploading {} artifact(s) to {} release(s) at once: {}.'.format(len(artifacts), len(self._targets), ', '.join('"{}"'.format(r.tag_name) for r, a in self._targets)))
+        failures = []
+        def releases_of(artifact):
+            return [release for release, release_artifacts in self._targets if artifact in release_artifacts]
+        def upload(artifact):
+            for release, e in self._fan_out(artifact, releases_of(artifact)):
+                logging.warning('\tFailed to store "{}" artifact in "{}" release along with the other releases, uploading it on its own. {}: {}'.format(artifact, release.tag_name, type(e).__name__, e))
+                try:
+                    self._upload_alone(artifact, release)
+                except Exception as e:
+                    failures.append((release, artifact, e))
+        for artifact, e in parallel.run_all(upload, artifacts, config.upload_concurrency):
+            # Reading the artifact has failed, which fails all of its uploads
+            failures.extend([(release, artifact, e) for release in releases_of(artifact)])
+        return failures
+
+    # Reads the artifact once while streaming it into the uploads to all of the releases.
+    # Returns a list of (release, exception) tuples for the uploads that have failed.
+    def _fan_out(self, artifact, releases):
+        artifact_path = os.path.join(self.src_dir, artifact)
+        size = os.path.getsize(artifact_path)
+        logging.info('\tStoring "{}" ({} bytes) artifact in {} release(s).'.format(artifact, size, len(releases)))
+        queues = [queue.Queue(self._queue_size) for _ in releases]
+        failed = [False] * len(releases)
+        def upload(i):
+            try:
+                _upload_asset(self.github_token, releases[i], artifact, size, _QueueReader(queues[i]))
+            except Exception:
+                failed[i] = True
+                raise
+        def put(i, chunk):
+            # Don't wait on a queue nobody is reading from anymore
+            while not failed[i]:
+                try:
+                    queues[i].put(chunk, timeout=1)
+                    return
+                except queue.Full:
+                    pass
+        with ThreadPoolExecutor(max_workers=len(releases)) as executor:
+            futures = [executor.submit(upload, i) for i in range(len(releases))]
+            try:
+                with open(artifact_path, 'rb') as f:
+                    remaining = size
+                    while remaining > 0:
+                        chunk = f.read(min(self._chunk_size, remaining))
+                        if not chunk:
+                            raise exception.CIReleasePublisherError('"{}" artifact got truncated while uploading it.'.format(artifact))
+                        remaining -= len(chunk)
+                        for i in range(len(releases)):
+                            put(i, chunk)
+            except Exception:
+                for i in range(len(releases)):
+                    put(i, None)
+                raise
+            return [(releases[i], future.exception()) for i, future in enumerate(futures) if future.exception()]
+
+    def _upload_alone(self, artifact, release):
+        # A failed upload might leave a partially uploaded asset behind, which would prevent uploading the same named asset
+        for asset in release.get_assets():
+            if asset.name == artifact:
+                asset.delete_asset()
+        upload_artifact(self.github_token, release, os.path.join(self.src_dir, artifact))
+
+class _SharedArtifactsParticipant:
+    def __init__(self, shared):
+        self.shared = shared
+        self.src_dir = shared.src_dir
+        self.joined = False
+        self.left = False
+
+    def leave(self):
+        self.shared._leave(self)
+
+# Uploads the artifacts from a directory, or copies them if they are ReleaseArtifacts.
+# When resume is set, the artifacts already uploaded to the release are not uploaded again. `only` limits the artifacts
+# uploaded from a directory to the given names.
+def upload_artifacts(github_token, src_dir, release, resume=False, only=None):
+    if isinstance(src_dir, ReleaseArtifacts):
+        return _copy_artifacts(src_dir, release, resume)
+    participant = None
+    if isinstance(src_dir, _SharedArtifactsParticipant):
+        participant = src_dir
+        src_dir = participant.src_dir
     logging.info('Uploading artifacts to "{}" release.'.format(release.tag_name))
     artifacts = sorted(os.listdir(src_dir))
     logging.info('Found {} artifact(s) in "{}" directory.'.format(len(artifacts), src_dir))
-    for artifact in artifacts:
-        artifact_path = os.path.join(src_dir, artifact)
-        if os.path.isfile(artifact_path):
+    artifacts = [artifact for artifact in artifacts if os.path.isfile(os.path.join(src_dir, artifact))]
+    if only is not None:
+        artifacts = [artifact for artifact in artifacts if artifact in only]
+    if resume:
+        artifacts = _resume_upload(src_dir, release, artifacts)
+    if participant:
+        failures = participant.shared._upload(participant, release, artifacts)
+    else:
+        def upload(artifact):
+            artifact_path = os.path.join(src_dir, artifact)
             logging.info('\tStoring "{}" ({} bytes) artifact in the release.'.format(artifact, os.path.getsize(artifact_path)))
-            release.upload_asset(artifact_path)
+            upload_artifact(github_token, release, artifact_path)
+        failures = parallel.run_all(upload, artifacts, config.upload_concurrency)
+    if failures:
+        for artifact, e in failures:
+            logging.error('\tFailed to store "{}" artifact in the release. {}: {}'.format(artifact, type(e).__name__, e))
+        raise exception.CIReleasePublisherError('Failed to upload {} out of {} artifact(s) to "{}" release.'.format(len(failures), len(artifacts), release.tag_name))
     logging.info('All artifacts for "{}" release are uploaded.'.format(release.tag_name))
 
-def delete_release_with_tag(release, github_token, github_api_url, travis_repo_slug):
+# Uploads the artifacts from a directory as a single bundle asset named `name`. When resume is set, a bundle already
+# uploaded to the release is not uploaded again.
+def upload_bundle(github_token, src_dir, release, name, resume=False):
+    logging.info('Uploading artifacts to "{}" release as "{}" bundle.'.format(release.tag_name, name))
+    artifacts = sorted(artifact for artifact in os.listdir(src_dir) if os.path.isfile(os.path.join(src_dir, artifact)))
+    logging.info('Found {} artifact(s) in "{}" directory.'.format(len(artifacts), src_dir))
+    reader = bundle.Reader(src_dir, artifacts)
+    if resume:
+        stored = False
+        for asset in release.get_assets():
+            if not stored and asset.name == name and asset.state == 'uploaded' and asset.size == reader.size and asset_sha256(asset) in [None, reader.sha256()]:
+                stored = True
+                continue
+            logging.info('\tDeleting "{}" artifact from the release as it\'s not the bundle of "{}" directory.'.format(asset.name, src_dir))
+            asset.delete_asset()
+        if stored:
+            logging.info('\tSkipping "{}" bundle as it\'s already stored in the release.'.format(name))
+            return
+    logging.info('\tStoring {} artifact(s) in "{}" bundle ({} bytes).'.format(len(artifacts), name, reader.size))
+    _upload_asset(github_token, release, name, reader.size, reader, 'application/x-tar')
+    logging.info('All artifacts for "{}" release are uploaded.'.format(release.tag_name))
+
+# Uploads only the artifacts from a directory with content that isn't stored in any of `other_releases` yet, along
+# with a manifest named `name` mapping all of the artifacts to their content. When resume is set, the artifacts already
+# uploaded to the release are not uploaded again.
+def upload_deduplicated(github_token, src_dir, release, other_releases, name, resume=False):
+    artifacts = sorted(artifact for artifact in os.listdir(src_dir) if os.path.isfile(os.path.join(src_dir, artifact)))
+    hashes = {artifact: file_sha256(os.path.join(src_dir, artifact)) for artifact in artifacts}
+    releases_assets = parallel.run_until_error(lambda release: [asset for asset in release.get_assets()], other_releases, config.upload_concurrency)
+    manifests = parallel.run_until_error(lambda assets: _release_manifest(github_token, assets), releases_assets, config.upload_concurrency)
+    stored = {sha256: asset.name for sha256, asset in _stored_content(releases_assets, manifests).items()}
+    artifacts_to_upload = set()
+    for artifact in artifacts:
+        if hashes[artifact] in stored:
+            logging.info('\tNot storing "{}" artifact as its content is already stored as "{}" artifact.'.format(artifact, stored[hashes[artifact]]))
+            continue
+        # Of the artifacts with the same content only the first one gets stored
+        stored[hashes[artifact]] = artifact
+        artifacts_to_upload.add(artifact)
+    logging.info('Storing {} out of {} artifact(s), the rest have the same content as the stored ones.'.format(len(artifacts_to_upload), len(artifacts)))
+    upload_artifacts(github_token, src_dir, release, resume=resume, only=artifacts_to_upload)
+    _upload_manifest(github_token, release, name, hashes)
+
+def _upload_manifest(github_token, release, name, hashes):
+    data = manifest.dumps(hashes)
+    _upload_asset(github_token, release, name, len(data), io.BytesIO(data), 'application/json')
+
+# Returns the name -> sha256 dict of the artifacts in a directory
+def artifact_hashes(src_dir):
+    artifacts = sorted(artifact for artifact in os.listdir(src_dir) if os.path.isfile(os.path.join(src_dir, artifact)))
+    return {artifact: file_sha256(os.path.join(src_dir, artifact)) for artifact in artifacts}
+
+# Uploads the manifest named `name` of the artifacts from a directory, so that a later ReleaseUpdate of the release can
+# tell which artifacts have changed
+def upload_manifest(github_token, src_dir, release, name):
+    _upload_manifest(github_token, release, name, artifact_hashes(src_dir))
+
+# Returns the directory of the artifacts passed in place of it to upload_artifacts(), or None if they are
+# ReleaseArtifacts. A SharedArtifacts participant leaves the shared upload, so that it doesn't hold up the other
+# participants, as the artifacts get uploaded some other way.
+def artifacts_dir(artifacts):
+    if isinstance(artifacts, ReleaseArtifacts):
+        return None
+    if isinstance(artifacts, _SharedArtifactsParticipant):
+        artifacts.leave()
+        return artifacts.src_dir
+    return artifacts
+
+# Temporary name of a changed artifact uploaded by a build next to the asset it's going to replace. It includes the build
+# number, so that builds updating the release at the same time don't touch each other's uploads.
+def _tmp_asset_name(name, build_number):
+    return '{}cirp-{}-{}'.format(config.tag_prefix_tmp, build_number, name)
+
+# Returns the number of the build that has uploaded the asset under a temporary name, or None if it's not such an asset
+def tmp_asset_build_number(name):
+    m = re.match(r'^{}cirp-(?P<build_number>\d+)-'.format(re.escape(config.tag_prefix_tmp)), name)
+    return m.group('build_number') if m else None
+
+# In-place update of a release that is re-used by every build, e.g. the latest release, with the artifacts from a
+# directory. Only the artifacts that differ from the assets of the release are uploaded, going by their size and by the
+# sha256 recorded in the manifest asset named `manifest_name`, or reported by GitHub for a release without a manifest.
+# The assets without an artifact are deleted, except for the temporary assets of the other builds.
+#
+# The changed artifacts are uploaded under temporary names, so that the release keeps serving the previous artifacts
+# until apply() swaps the uploaded ones in, or discard() deletes them. GitHub can't replace assets all at once, so while
+# apply() runs, and if it fails part way, the release has a mix of the previous and the new artifacts. The manifest is
+# deleted first and uploaded last, so the next update goes by the content of the assets and fixes the mix up.
+class ReleaseUpdate:
+    def __init__(self, github_token, src_dir, release, manifest_name, build_number):
+        self.github_token = github_token
+        self.src_dir = src_dir
+        self.release = release
+        self.manifest_name = manifest_name
+        self.build_number = build_number
+        self.hashes = None
+        self.changed = None
+        self.removed = None
+        self._assets = None
+        self._manifest_asset = None
+
+    # Compares the artifacts with the assets of the release
+    def diff(self):
+        logging.info('Comparing the artifacts in "{}" directory with the ones in "{}" release.'.format(self.src_dir, self.release.tag_name))
+        self.hashes = artifact_hashes(self.src_dir)
+        logging.info('Found {} artifact(s) in "{}" directory.'.format(len(self.hashes), self.src_dir))
+        self._assets = {}
+        for asset in self.release.get_assets():
+            build_number = tmp_asset_build_number(asset.name)
+            if build_number is not None and build_number != str(self.build_number):
+                logging.info('\tIgnoring "{}" artifact uploaded by build #{}.'.format(asset.name, build_number))
+                continue
+            self._assets[asset.name] = asset
+        self._manifest_asset = self._assets.pop(self.manifest_name, None)
+        recorded = _release_manifest(self.github_token, [self._manifest_asset]) if self._manifest_asset else {}
+        self.changed = []
+        for artifact, sha256 in sorted(self.hashes.items()):
+            asset = self._assets.get(artifact)
+            if asset and asset.state == 'uploaded' and asset.size == os.path.getsize(os.path.join(self.src_dir, artifact)) and \
+                    (recorded.get(artifact) or asset_sha256(asset)) == sha256:
+                logging.info('\tKeeping "{}" artifact as it\'s the same as the one in the release.'.format(artifact))
+                continue
+            self.changed.append(artifact)
+        # Along with the assets left over by an earlier run of this build that didn't finish
+        self.removed = sorted(name for name in self._assets if name not in self.hashes)
+        logging.info('{} out of {} artifact(s) have changed, {} artifact(s) are to be deleted from the release.'.format(len(self.changed), len(self.hashes), len(self.removed)))
+
+    def _tmp_name(self, name):
+        return _tmp_asset_name(name, self.build_number)
+
+    def _tmp_names(self):
+        return [self._tmp_name(name) for name in self.changed + [self.manifest_name]]
+
+    # Uploads the changed artifacts and the new manifest under temporary names
+    def upload(self):
+        tmp_names = self._tmp_names()
+        for name in [name for name in self.removed if name in tmp_names]:
+            logging.info('\tDeleting "{}" artifact left over by an earlier update of the release.'.format(name))
+            self._assets.pop(name).delete_asset()
+            self.removed.remove(name)
+        def upload(artifact):
+            artifact_path = os.path.join(self.src_dir, artifact)
+            logging.info('\tStoring "{}" ({} bytes) artifact in the release as "{}".'.format(artifact, os.path.getsize(artifact_path), self._tmp_name(artifact)))
+            with open(artifact_path, 'rb') as f:
+                _upload_asset(self.github_token, self.release, self._tmp_name(artifact), os.path.getsize(artifact_path), f)
+        failures = parallel.run_all(upload, self.changed, config.upload_concurrency)
+        if failures:
+            for artifact, e in failures:
+                logging.error('\tFailed to store "{}" artifact in the release. {}: {}'.format(artifact, type(e).__name__, e))
+            raise exception.CIReleasePublisherError('Failed to upload {} out of {} artifact(s) to "{}" release.'.format(len(failures), len(self.changed), self.release.tag_name))
+        _upload_manifest(self.github_token, self.release, self._tmp_name(self.manifest_name), self.hashes)
+
+    # Deletes the uploaded artifacts, leaving the release as it was
+    def discard(self):
+        tmp_names = self._tmp_names()
+        for asset in self.release.get_assets():
+            if asset.name in tmp_names:
+                logging.info('\tDeleting "{}" artifact from the release.'.format(asset.name))
+                asset.delete_asset()
+
+    # Replaces the changed assets with the uploaded artifacts and deletes the assets without an artifact. Goes through
+    # all of them even if some fail, so that as little as possible of the release is left mixed.
+    def apply(self):
+        logging.info('Replacing {} artifact(s) of "{}" release.'.format(len(self.changed), self.release.tag_name))
+        uploaded = {asset.name: asset for asset in self.release.get_assets() if asset.name in self._tmp_names()}
+        def rename(name):
+            asset = uploaded.get(self._tmp_name(name))
+            if not asset:
+                raise exception.CIReleasePublisherError('Couldn\'t find the uploaded "{}" artifact in "{}" release.'.format(self._tmp_name(name), self.release.tag_name))
+            asset.update_asset(name)
+        if self._manifest_asset:
+            self._manifest_asset.delete_asset()
+        def replace(artifact):
+            if artifact in self._assets:
+                self._assets[artifact].delete_asset()
+            rename(artifact)
+            logging.info('\tReplaced "{}" artifact.'.format(artifact))
+        failures = parallel.run_all(replace, self.changed, config.upload_concurrency)
+        def delete(name):
+            logging.info('\tDeleting "{}" artifact from the release as it\'s not in "{}" directory.'.format(name, self.src_dir))
+            self._assets[name].delete_asset()
+        failures += parallel.run_all(delete, self.removed, config.delete_concurrency)
+        if failures:
+            for name, e in failures:
+                logging.error('\tFailed to replace or delete "{}" artifact of the release. {}: {}'.format(name, type(e).__name__, e))
+            raise exception.CIReleasePublisherError('Failed to replace or delete {} artifact(s) of "{}" release, which is left with a mix of the artifacts of this and '
+                                                    'the previous build until the next update.'.format(len(failures), self.release.tag_name))
+        rename(self.manifest_name)
+
+def _delete_release(release):
     logging.info('Deleting a release with the tag name "{}".'.format(release.tag_name))
     release.delete_release()
-    # Published releases create tags and we don't want to keep the tags
-    if not release.draft:
-        logging.info('Deleting "{}" tag.'.format(release.tag_name))
-        github(github_token, github_api_url).get_repo(travis_repo_slug).get_git_ref('tags/{}'.format(release.tag_name)).delete()
+
+def _delete_tag(release, github_token, github_api_url, travis_repo_slug):
+    logging.info('Deleting "{}" tag.'.format(release.tag_name))
+    repo(github_token, github_api_url, travis_repo_slug).get_git_ref('tags/{}'.format(release.tag_name)).delete()
+
+# Moves the tag of the release to the commit
+def move_tag(release, sha, github_token, github_api_url, travis_repo_slug):
+    logging.info('Moving "{}" tag to {} commit.'.format(release.tag_name, sha))
+    repo(github_token, github_api_url, travis_repo_slug).get_git_ref('tags/{}'.format(release.tag_name)).edit(sha, force=True)
+
+async def _delete_release_async(client, release, github_token):
+    logging.info('Deleting a release with the tag name "{}".'.format(release.tag_name))
+    (await client.request('DELETE', release.url, headers=_api_headers(github_token))).raise_for_status()
+
+async def _delete_tag_async(client, release, github_token, github_api_url, travis_repo_slug):
+    logging.info('Deleting "{}" tag.'.format(release.tag_name))
+    # API doc: https://docs.github.com/en/rest/git/refs#delete-a-reference
+    url = '{}/repos/{}/git/refs/tags/{}'.format(github_api_url.rstrip('/'), travis_repo_slug, requests.utils.quote(release.tag_name, safe=''))
+    (await client.request('DELETE', url, headers=_api_headers(github_token))).raise_for_status()
+
+# Adds the steps deleting the releases with their tags to the plan, running once the `after` steps are done. A failed
+# deletion fails the plan only if `fatal` is set. Returns a list of (release deletion step, tag deletion step or None).
+def plan_delete_releases_with_tags(plan, releases, github_token, github_api_url, travis_repo_slug, after=None, fatal=False):
+    steps = []
+    for release in releases:
+        release_step = plan.add('Delete "{}" release'.format(release.tag_name), lambda release=release: _delete_release(release), after, 'delete', fatal,
+                                lambda client, release=release: _delete_release_async(client, release, github_token))
+        tag_step = None
+        # Published releases create tags and we don't want to keep the tags. A release and its tag are deleted one
+        # after another, rather than at the same time, so that we don't end up with the tag being deleted but the
+        # release being left, as GitHub turns such releases into drafts.
+        if not release.draft:
+            tag_step = plan.add('Delete "{}" tag'.format(release.tag_name), lambda release=release: _delete_tag(release, github_token, github_api_url, travis_repo_slug),
+                                [release_step], 'delete', fatal,
+                                lambda client, release=release: _delete_tag_async(client, release, github_token, github_api_url, travis_repo_slug))
+        steps.append((release_step, tag_step))
+    return steps
+
+def delete_release_with_tag(release, github_token, github_api_url, travis_repo_slug):
+    p = plan.Plan()
+    plan_delete_releases_with_tags(p, [release], github_token, github_api_url, travis_repo_slug, fatal=True)
+    p.run()
+
+# Deletes releases with their tags, running up to config.delete_concurrency deletions at once.
+# A failed deletion is logged as a warning and doesn't stop the rest of the deletions.
+def delete_releases_with_tags(releases, github_token, github_api_url, travis_repo_slug):
+    if not releases:
+        return
+    p = plan.Plan()
+    steps = plan_delete_releases_with_tags(p, releases, github_token, github_api_url, travis_repo_slug)
+    p.run()
+    if config.dry_run:
+        return
+    logging.info('Deleted {} out of {} release(s) and {} tag(s).'.format(len([r for r, t in steps if r.state == 'done']), len(releases),
+                                                                         len([t for r, t in steps if t and t.state == 'done'])))
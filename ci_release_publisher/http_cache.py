@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+from urllib.parse import urlsplit
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+
+from . import config
+
+# Persistent HTTP cache for the GitHub release listing pages, which every command fetches in full. Each page is stored
+# with its ETag and is requested again with If-None-Match, so an unchanged page comes back as an empty 304 response,
+# which GitHub doesn't count against the rate limit. Entries are written atomically, so several jobs running on the
+# same machine can share the cache directory. Enabled by setting config.http_cache_dir.
+
+_cacheable_path_re = re.compile(r'^.*/repos/[^/]+/[^/]+/releases$')
+
+# Headers to restore when serving a page from the cache, Link being needed for the pagination
+_cached_headers = ['Content-Type', 'ETag', 'Link']
+
+def _cacheable(request):
+    return config.http_cache_dir and request.method == 'GET' and _cacheable_path_re.match(urlsplit(request.url).path)
+
+def _path(request):
+    # Different tokens can see different releases, e.g. drafts are visible only with push access
+    key = '{}\n{}'.format(request.url, request.headers.get('Authorization', ''))
+    return os.path.join(config.http_cache_dir, '{}.json'.format(hashlib.sha256(key.encode('utf-8')).hexdigest()))
+
+# Adds If-None-Match to the request if the response to it is cached. Returns the cache entry, or None.
+def prepare(request):
+    if not _cacheable(request):
+        return None
+    path = _path(request)
+    try:
+        with open(path, 'r') as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if entry.get('url') != request.url:
+        return None
+    request.headers['If-None-Match'] = entry['headers']['ETag']
+    return entry
+
+# Turns a 304 response into the cached response and caches a new response. Returns the response to use.
+def process(request, response, entry):
+    if not _cacheable(request):
+        return response
+    if response.status_code == 304 and entry:
+        response.status_code = 200
+        response.reason = 'OK'
+        response.headers.update(entry['headers'])
+        response._content = entry['body'].encode('utf-8')
+        response.encoding = 'utf-8'
+        try:
+            # Mark as recently used for the eviction
+            os.utime(_path(request))
+        except OSError:
+            pass
+        return response
+    if response.status_code == 200 and 'ETag' in response.headers:
+        headers = {name: response.headers[name] for name in _cached_headers if name in response.headers}
+        _write(_path(request), {'url': request.url, 'headers': headers, 'body': response.text})
+    return response
+
+def _write(path, entry):
+    try:
+        os.makedirs(config.http_cache_dir, exist_ok=True)
+        # Write atomically, so that a concurrent reader never sees a partially written entry
+        fd, tmp_path = tempfile.mkstemp(dir=config.http_cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        _evict()
+    except OSError as e:
+        logging.warning('Failed to write into the HTTP cache. {}: {}'.format(type(e).__name__, e))
+
+# Removes the least recently used entries until the cache fits into config.http_cache_max_size
+def _evict():
+    entries = []
+    for name in os.listdir(config.http_cache_dir):
+        if not name.endswith('.json'):
+            continue
+        try:
+            stat = os.stat(os.path.join(config.http_cache_dir, name))
+        except OSError:
+            # Removed by a concurrent job
+            continue
+        entries.append((stat.st_mtime, stat.st_size, name))
+    size = sum(entry_size for _, entry_size, _ in entries)
+    for _, entry_size, name in sorted(entries):
+        if size <= config.http_cache_max_size:
+            break
+        try:
+            os.remove(os.path.join(config.http_cache_dir, name))
+        except OSError:
+            pass
+        size -= entry_size
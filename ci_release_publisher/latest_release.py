@@ -8,9 +8,13 @@ from . import config
 from . import enum
 from . import env
 from . import github
+from . import manifest
+from . import plan
+from . import release_index
 from . import travis
 
 _tag_suffix = 'latest'
+_tag_name_re = re.compile(r'^-(?P<branch>.*)-$')
 
 def _tag_name(travis_branch):
     return '{}-{}-{}'.format(config.tag_prefix, travis_branch, _tag_suffix)
@@ -19,7 +23,7 @@ def _break_tag_name(tag_name):
     if not tag_name.startswith(config.tag_prefix) or not tag_name.endswith(_tag_suffix):
         return None
     tag_name = tag_name[len(config.tag_prefix):-len(_tag_suffix)]
-    m = re.match('^-(?P<branch>.*)-$', tag_name)
+    m = _tag_name_re.match(tag_name)
     if not m:
         return None
     return {'matched': True, 'branch': m.group('branch')}
@@ -44,17 +48,21 @@ def publish_args(parser):
                         help='Commit the release should point to. By default it\'s set to $TRAVIS_COMMIT when publishing to the same repo and not set when publishing to a different repo.')
     parser.add_argument('--latest-release-check-event-type', default=['any'], nargs='+', type=str, choices=enum.enum_to_arg_choices(travis.Travis.EventType),
                         help='Consider only builds of specific event types when checking if the current build is the latest. If not specified, "any" is used.')
+    parser.add_argument('--latest-release-incremental', default=False, action='store_true',
+                        help='Update the existing latest release in place instead of re-creating it: upload only the artifacts that differ from the ones in the release, '
+                             'delete the ones that are gone and move the tag to the new commit. The sha256 digests of the artifacts are recorded in a "{}-<branch>-{}{}" '
+                             'asset of the release to tell which artifacts have changed.'.format(config.tag_prefix, _tag_suffix, manifest.suffix))
 
 def publish_validate_args(args):
     return args.latest_release
 
-def publish_with_args(args, releases, artifact_dir, github_api_url, travis_api_url):
+def publish_with_args(args, index, artifacts, github_api_url, travis_api_url):
     if not args.latest_release:
         return
-    publish(releases, artifact_dir, args.latest_release_name, args.latest_release_body, args.latest_release_draft, args.latest_release_prerelease, args.latest_release_target_commitish,
-            enum.arg_choices_to_enum(travis.Travis.EventType, args.latest_release_check_event_type), github_api_url, travis_api_url)
+    publish(index, artifacts, args.latest_release_name, args.latest_release_body, args.latest_release_draft, args.latest_release_prerelease, args.latest_release_target_commitish,
+            enum.arg_choices_to_enum(travis.Travis.EventType, args.latest_release_check_event_type), args.latest_release_incremental, github_api_url, travis_api_url)
 
-def publish(releases, artifact_dir, latest_release_name, latest_release_body, latest_release_draft, latest_release_prerelease, latest_release_target_commitish, latest_release_check_event_type, github_api_url, travis_api_url):
+def publish(index, artifacts, latest_release_name, latest_release_body, latest_release_draft, latest_release_prerelease, latest_release_target_commitish, latest_release_check_event_type, latest_release_incremental, github_api_url, travis_api_url):
     github_token         = env.required('CIRP_GITHUB_ACCESS_TOKEN') if env.optional('CIRP_GITHUB_ACCESS_TOKEN') else env.required('GITHUB_ACCESS_TOKEN')
     github_repo_slug     = env.required('CIRP_GITHUB_REPO_SLUG') if env.optional('CIRP_GITHUB_REPO_SLUG') else env.required('TRAVIS_REPO_SLUG')
     travis_repo_slug     = env.required('TRAVIS_REPO_SLUG')
@@ -79,29 +87,85 @@ def publish(releases, artifact_dir, latest_release_name, latest_release_body, la
 
     if not _is_latest_build_for_branch():
         return
+    release_name = latest_release_name if latest_release_name else 'Latest CI build of {} branch'.format(travis_branch)
+    release_body = latest_release_body if latest_release_body else 'This is an auto-generated release based on [Travis-CI build #{}]({})'.format(travis_build_id, travis_build_web_url)
+    target_commitish = latest_release_target_commitish if latest_release_target_commitish else travis_commit if not env.optional('CIRP_GITHUB_REPO_SLUG') else GithubObject.NotSet
+    manifest_name = '{}{}'.format(tag_name, manifest.suffix)
+    previous_release = index.by_tag(tag_name, draft=latest_release_draft)
+    if latest_release_incremental and previous_release:
+        src_dir = github.artifacts_dir(artifacts)
+        if src_dir:
+            _update(previous_release[0], src_dir, manifest_name, release_name, release_body, latest_release_draft, latest_release_prerelease, target_commitish,
+                    travis_branch, travis_build_number, _is_latest_build_for_branch, github_token, github_api_url, github_repo_slug)
+            return
+        logging.info('Re-creating "{}" release instead of updating it in place, as the artifacts are published from the temporary store releases.'.format(tag_name))
     tag_name_tmp = _tag_name_tmp(travis_branch)
-    logging.info('Creating a draft release with the tag name "{}".'.format(tag_name_tmp))
-    release = github.github(github_token, github_api_url).get_repo(github_repo_slug).create_git_release(
-        tag=tag_name_tmp,
-        name=latest_release_name if latest_release_name else
-             'Latest CI build of {} branch'.format(travis_branch),
-        message=latest_release_body if latest_release_body else
-                'This is an auto-generated release based on [Travis-CI build #{}]({})'
-                .format(travis_build_id, travis_build_web_url),
-        draft=True,
-        prerelease=latest_release_prerelease,
-        target_commitish=latest_release_target_commitish if latest_release_target_commitish else travis_commit if not env.optional('CIRP_GITHUB_REPO_SLUG') else GithubObject.NotSet)
-    github.upload_artifacts(artifact_dir, release)
-    if not _is_latest_build_for_branch():
-        github.delete_release_with_tag(release, github_token, github_api_url, github_repo_slug)
-        return
-    previous_release = [r for r in releases if r.tag_name == tag_name]
+    p = plan.Plan()
+
+    def create_release():
+        logging.info('Creating a draft release with the tag name "{}".'.format(tag_name_tmp))
+        return github.create_draft_release(github.repo(github_token, github_api_url, github_repo_slug), artifacts,
+            tag=tag_name_tmp, name=release_name, message=release_body, prerelease=latest_release_prerelease, target_commitish=target_commitish)
+    create = p.add('Create "{}" draft release'.format(tag_name_tmp), create_release)
+
+    def upload_artifacts():
+        github.upload_artifacts(github_token, artifacts, create.result)
+        # Lets the next build update the release in place
+        if latest_release_incremental and github.artifacts_dir(artifacts):
+            github.upload_manifest(github_token, github.artifacts_dir(artifacts), create.result, manifest_name)
+    upload = p.add('Upload the artifacts to "{}" release'.format(tag_name_tmp), upload_artifacts, [create])
+
+    # A newer build might have started while we were uploading
+    def check_latest():
+        if not _is_latest_build_for_branch():
+            github.delete_release_with_tag(create.result, github_token, github_api_url, github_repo_slug)
+            raise plan.Cancel()
+    check = p.add('Check that this is still the latest build for "{}" branch'.format(travis_branch), check_latest, [upload])
+    after = [check]
     if previous_release:
-        github.delete_release_with_tag(previous_release[0], github_token, github_api_url, github_repo_slug)
-    logging.info('Changing the tag name from "{}" to "{}"{}.'.format(tag_name_tmp, tag_name, '' if latest_release_draft else ' and removing the draft flag'))
-    release.update_release(name=release.title, message=release.body, prerelease=release.prerelease, target_commitish=release.target_commitish, draft=latest_release_draft, tag_name=tag_name)
-
-def cleanup(releases, branch_unfinished_build_numbers, github_api_url):
+        after = [t or r for r, t in github.plan_delete_releases_with_tags(p, previous_release[:1], github_token, github_api_url, github_repo_slug, after, fatal=True)]
+
+    def rename():
+        release = create.result
+        logging.info('Changing the tag name from "{}" to "{}"{}.'.format(tag_name_tmp, tag_name, '' if latest_release_draft else ' and removing the draft flag'))
+        release.update_release(name=release.title, message=release.body, prerelease=release.prerelease, target_commitish=release.target_commitish, draft=latest_release_draft, tag_name=tag_name)
+    p.add('Change the tag name from "{}" to "{}"{}'.format(tag_name_tmp, tag_name, '' if latest_release_draft else ' and remove the draft flag'), rename, after)
+    p.run()
+
+# Updates the latest release in place with the artifacts from a directory, replacing only the artifacts that have
+# changed, and points the release to the commit of this build
+def _update(release, src_dir, manifest_name, release_name, release_body, latest_release_draft, latest_release_prerelease, target_commitish,
+            travis_branch, travis_build_number, is_latest_build_for_branch, github_token, github_api_url, github_repo_slug):
+    logging.info('Updating "{}" release in place.'.format(release.tag_name))
+    update = github.ReleaseUpdate(github_token, src_dir, release, manifest_name, travis_build_number)
+    p = plan.Plan()
+    diff = p.add('Compare the artifacts with the ones in "{}" release'.format(release.tag_name), update.diff)
+    upload = p.add('Upload the changed artifacts to "{}" release'.format(release.tag_name), update.upload, [diff])
+
+    # A newer build might have started while we were uploading
+    def check_latest():
+        if not is_latest_build_for_branch():
+            update.discard()
+            raise plan.Cancel()
+    check = p.add('Check that this is still the latest build for "{}" branch'.format(travis_branch), check_latest, [upload])
+    replace = p.add('Replace the changed artifacts of "{}" release'.format(release.tag_name), update.apply, [check])
+
+    def point():
+        repo = github.repo(github_token, github_api_url, github_repo_slug)
+        sha = repo.get_commit(target_commitish if target_commitish is not GithubObject.NotSet else repo.default_branch).sha
+        # A draft release has no tag yet, publishing it creates one
+        if not release.draft:
+            github.move_tag(release, sha, github_token, github_api_url, github_repo_slug)
+        logging.info('Updating the name and the description of "{}" release{}.'.format(release.tag_name, '' if latest_release_draft else ' and removing the draft flag'))
+        release.update_release(name=release_name, message=release_body, draft=latest_release_draft, prerelease=latest_release_prerelease, target_commitish=sha, tag_name=release.tag_name)
+    p.add('Point "{}" release to the commit of this build'.format(release.tag_name), point, [replace])
+    p.run()
+
+def _delete_tmp_asset(release, asset, build_number):
+    logging.info('Deleting "{}" artifact of "{}" release left over by build #{}.'.format(asset.name, release.tag_name, build_number))
+    asset.delete_asset()
+
+def cleanup(index, branch_unfinished_build_numbers, github_api_url):
     github_token        = env.required('CIRP_GITHUB_ACCESS_TOKEN') if env.optional('CIRP_GITHUB_ACCESS_TOKEN') else env.required('GITHUB_ACCESS_TOKEN')
     github_repo_slug    = env.required('CIRP_GITHUB_REPO_SLUG') if env.optional('CIRP_GITHUB_REPO_SLUG') else env.required('TRAVIS_REPO_SLUG')
     travis_branch       = env.required('TRAVIS_BRANCH')
@@ -111,14 +175,18 @@ def cleanup(releases, branch_unfinished_build_numbers, github_api_url):
     if travis_tag:
         return
     logging.info('* Deleting incomplete latest releases left over due to jobs failing or being cancelled.')
-    # FIXME(nurupo): once Python 3.8 is out, use Assignemnt Expression to prevent expensive _break_tag_name() calls https://www.python.org/dev/peps/pep-0572/
-    latest_releases_incomplete = [r for r in releases if r.draft and
-                                  _break_tag_name_tmp(r.tag_name) and
-                                  _break_tag_name_tmp(r.tag_name)['branch'] == travis_branch]
+    # The artifacts the in-place updates of the builds that have finished since have left behind
+    # Whether the release is a draft depends on the options of the build that has published it
+    latest_release = index.by_tag(_tag_name(travis_branch), draft=True)
+    if latest_release:
+        p = plan.Plan()
+        for asset in latest_release[0].get_assets():
+            build_number = github.tmp_asset_build_number(asset.name)
+            if build_number is not None and build_number not in branch_unfinished_build_numbers:
+                p.add('Delete "{}" artifact of "{}" release'.format(asset.name, latest_release[0].tag_name),
+                      lambda asset=asset, build_number=build_number: _delete_tmp_asset(latest_release[0], asset, build_number), kind='delete', fatal=False)
+        p.run()
+    latest_releases_incomplete = [r for r in index.find(release_index.Kind.LATEST_TMP, travis_branch) if r.draft]
     if not latest_releases_incomplete or any(n != travis_build_number for n in branch_unfinished_build_numbers):
         return
-    for r in latest_releases_incomplete:
-        try:
-            github.delete_release_with_tag(r, github_token, github_api_url, github_repo_slug)
-        except Exception as e:
-            logging.warning('{}: {}'.format(type(e).__name__, e))
+    github.delete_releases_with_tags([r.release for r in latest_releases_incomplete], github_token, github_api_url, github_repo_slug)
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+from . import exception
+
+# Manifests of the temporary store releases made by "store --dedupe". Jobs of a build often store byte-identical
+# artifacts, e.g. the same documentation or license files. A job storing with --dedupe uploads only the artifacts with
+# content that isn't already stored in a complete store release of the same build, and uploads a manifest mapping the
+# names of all of its artifacts to the sha256 of their content instead. "collect" and "publish --from-store" then look
+# the content of an artifact that isn't stored in its own release up by the sha256 in the other store releases, and
+# fetch every distinct content only once.
+#
+# The manifest is a JSON object of the form {"artifacts": {"<name>": "<sha256 hex digest>", ...}}.
+
+suffix = '.cirp-manifest.json'
+
+def is_manifest(name):
+    return name.endswith(suffix)
+
+def dumps(hashes):
+    return json.dumps({'artifacts': hashes}, sort_keys=True).encode('utf-8')
+
+# Returns a name -> sha256 dict of the artifacts listed in the manifest
+def loads(name, data):
+    try:
+        hashes = json.loads(data.decode('utf-8'))['artifacts']
+        if not isinstance(hashes, dict) or not all(isinstance(h, str) for h in hashes.values()):
+            raise ValueError('"artifacts" is not a name to sha256 mapping')
+        return hashes
+    except (ValueError, KeyError, TypeError) as e:
+        raise exception.CIReleasePublisherError('Couldn\'t read "{}" manifest. {}: {}'.format(name, type(e).__name__, e))
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+from urllib.parse import urlsplit
+import json
+import logging
+import re
+import threading
+import time
+
+# Per-endpoint metrics of all HTTP requests made, both by us and by PyGithub, as they all go through the sessions of
+# requests_retry. Requests are grouped by the logical endpoint they call, e.g. all asset uploads go under "upload asset"
+# no matter the release or the asset, so that the metrics of different runs can be compared.
+
+_endpoints = [
+    ('GET', r'^/repos/[^/]+/[^/]+$', 'get repo'),
+    ('GET', r'^/repos/[^/]+/[^/]+/releases$', 'list releases'),
+    ('POST', r'^/repos/[^/]+/[^/]+/releases$', 'create release'),
+    ('GET', r'^/repos/[^/]+/[^/]+/releases/tags/.+$', 'get release by tag'),
+    ('GET', r'^/repos/[^/]+/[^/]+/releases/assets/\d+$', 'download asset'),
+    ('DELETE', r'^/repos/[^/]+/[^/]+/releases/assets/\d+$', 'delete asset'),
+    ('GET', r'^/repos/[^/]+/[^/]+/releases/\d+$', 'get release'),
+    ('PATCH', r'^/repos/[^/]+/[^/]+/releases/\d+$', 'update release'),
+    ('DELETE', r'^/repos/[^/]+/[^/]+/releases/\d+$', 'delete release'),
+    ('GET', r'^/repos/[^/]+/[^/]+/releases/\d+/assets$', 'list assets'),
+    ('POST', r'^.*/releases/\d+/assets$', 'upload asset'),
+    ('GET', r'^/repos/[^/]+/[^/]+/git/refs?/tags/.+$', 'get tag'),
+    ('DELETE', r'^/repos/[^/]+/[^/]+/git/refs?/tags/.+$', 'delete tag'),
+    ('GET', r'^/repos/[^/]+/[^/]+/commits/[^/]+$', 'get commit'),
+    ('POST', r'^(/api)?/graphql$', 'graphql'),
+    ('POST', r'^/auth/github$', 'travis auth'),
+    ('GET', r'^/repo/[^/]+/branch/[^/]+$', 'travis branch'),
+    ('GET', r'^/repo/[^/]+/builds$', 'travis builds'),
+    ('GET', r'^/build/\d+$', 'travis build'),
+]
+_endpoints = [(method, re.compile(path), name) for method, path, name in _endpoints]
+
+# Upper bounds of the latency histogram buckets, in seconds
+_buckets = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+_metrics = {}
+_lock = threading.Lock()
+_start_time = time.time()
+
+# Returns the name of the endpoint the request is made to
+def endpoint(method, url):
+    parts = urlsplit(url)
+    # GitHub Enterprise has the API under /api/v3
+    path = re.sub(r'^/api/v3(?=/)', '', parts.path.rstrip('/'))
+    for endpoint_method, path_re, name in _endpoints:
+        if method == endpoint_method and path_re.match(path):
+            return name
+    # E.g. the asset downloads being redirected to a storage host
+    return '{} {}'.format(method, parts.hostname) if parts.hostname else '{} other'.format(method)
+
+def _endpoint_metrics(name):
+    if name not in _metrics:
+        _metrics[name] = {
+            'requests': 0,
+            'errors': 0,
+            'retries': 0,
+            'rate_limit_waits': 0,
+            'rate_limit_wait_time': 0.0,
+            'time': 0.0,
+            'latency_histogram': [0] * (len(_buckets) + 1),
+            'bytes_sent': 0,
+            'bytes_received': 0,
+        }
+    return _metrics[name]
+
+# Records a request that took `latency` seconds. `status` is None if no response was received.
+def request(name, latency, status, bytes_sent, bytes_received):
+    with _lock:
+        m = _endpoint_metrics(name)
+        m['requests'] += 1
+        if status is None or status >= 400:
+            m['errors'] += 1
+        m['time'] += latency
+        m['latency_histogram'][len([b for b in _buckets if b < latency])] += 1
+        m['bytes_sent'] += bytes_sent
+        m['bytes_received'] += bytes_received
+
+def retry(name):
+    with _lock:
+        _endpoint_metrics(name)['retries'] += 1
+
+# Records having waited on the API rate limit for `wait_time` seconds
+def rate_limit_wait(name, wait_time):
+    with _lock:
+        m = _endpoint_metrics(name)
+        m['rate_limit_waits'] += 1
+        m['rate_limit_wait_time'] += wait_time
+
+def reset():
+    global _start_time
+    with _lock:
+        _metrics.clear()
+        _start_time = time.time()
+
+def report():
+    with _lock:
+        endpoints = {name: dict(m, latency_histogram=list(m['latency_histogram'])) for name, m in _metrics.items()}
+    total = {}
+    for name in ['requests', 'errors', 'retries', 'rate_limit_waits', 'rate_limit_wait_time', 'time', 'bytes_sent', 'bytes_received']:
+        total[name] = sum(m[name] for m in endpoints.values())
+    return {
+        'wall_time': time.time() - _start_time,
+        'latency_buckets': _buckets,
+        'endpoints': endpoints,
+        'total': total,
+    }
+
+# Logs a summary of the metrics and writes them into `metrics_file` as JSON, if it's set
+def log_and_write(metrics_file=None):
+    r = report()
+    if r['total']['requests']:
+        logging.info('Made {} API request(s) taking {:.1f} seconds in total, with {} retries and {:.1f} seconds of waiting on the API rate limit:'.format(
+                     r['total']['requests'], r['total']['time'], r['total']['retries'], r['total']['rate_limit_wait_time']))
+        for name, m in sorted(r['endpoints'].items(), key=lambda item: -item[1]['time']):
+            logging.info('\t{}: {} request(s) in {:.1f} seconds, {} error(s), {} retries, {} bytes sent, {} bytes received.'.format(
+                         name, m['requests'], m['time'], m['errors'], m['retries'], m['bytes_sent'], m['bytes_received']))
+    if metrics_file:
+        try:
+            with open(metrics_file, 'w') as f:
+                json.dump(r, f, indent=2, sort_keys=True)
+        except OSError as e:
+            logging.warning('Failed to write the metrics into "{}". {}: {}'.format(metrics_file, type(e).__name__, e))
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Various helpers for running things in parallel
+
+# Calls fn(item) for every item using at most `workers` threads, running all of them even if some fail.
+# Returns a list of (item, exception) tuples for the calls that have raised, in the order of `items`.
+def run_all(fn, items, workers):
+    failures = []
+    if workers <= 1:
+        for item in items:
+            try:
+                fn(item)
+            except Exception as e:
+                failures.append((item, e))
+        return failures
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [(item, executor.submit(fn, item)) for item in items]
+        for item, future in futures:
+            e = future.exception()
+            if e:
+                failures.append((item, e))
+    return failures
+
+# Calls fn(item) for every item using at most `workers` threads, stopping at the first failure.
+# The calls that haven't started yet are cancelled and the exception is re-raised once the running calls finish.
+# Returns a list of fn(item) results in the order of `items`.
+def run_until_error(fn, items, workers):
+    if workers <= 1:
+        return [fn(item) for item in items]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(fn, item) for item in items]
+        try:
+            for future in as_completed(futures):
+                future.result()
+        except Exception:
+            for future in futures:
+                future.cancel()
+            raise
+        return [future.result() for future in futures]
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import asyncio
+import logging
+
+from . import aio
+from . import config
+
+# Changes to make on GitHub -- release creations, uploads, deletions of releases and tags, renames -- decided upfront
+# from a single release listing, along with the order they have to happen in. The steps that don't depend on each other
+# run at the same time, e.g. the deletion of old releases runs while the artifacts are being uploaded. With --dry-run
+# the plan is only logged, allowing to see what a command would do, e.g. what a changed retention policy would delete.
+
+# Raised by a step to stop the steps depending on it without it being an error
+class Cancel(Exception):
+    pass
+
+class Step:
+    def __init__(self, number, description, fn, after, kind, fatal, afn):
+        self.number = number
+        self.description = description
+        self.fn = fn
+        self.afn = afn
+        self.after = after
+        self.kind = kind
+        self.fatal = fatal
+        # One of 'pending', 'done', 'failed', 'cancelled' or 'skipped'
+        self.state = 'pending'
+        self.result = None
+        self.error = None
+
+class Plan:
+    def __init__(self):
+        self.steps = []
+
+    # Adds a step running `fn` once all of the steps in `after` are done. The result of `fn` is stored in the result
+    # attribute of the returned step. Steps of the same `kind` are run at most as many at once as config allows, e.g.
+    # config.delete_concurrency for 'delete'. A failed `fatal` step fails the whole plan, while a failure of a non-fatal
+    # step is only logged as a warning, in both cases the steps depending on the failed step are skipped.
+    # With the asyncio engine `afn(client)` coroutine is awaited instead of `fn`, if it's set, while `fn` is run in a
+    # thread otherwise.
+    def add(self, description, fn, after=None, kind=None, fatal=True, afn=None):
+        step = Step(len(self.steps) + 1, description, fn, [s for s in (after or []) if s], kind, fatal, afn)
+        self.steps.append(step)
+        return step
+
+    def log(self):
+        for step in self.steps:
+            after = ' (after {})'.format(', '.join(str(s.number) for s in step.after)) if step.after else ''
+            logging.info('\t{}. {}{}'.format(step.number, step.description, after))
+
+    def _run_step(self, step):
+        try:
+            step.result = step.fn()
+            step.state = 'done'
+        except Cancel:
+            step.state = 'cancelled'
+        except Exception as e:
+            step.error = e
+            step.state = 'failed'
+
+    def _skip(self, step, error):
+        return error is not None or any(s.state in ['failed', 'cancelled', 'skipped'] for s in step.after)
+
+    # Returns the error of the first failed fatal step, if any
+    async def _run_async(self, client):
+        loop = asyncio.get_event_loop()
+        limits = {'delete': asyncio.Semaphore(config.delete_concurrency)}
+        tasks = {}
+        errors = []
+        async def run_step(step):
+            # The steps only ever depend on the steps added before them, which already have their tasks
+            for s in step.after:
+                await tasks[s]
+            if self._skip(step, errors[0] if errors else None):
+                step.state = 'skipped'
+                return
+            limit = limits.get(step.kind)
+            if limit:
+                await limit.acquire()
+            try:
+                if self._skip(step, errors[0] if errors else None):
+                    step.state = 'skipped'
+                    return
+                try:
+                    step.result = await step.afn(client) if step.afn else await loop.run_in_executor(None, step.fn)
+                    step.state = 'done'
+                except Cancel:
+                    step.state = 'cancelled'
+                except Exception as e:
+                    step.error = e
+                    step.state = 'failed'
+                    if step.fatal and not errors:
+                        errors.append(e)
+                    else:
+                        logging.warning('{}: {}'.format(type(e).__name__, e))
+            finally:
+                if limit:
+                    limit.release()
+        for step in self.steps:
+            tasks[step] = asyncio.ensure_future(run_step(step))
+        await asyncio.gather(*tasks.values())
+        return errors[0] if errors else None
+
+    # Runs the steps, or only logs them with config.dry_run set. Raises the error of the first failed fatal step.
+    # The steps log what they do on their own.
+    def run(self):
+        if not self.steps:
+            return
+        if config.dry_run:
+            logging.info('Dry run, would run the following step(s):')
+            self.log()
+            return
+        if config.engine == 'asyncio':
+            error = aio.run(self._run_async)
+            if error is not None:
+                raise error
+            return
+        limits = {'delete': config.delete_concurrency}
+        pending = list(self.steps)
+        running = {}
+        error = None
+        with ThreadPoolExecutor(max_workers=len(self.steps)) as executor:
+            while pending or running:
+                for step in list(pending):
+                    if self._skip(step, error):
+                        step.state = 'skipped'
+                        pending.remove(step)
+                        continue
+                    if not all(s.state == 'done' for s in step.after):
+                        continue
+                    if step.kind in limits and len([s for s in running.values() if s.kind == step.kind]) >= limits[step.kind]:
+                        continue
+                    pending.remove(step)
+                    running[executor.submit(self._run_step, step)] = step
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    step = running.pop(future)
+                    if step.state != 'failed':
+                        continue
+                    if step.fatal and error is None:
+                        error = step.error
+                    else:
+                        logging.warning('{}: {}'.format(type(step.error).__name__, step.error))
+        if error is not None:
+            raise error
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+from email.utils import parsedate_to_datetime
+from urllib3.util import retry
+import datetime
+import logging
+import threading
+import time
+
+from . import metrics
+
+# Paces requests made to a host based on the rate limit information the host sends in the response headers, so that
+# we slow down before running out of the rate limit budget instead of hitting the limit and having all of the retries
+# fail in quick succession. Shared by all threads making requests to the host.
+class Governor:
+    # Once the remaining budget drops this low, requests are spread out evenly over the time left until the reset
+    _slow_down_remaining = 100
+    # Once the remaining budget drops this low, requests wait for the reset. Leaves some slack for requests in flight.
+    _pause_remaining = 5
+
+    def __init__(self, host):
+        self._host = host
+        self._cond = threading.Condition()
+        self._limit = None
+        self._remaining = None
+        self._reset = None
+        self._pause_until = 0
+        self._next_request = 0
+        self._slowing_down = False
+        # When the last logged wait ends
+        self._logged_wait_until = 0
+
+    # Returns how many seconds to wait before making a request, logging the longer waits. A wait is logged once, rather
+    # than by every thread waiting until the same time and on every wake up or poll while waiting.
+    def _wait_time(self, now):
+        if self._reset is not None and self._reset <= now:
+            # The budget has been reset, we don't know how much of it is left until we get a response
+            self._remaining = None
+            self._reset = None
+            self._next_request = 0
+            self._slowing_down = False
+        wait = max(self._pause_until, self._next_request) - now
+        if self._remaining is not None and self._remaining <= self._pause_remaining:
+            wait = max(wait, self._reset - now)
+        if wait >= 1 and now + wait > self._logged_wait_until:
+            self._logged_wait_until = now + wait
+            logging.info('Waiting {:.0f} second(s) for "{}" API rate limit. {}'.format(wait, self._host, self.budget()))
+        return wait
+
+    # Takes one request out of the remaining budget
+    def _take(self, now):
+        if self._remaining is not None:
+            self._remaining -= 1
+            if self._remaining <= self._slow_down_remaining:
+                if not self._slowing_down:
+                    self._slowing_down = True
+                    logging.warning('Slowing down the requests to "{}" as the API rate limit is running out. {}'.format(self._host, self.budget()))
+                self._next_request = now + (self._reset - now) / max(self._remaining - self._pause_remaining, 1)
+
+    # Blocks until it's fine to make a request and takes one request out of the remaining budget.
+    # Returns True if it had to wait.
+    def acquire(self):
+        waited = False
+        with self._cond:
+            while True:
+                now = time.time()
+                wait = self._wait_time(now)
+                if wait <= 0:
+                    break
+                waited = True
+                self._cond.wait(wait)
+            self._take(now)
+        return waited
+
+    # Non-blocking acquire() for the asyncio engine. Takes one request out of the remaining budget and returns 0 if it's
+    # fine to make a request right away, otherwise returns how many seconds to wait before trying again.
+    def try_acquire(self):
+        with self._cond:
+            now = time.time()
+            wait = self._wait_time(now)
+            if wait > 0:
+                return wait
+            self._take(now)
+            return 0
+
+    # Updates the budget from the headers of a response
+    def update(self, headers, status):
+        limit = headers.get('X-RateLimit-Limit')
+        remaining = headers.get('X-RateLimit-Remaining')
+        reset = headers.get('X-RateLimit-Reset')
+        retry_after = headers.get('Retry-After')
+        with self._cond:
+            if remaining is not None and reset is not None:
+                remaining = int(remaining)
+                reset = int(reset)
+                if limit is not None:
+                    self._limit = int(limit)
+                # Responses to concurrent requests can arrive out of order, within the same rate limit window trust
+                # the lowest remaining budget seen, which also accounts for the requests that are still in flight
+                if reset == self._reset and self._remaining is not None:
+                    remaining = min(remaining, self._remaining)
+                self._remaining = remaining
+                self._reset = reset
+            if retry_after is not None:
+                # GitHub sends Retry-After when a secondary rate limit is hit
+                try:
+                    pause_until = time.time() + int(retry_after)
+                except ValueError:
+                    pause_until = parsedate_to_datetime(retry_after).timestamp()
+                self._pause_until = max(self._pause_until, pause_until)
+                logging.warning('"{}" API asked us to retry after {} second(s).'.format(self._host, retry_after))
+            elif status in [403, 429] and self._remaining == 0:
+                self._pause_until = max(self._pause_until, self._reset)
+            self._cond.notify_all()
+
+    def budget(self):
+        if self._remaining is None:
+            return 'Remaining API rate limit budget is unknown.'
+        return 'Remaining API rate limit budget: {} out of {} request(s), resets at {} UTC.'.format(
+            max(self._remaining, 0), self._limit, datetime.datetime.fromtimestamp(self._reset, datetime.timezone.utc).strftime('%H:%M:%S'))
+
+_governors = {}
+_governors_lock = threading.Lock()
+
+def governor(host):
+    with _governors_lock:
+        if host not in _governors:
+            _governors[host] = Governor(host)
+        return _governors[host]
+
+def log_budgets():
+    with _governors_lock:
+        governors = list(_governors.items())
+    for host, g in governors:
+        if g._remaining is not None:
+            logging.info('"{}": {}'.format(host, g.budget()))
+
+# urllib3 Retry that lets the governor of the host see the responses that are being retried and makes the retries
+# wait on the governor, e.g. until the rate limit resets, instead of just sleeping for a short backoff time.
+# Also records the retries in the metrics.
+class Retry(retry.Retry):
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        if response is not None and _pool is not None:
+            governor(_pool.host).update(response.headers, response.status)
+        endpoint = metrics.endpoint(method, url) if method and url else None
+        new_retry = super().increment(method, url, response, error, _pool, _stacktrace)
+        if endpoint:
+            metrics.retry(endpoint)
+        new_retry._host = _pool.host if _pool is not None else None
+        new_retry._endpoint = endpoint
+        return new_retry
+
+    def sleep(self, response=None):
+        super().sleep(response)
+        host = getattr(self, '_host', None)
+        if host:
+            start = time.time()
+            if governor(host).acquire() and getattr(self, '_endpoint', None):
+                metrics.rate_limit_wait(self._endpoint, time.time() - start)
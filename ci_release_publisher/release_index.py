@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+from enum import Enum, unique
+from github import GithubException, UnknownObjectException
+import datetime
+import logging
+import threading
+
+from . import config
+from . import env
+
+@unique
+class Kind(Enum):
+    LATEST = 1
+    LATEST_TMP = 2
+    NUMBERED = 3
+    NUMBERED_TMP = 4
+    TAG_TMP = 5
+    STORE = 6
+    STORE_TMP = 7
+
+def _parsers():
+    # Imported here rather than at the top as the release modules import this module
+    from . import latest_release, numbered_release, tag_release, temporary_store_release
+    # Tag releases don't have a (non-tmp) parser, as any tag name is a valid tag release tag name, look them up by_tag() instead
+    return [
+        (Kind.LATEST, latest_release._break_tag_name),
+        (Kind.LATEST_TMP, latest_release._break_tag_name_tmp),
+        (Kind.NUMBERED, numbered_release._break_tag_name),
+        (Kind.NUMBERED_TMP, numbered_release._break_tag_name_tmp),
+        (Kind.TAG_TMP, tag_release._break_tag_name_tmp),
+        (Kind.STORE, temporary_store_release._break_tag_name),
+        (Kind.STORE_TMP, temporary_store_release._break_tag_name_tmp),
+    ]
+
+# A release along with the information parsed out of its tag name.
+# `branch` is the tag for tag releases, the same way $TRAVIS_BRANCH is set to the tag in tag builds.
+# `build` and `job` are ints, or None if the release kind has no such information in its tag name.
+class Record:
+    __slots__ = ['kind', 'branch', 'build', 'job', 'draft', 'created_at', 'id', 'release']
+
+    def __init__(self, kind, info, release):
+        self.kind = kind
+        self.branch = info['tag'] if 'tag' in info else info['branch']
+        self.build = int(info['build_number']) if 'build_number' in info else None
+        self.job = int(info['job_number']) if 'job_number' in info else None
+        self.draft = release.draft
+        self.created_at = release.created_at
+        self.id = release.id
+        self.release = release
+
+# Parses tag names of the releases once and indexes them by release kind, branch and build number, so that the release
+# modules don't have to re-parse and re-scan all of the releases on every query. The releases are listed lazily, page by
+# page, and only as far as a query needs, so no listing is done if nothing ends up querying the index, and the queries
+# for releases of the current build stop at the first release created before the build, for as long as the listing
+# comes newest first. If `repo` is given, it's used to look published releases up by their tag without listing the
+# releases at all.
+class ReleaseIndex:
+    def __init__(self, releases, repo=None):
+        self._releases = releases
+        self._repo = repo
+        self._lock = threading.Lock()
+        self._iter = None
+        self._parsers = None
+        self._complete = False
+        # created_at of the last indexed release, with GitHub listing the releases newest first
+        self._oldest = None
+        # Whether the listing has come newest first so far. If it hasn't, nothing can be told about the releases not
+        # listed yet, so the listing is never stopped early.
+        self._ordered = True
+        self._created_after = None
+        self._by_tag = {}
+        self._by_branch = {}
+        self._by_build = {}
+
+    # Indexes the releases until one created before `created_after` is reached, or all of them if it's None
+    def _index(self, created_after=None):
+        with self._lock:
+            if self._complete:
+                return
+            if self._iter is None:
+                self._parsers = _parsers()
+                self._iter = iter(self._releases)
+            if not self._ordered:
+                created_after = None
+            if created_after is not None and self._oldest is not None and self._oldest < created_after:
+                return
+            for release in self._iter:
+                self._add(release)
+                if self._oldest is not None and release.created_at > self._oldest:
+                    logging.debug('Releases are not listed newest first, listing all of them.')
+                    self._ordered = False
+                    created_after = None
+                self._oldest = release.created_at
+                if created_after is not None and release.created_at < created_after:
+                    return
+            self._complete = True
+
+    def _add(self, release):
+        self._by_tag.setdefault(release.tag_name, []).append(release)
+        for kind, parser in self._parsers:
+            info = parser(release.tag_name)
+            if not info:
+                continue
+            record = Record(kind, info, release)
+            self._by_branch.setdefault((kind, record.branch), []).append(record)
+            self._by_build.setdefault((kind, record.branch, record.build), []).append(record)
+
+    # Returns the earliest time a release of the current build could have been created at, or None if it's unknown.
+    # A build can't create anything before its commit was made, although the commit date comes from the committer's
+    # clock, so some leeway is given for it being off.
+    def _current_build_created_after(self):
+        with self._lock:
+            if self._created_after is None:
+                self._created_after = False
+                # The commit is not in the repo we publish to when publishing to a different repo
+                if self._repo is not None and not env.optional('CIRP_GITHUB_REPO_SLUG'):
+                    try:
+                        date = self._repo.get_commit(env.required('TRAVIS_COMMIT')).commit.committer.date
+                        self._created_after = date - datetime.timedelta(seconds=config.clock_skew)
+                    except GithubException as e:
+                        logging.warning('Couldn\'t look up the date of the commit, listing all releases. {}: {}'.format(type(e).__name__, e))
+            return self._created_after or None
+
+    # Returns a list of releases with the exact tag name.
+    # `current_build` tells that only a release created by the current build is of interest.
+    # `draft` tells that the release might be a draft, which can't be looked up by the tag, only found in the listing.
+    def by_tag(self, tag_name, current_build=False, draft=False):
+        if not self._complete and not current_build and not draft and self._repo is not None:
+            try:
+                return [self._repo.get_release(tag_name)]
+            except UnknownObjectException:
+                return []
+        self._index(self._current_build_created_after() if current_build else None)
+        return list(self._by_tag.get(tag_name, []))
+
+    # Returns a list of records of the release kind for the branch, optionally only of a specific build number.
+    # `current_build` tells that only releases created by the current build are of interest. Not meant for the lookups
+    # of releases to delete, as it relies on the commit date and on the listing order.
+    def find(self, kind, branch, build=None, current_build=False):
+        self._index(self._current_build_created_after() if current_build else None)
+        if build is None:
+            return list(self._by_branch.get((kind, branch), []))
+        return list(self._by_build.get((kind, branch, int(build)), []))
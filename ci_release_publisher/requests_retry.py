@@ -1,13 +1,69 @@
 # -*- coding: utf-8 -*-
 
 from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
 import requests
+import threading
+import time
 
 from . import config
 from . import env
+from . import http_cache
+from . import metrics
+from . import rate_limit
 
-def requests_retry():
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def _origin(url):
+    parts = urlsplit(url)
+    origin = '{}://{}'.format(parts.scheme, parts.hostname)
+    if parts.port and parts.port != {'http': 80, 'https': 443}.get(parts.scheme):
+        origin += ':{}'.format(parts.port)
+    return origin
+
+def _body_size(body):
+    if body is None:
+        return 0
+    try:
+        return len(body)
+    except TypeError:
+        return 0
+
+# Makes every request wait on the rate limit governor of the host and lets the governor see every response.
+# Also serves the responses cached by the HTTP cache, if it's enabled, and records the metrics of the requests.
+class _RateLimitedHTTPAdapter(HTTPAdapter):
+    def send(self, request, **kwargs):
+        endpoint = metrics.endpoint(request.method, request.url)
+        cache_entry = None if kwargs.get('stream') else http_cache.prepare(request)
+        governor = rate_limit.governor(urlsplit(request.url).hostname)
+        start = time.time()
+        if governor.acquire():
+            metrics.rate_limit_wait(endpoint, time.time() - start)
+        start = time.time()
+        try:
+            response = super().send(request, **kwargs)
+        except Exception:
+            metrics.request(endpoint, time.time() - start, None, _body_size(request.body), 0)
+            raise
+        governor.update(response.headers, response.status_code)
+        if kwargs.get('stream'):
+            # Not read yet, the length of the body is the best we have
+            received = int(response.headers.get('Content-Length', 0))
+        else:
+            received = len(response.content)
+            response = http_cache.process(request, response, cache_entry)
+        metrics.request(endpoint, time.time() - start, response.status_code, _body_size(request.body), received)
+        return response
+
+# Having an auth set stops requests from falling back to the credentials in ~/.netrc, which would replace the
+# Authorization header we set
+def _no_auth(request):
+    return request
+
+def _session():
     session = requests.Session()
+    session.auth = _no_auth
     retry = config.retries()
 
     debug = env.optional('CIRP_DEBUG')
@@ -25,8 +81,17 @@ def requests_retry():
         add_response_to_exeption(session, 'get')
         add_response_to_exeption(session, 'post')
 
-    adapter = HTTPAdapter(max_retries=retry)
+    adapter = _RateLimitedHTTPAdapter(max_retries=retry, pool_connections=config.pool_size, pool_maxsize=config.pool_size)
     session.mount('http://', adapter)
     session.mount('https://', adapter)
 
     return session
+
+# Returns a session shared by all requests made to the same scheme, host and port as the url, so that the connections
+# are pooled and re-used instead of doing a TCP and TLS handshake on every request. Sessions are thread-safe for our use.
+def requests_retry(url):
+    origin = _origin(url)
+    with _sessions_lock:
+        if origin not in _sessions:
+            _sessions[origin] = _session()
+        return _sessions[origin]
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+
+from contextlib import redirect_stderr, redirect_stdout
+import json
+import logging
+import os
+import socket
+import socketserver
+import stat
+import sys
+import tempfile
+import threading
+
+from . import config
+from . import env
+from . import exception
+from . import metrics
+from .__version__ import __version__
+
+# Warm worker mode. `ci-release-publisher serve` keeps a process running for the rest of the job, listening on a Unix
+# socket, and the commands run afterwards in the same job forward themselves to it instead of running on their own.
+# The commands then re-use the connections the previous commands have opened, the GitHub objects they have fetched,
+# the Travis-CI token and the rate limit budgets they have seen, and the release listing is re-validated page by page
+# against an HTTP cache instead of being downloaded again. A command runs in-process, as usual, whenever there is no
+# server to forward it to.
+#
+# The server runs one command at a time, with the environment variables and the working directory of the command's
+# process, and sends its output back as it goes. Only the processes of the same user can connect, as the environment
+# variables sent hold the access tokens.
+
+# How long to wait for the server to accept a command before running the command in-process instead, in seconds
+_accept_timeout = 5
+
+# Returns the path of the socket of the current job
+def socket_path():
+    if env.optional('CIRP_SERVE_SOCKET'):
+        return env.required('CIRP_SERVE_SOCKET')
+    return os.path.join(tempfile.gettempdir(), 'ci-release-publisher-{}'.format(os.getuid()), '{}.sock'.format(env.optional('TRAVIS_JOB_ID') or 'local'))
+
+def _send(f, message):
+    f.write(json.dumps(message).encode('utf-8') + b'\n')
+    f.flush()
+
+# Runs the command on the server of the current job, writing its output into stdout and stderr. Returns the exit code
+# of the command, or None if there is no server to run it on.
+def forward(argv):
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+    streams = {'stdout': sys.stdout, 'stderr': sys.stderr}
+    path = socket_path()
+    if not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(_accept_timeout)
+        sock.connect(path)
+        f = sock.makefile('rwb')
+        _send(f, {'version': __version__, 'argv': argv, 'env': dict(os.environ), 'cwd': os.getcwd()})
+        reply = json.loads(f.readline().decode('utf-8'))
+    except (OSError, ValueError):
+        sock.close()
+        return None
+    if not reply.get('accepted'):
+        sock.close()
+        return None
+    # The command is running on the server now, it must not be run again in-process no matter what happens
+    sock.settimeout(None)
+    try:
+        for line in f:
+            message = json.loads(line.decode('utf-8'))
+            if 'exit' in message:
+                return message['exit']
+            stream = streams[message['stream']]
+            stream.write(message['data'])
+            stream.flush()
+    except (OSError, ValueError):
+        pass
+    finally:
+        sock.close()
+    sys.stderr.write('Error: Lost the connection to the "{}" server in the middle of the command.\n'.format(path))
+    return 1
+
+_client = None
+_client_lock = threading.Lock()
+
+# Sends what is written into it to the client of the command being run, or to the original stream if there is none.
+# Shared by all threads, as a command can log from several of them.
+class _ClientStream:
+    def __init__(self, name):
+        self._name = name
+
+    def write(self, data):
+        with _client_lock:
+            if _client is None:
+                getattr(sys, '__{}__'.format(self._name)).write(data)
+                return len(data)
+            try:
+                _send(_client, {'stream': self._name, 'data': data})
+            except OSError:
+                # The client is gone, the command still runs to the end
+                pass
+        return len(data)
+
+    def flush(self):
+        pass
+
+def _set_client(f):
+    global _client
+    with _client_lock:
+        _client = f
+
+def _config_values():
+    return {name: value for name, value in vars(config).items() if not name.startswith('_') and not callable(value) and not hasattr(value, '__file__')}
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+        except ValueError:
+            return
+        if request.get('version') != __version__:
+            logging.warning('Not running a command of ci-release-publisher {} on {} server.'.format(request.get('version'), __version__))
+            _send(self.wfile, {'accepted': False})
+            return
+        _send(self.wfile, {'accepted': True})
+        _send(self.wfile, {'exit': self.server.run_command(request, self.wfile)})
+
+class _Server(socketserver.UnixStreamServer):
+    def __init__(self, path, run, idle_timeout):
+        super().__init__(path, _Handler)
+        self.run = run
+        # handle_request() gives up waiting after this long
+        self.timeout = idle_timeout
+        self.idle = False
+        self._environ = dict(os.environ)
+        self._cwd = os.getcwd()
+        self._config = _config_values()
+
+    def handle_timeout(self):
+        self.idle = True
+
+    def run_command(self, request, client):
+        # Every command starts with the same config, the config is set from the command line arguments
+        for name, value in self._config.items():
+            setattr(config, name, value)
+        os.environ.clear()
+        os.environ.update(request['env'])
+        metrics.reset()
+        _set_client(client)
+        try:
+            os.chdir(request['cwd'])
+            with redirect_stdout(_ClientStream('stdout')), redirect_stderr(_ClientStream('stderr')):
+                self.run(request['argv'])
+            return 0
+        except SystemExit as e:
+            return e.code if isinstance(e.code, int) else 0 if e.code is None else 1
+        except Exception as e:
+            logging.error('{}: {}'.format(type(e).__name__, e))
+            return 1
+        finally:
+            _set_client(None)
+            os.environ.clear()
+            os.environ.update(self._environ)
+            os.chdir(self._cwd)
+
+# Runs the server until no command has been run for `idle_timeout` seconds. `run(argv)` runs a command in-process.
+def serve(run, idle_timeout):
+    if not hasattr(socket, 'AF_UNIX'):
+        raise exception.CIReleasePublisherError('The "serve" command needs Unix sockets, which this platform doesn\'t support.')
+    path = socket_path()
+    if not env.optional('CIRP_SERVE_SOCKET'):
+        directory = os.path.dirname(path)
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        st = os.stat(directory)
+        if st.st_uid != os.getuid() or stat.S_IMODE(st.st_mode) & 0o077:
+            raise exception.CIReleasePublisherError('Directory "{}" of the socket must be accessible only by its owner.'.format(directory))
+    if os.path.exists(path):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+            raise exception.CIReleasePublisherError('A server is already running on "{}".'.format(path))
+        except OSError:
+            # Left over by a server that has died
+            os.remove(path)
+        finally:
+            sock.close()
+    server = _Server(path, run, idle_timeout)
+    os.chmod(path, 0o600)
+    # The release listing is re-validated instead of re-downloaded by the following commands, unless an HTTP cache is
+    # set up already
+    http_cache_dir = None
+    if not config.http_cache_dir:
+        http_cache_dir = tempfile.TemporaryDirectory(prefix='ci-release-publisher-http-cache-')
+        config.http_cache_dir = http_cache_dir.name
+        server._config['http_cache_dir'] = http_cache_dir.name
+    # The output of the commands goes to their clients
+    streams = {}
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, logging.StreamHandler) and handler.stream in [sys.stderr, sys.__stderr__]:
+            streams[handler] = handler.stream
+            handler.stream = _ClientStream('stderr')
+    logging.info('Serving the commands of this job on "{}".'.format(path))
+    try:
+        while not server.idle:
+            server.handle_request()
+        logging.info('Stopping as no command has been run for {} seconds.'.format(idle_timeout))
+    finally:
+        server.server_close()
+        os.remove(path)
+        for handler, stream in streams.items():
+            handler.stream = stream
+        # Already reported by the commands
+        metrics.reset()
+        if http_cache_dir:
+            http_cache_dir.cleanup()
@@ -7,6 +7,8 @@ from . import config
 from . import env
 from . import exception
 from . import github
+from . import plan
+from . import release_index
 from . import travis
 
 _tmp_tag_suffix = 'tag'
@@ -49,13 +51,13 @@ def publish_args(parser):
 def publish_validate_args(args):
     return args.tag_release
 
-def publish_with_args(args, releases, artifact_dir, github_api_url, travis_api_url):
+def publish_with_args(args, index, artifacts, github_api_url, travis_api_url):
     if not args.tag_release:
         return
-    publish(releases, artifact_dir, args.tag_release_name, args.tag_release_body, args.tag_release_draft, args.tag_release_prerelease,
+    publish(index, artifacts, args.tag_release_name, args.tag_release_body, args.tag_release_draft, args.tag_release_prerelease,
             args.tag_release_target_commitish, args.tag_release_force_recreate, github_api_url, travis_api_url)
 
-def publish(releases, artifact_dir, tag_release_name, tag_release_body, tag_release_draft, tag_release_prerelease, tag_release_target_commitish, tag_release_force_recreate, github_api_url, travis_api_url):
+def publish(index, artifacts, tag_release_name, tag_release_body, tag_release_draft, tag_release_prerelease, tag_release_target_commitish, tag_release_force_recreate, github_api_url, travis_api_url):
     github_token         = env.required('CIRP_GITHUB_ACCESS_TOKEN') if env.optional('CIRP_GITHUB_ACCESS_TOKEN') else env.required('GITHUB_ACCESS_TOKEN')
     github_repo_slug     = env.required('CIRP_GITHUB_REPO_SLUG') if env.optional('CIRP_GITHUB_REPO_SLUG') else env.required('TRAVIS_REPO_SLUG')
     travis_repo_slug     = env.required('TRAVIS_REPO_SLUG')
@@ -80,36 +82,53 @@ def publish(releases, artifact_dir, tag_release_name, tag_release_body, tag_rele
     if not _is_latest_build_for_branch():
         return
     tag_name_tmp = _tag_name_tmp(travis_tag)
-    logging.info('Creating a release with the tag name "{}".'.format(tag_name_tmp))
-    release = github.github(github_token, github_api_url).get_repo(github_repo_slug).create_git_release(
-        tag=tag_name_tmp,
-        name=tag_release_name if tag_release_name else tag_name,
-        message=tag_release_body if tag_release_body else
-                'This is an auto-generated release based on [Travis-CI build #{}]({})'
-                .format(travis_build_id, travis_build_web_url),
-        draft=True,
-        prerelease=tag_release_prerelease,
-        target_commitish=tag_release_target_commitish if tag_release_target_commitish else travis_commit if not env.optional('CIRP_GITHUB_REPO_SLUG') else GithubObject.NotSet)
-    github.upload_artifacts(artifact_dir, release)
-    if not _is_latest_build_for_branch():
-        github.delete_release_with_tag(release, github_token, github_api_url, github_repo_slug)
-        return
-    previous_release = [r for r in releases if r.tag_name == tag_name]
+    p = plan.Plan()
+
+    def create_release():
+        logging.info('Creating a release with the tag name "{}".'.format(tag_name_tmp))
+        return github.create_draft_release(github.repo(github_token, github_api_url, github_repo_slug), artifacts,
+            tag=tag_name_tmp,
+            name=tag_release_name if tag_release_name else tag_name,
+            message=tag_release_body if tag_release_body else
+                    'This is an auto-generated release based on [Travis-CI build #{}]({})'
+                    .format(travis_build_id, travis_build_web_url),
+            prerelease=tag_release_prerelease,
+            target_commitish=tag_release_target_commitish if tag_release_target_commitish else travis_commit if not env.optional('CIRP_GITHUB_REPO_SLUG') else GithubObject.NotSet)
+    create = p.add('Create "{}" draft release'.format(tag_name_tmp), create_release)
+    upload = p.add('Upload the artifacts to "{}" release'.format(tag_name_tmp), lambda: github.upload_artifacts(github_token, artifacts, create.result), [create])
+
+    # A newer build might have started while we were uploading
+    def check_latest():
+        if not _is_latest_build_for_branch():
+            github.delete_release_with_tag(create.result, github_token, github_api_url, github_repo_slug)
+            raise plan.Cancel()
+    check = p.add('Check that this is still the latest build for the "{}" tag'.format(travis_tag), check_latest, [upload])
+    previous_release = index.by_tag(tag_name, draft=tag_release_draft)
+    after = [check]
     if previous_release:
         if tag_release_force_recreate:
             # Delete release but keep the tag, since in Tag Releases the user creates the tag, not us
-            logging.info('Deleting a release with the tag name "{}".'.format(tag_name))
-            previous_release[0].delete_release()
+            def delete_previous_release():
+                logging.info('Deleting a release with the tag name "{}".'.format(tag_name))
+                previous_release[0].delete_release()
+            after = [p.add('Delete "{}" release, keeping the tag'.format(tag_name), delete_previous_release, after, kind='delete')]
         else:
-            github.delete_release_with_tag(release, github_token, github_api_url, github_repo_slug)
-            raise exception.CIReleasePublisherError('Tag release with the tag name "{}" already exists. Are you sure you meant to recreate the tag release? '
-                                                    'Recreating a publicly visible tag release might be disastrous, as all the changes you have done to the release -- changed text, '
-                                                    'extra artifacts and so on -- will be lost, as well as hashes of the files created as part of the build might change. '
-                                                    'Please manually delete the "{}" release and restart the build if you really meant to recreate the release.'.format(tag_name, tag_name))
-    logging.info('Changing the tag name from "{}" to "{}"{}.'.format(tag_name_tmp, tag_name, '' if tag_release_draft else ' and removing the draft flag'))
-    release.update_release(name=release.title, message=release.body, prerelease=release.prerelease, target_commitish=release.target_commitish, draft=tag_release_draft, tag_name=tag_name)
-
-def cleanup(releases, branch_unfinished_build_numbers, github_api_url):
+            def refuse_to_recreate():
+                github.delete_release_with_tag(create.result, github_token, github_api_url, github_repo_slug)
+                raise exception.CIReleasePublisherError('Tag release with the tag name "{}" already exists. Are you sure you meant to recreate the tag release? '
+                                                        'Recreating a publicly visible tag release might be disastrous, as all the changes you have done to the release -- changed text, '
+                                                        'extra artifacts and so on -- will be lost, as well as hashes of the files created as part of the build might change. '
+                                                        'Please manually delete the "{}" release and restart the build if you really meant to recreate the release.'.format(tag_name, tag_name))
+            after = [p.add('Fail as "{}" release already exists, deleting "{}" release'.format(tag_name, tag_name_tmp), refuse_to_recreate, after)]
+
+    def rename():
+        release = create.result
+        logging.info('Changing the tag name from "{}" to "{}"{}.'.format(tag_name_tmp, tag_name, '' if tag_release_draft else ' and removing the draft flag'))
+        release.update_release(name=release.title, message=release.body, prerelease=release.prerelease, target_commitish=release.target_commitish, draft=tag_release_draft, tag_name=tag_name)
+    p.add('Change the tag name from "{}" to "{}"{}'.format(tag_name_tmp, tag_name, '' if tag_release_draft else ' and remove the draft flag'), rename, after)
+    p.run()
+
+def cleanup(index, branch_unfinished_build_numbers, github_api_url):
     github_token        = env.required('CIRP_GITHUB_ACCESS_TOKEN') if env.optional('CIRP_GITHUB_ACCESS_TOKEN') else env.required('GITHUB_ACCESS_TOKEN')
     github_repo_slug    = env.required('CIRP_GITHUB_REPO_SLUG') if env.optional('CIRP_GITHUB_REPO_SLUG') else env.required('TRAVIS_REPO_SLUG')
     travis_build_number = env.required('TRAVIS_BUILD_NUMBER')
@@ -118,14 +137,7 @@ def cleanup(releases, branch_unfinished_build_numbers, github_api_url):
     if not travis_tag:
         return
     logging.info('* Deleting incomplete tag releases left over due to jobs failing or being cancelled.')
-    # FIXME(nurupo): once Python 3.8 is out, use Assignemnt Expression to prevent expensive _break_tag_name() calls https://www.python.org/dev/peps/pep-0572/
-    tag_releases_incomplete = [r for r in releases if r.draft and
-                               _break_tag_name_tmp(r.tag_name) and
-                               _break_tag_name_tmp(r.tag_name)['tag'] == travis_tag]
+    tag_releases_incomplete = [r for r in index.find(release_index.Kind.TAG_TMP, travis_tag) if r.draft]
     if not tag_releases_incomplete or any(n != travis_build_number for n in branch_unfinished_build_numbers):
         return
-    for r in tag_releases_incomplete:
-        try:
-            github.delete_release_with_tag(r, github_token, github_api_url, github_repo_slug)
-        except Exception as e:
-            logging.warning('{}: {}'.format(type(e).__name__, e))
+    github.delete_releases_with_tags([r.release for r in tag_releases_incomplete], github_token, github_api_url, github_repo_slug)
@@ -5,13 +5,18 @@ from github import GithubObject
 import logging
 import re
 
+from . import bundle
 from . import config
 from . import enum
 from . import env
 from . import github
+from . import manifest
+from . import plan
+from . import release_index
 from . import travis
 
 _tag_suffix = 'tmp'
+_tag_name_re = re.compile(r'^-(?P<branch>.*)-(?P<build_number>\d+)-(?P<job_number>\d+)-$')
 
 def _tag_name(travis_branch, travis_build_number, travis_job_number):
     return '{}-{}-{}-{}-{}'.format(config.tag_prefix, travis_branch, travis_build_number, travis_job_number, _tag_suffix)
@@ -20,7 +25,7 @@ def _break_tag_name(tag_name):
     if not tag_name.startswith(config.tag_prefix) or not tag_name.endswith(_tag_suffix):
         return None
     tag_name = tag_name[len(config.tag_prefix):-len(_tag_suffix)]
-    m = re.match('^-(?P<branch>.*)-(?P<build_number>\d+)-(?P<job_number>\d+)-$', tag_name)
+    m = _tag_name_re.match(tag_name)
     if not m:
         return None
     return {'branch': m.group('branch'), 'build_number': m.group('build_number'), 'job_number': m.group('job_number')}
@@ -37,11 +42,18 @@ def _break_tag_name_tmp(tag_name):
 def publish_args(parser):
     parser.add_argument('--release-name', type=str, help='Release name text. If not specified a predefined text is used.')
     parser.add_argument('--release-body', type=str, help='Release body text. If not specified a predefined text is used.')
-
-def publish_with_args(args, releases, artifact_dir, github_api_url, travis_api_url):
-    publish(releases, artifact_dir, args.release_name, args.release_body, github_api_url)
-
-def publish(releases, artifact_dir, release_name, release_body, github_api_url):
+    parser.add_argument('--bundle', default=False, action='store_true',
+                        help='Store all of the artifacts as a single tar asset, generated while it\'s being uploaded, instead of an asset per artifact. '
+                             'Saves an API request per artifact when storing and collecting jobs with many small artifacts. "collect" extracts the bundles on its own, '
+                             'while "publish --from-store" doesn\'t support them.')
+    parser.add_argument('--dedupe', default=False, action='store_true',
+                        help='Store only the artifacts with content that isn\'t already stored by another job of the current build, along with a manifest of all of '
+                             'the artifacts. "collect" and "publish --from-store" fetch the same content only once.')
+
+def publish_with_args(args, index, artifact_dir, github_api_url, travis_api_url):
+    publish(index, artifact_dir, args.release_name, args.release_body, github_api_url, args.bundle, args.dedupe)
+
+def publish(index, artifact_dir, release_name, release_body, github_api_url, bundle_artifacts=False, dedupe_artifacts=False):
     github_token        = env.required('CIRP_GITHUB_ACCESS_TOKEN') if env.optional('CIRP_GITHUB_ACCESS_TOKEN') else env.required('GITHUB_ACCESS_TOKEN')
     github_repo_slug    = env.required('CIRP_GITHUB_REPO_SLUG') if env.optional('CIRP_GITHUB_REPO_SLUG') else env.required('TRAVIS_REPO_SLUG')
     travis_branch       = env.required('TRAVIS_BRANCH')
@@ -54,23 +66,50 @@ def publish(releases, artifact_dir, release_name, release_body, github_api_url):
     tag_name = _tag_name(travis_branch, travis_build_number, travis_job_number)
     logging.info('* Creating a temporary store release with the tag name "{}".'.format(tag_name))
     tag_name_tmp = _tag_name_tmp(travis_branch, travis_build_number, travis_job_number)
-    logging.info('Creating a release with the tag name "{}".'.format(tag_name_tmp))
-    release = github.github(github_token, github_api_url).get_repo(github_repo_slug).create_git_release(
-        tag=tag_name_tmp,
-        name=release_name if release_name else
-             'Temporary store release {}'
-             .format(tag_name),
-        message=release_body if release_body else
-                ('Auto-generated temporary release containing build artifacts of [Travis-CI job #{}]({}).\n\n'
-                'This release was created by the CI Release Publisher script, which will automatically delete it in the current or following builds.\n\n'
-                'You should not manually delete this release, unless you don\'t use the CI Release Publisher script anymore.')
-                .format(travis_job_id, travis_job_web_url),
-        draft=True,
-        prerelease=True,
-        target_commitish=travis_commit if not env.optional('CIRP_GITHUB_REPO_SLUG') else GithubObject.NotSet)
-    github.upload_artifacts(artifact_dir, release)
-    logging.info('Changing the tag name from "{}" to "{}".'.format(tag_name_tmp, tag_name))
-    release.update_release(name=release.title, message=release.body, prerelease=release.prerelease, target_commitish=release.target_commitish, draft=release.draft, tag_name=tag_name)
+    # An incomplete release of this very job might be left over if the job was restarted or has failed mid-upload,
+    # in which case we re-use it and upload only the artifacts that are missing from it
+    release = github.latest_draft_release(index.by_tag(tag_name_tmp, current_build=True))
+    p = plan.Plan()
+    create = None
+    if release:
+        logging.info('Resuming the incomplete release with the tag name "{}".'.format(tag_name_tmp))
+    else:
+        def create_release():
+            logging.info('Creating a release with the tag name "{}".'.format(tag_name_tmp))
+            return github.repo(github_token, github_api_url, github_repo_slug).create_git_release(
+                tag=tag_name_tmp,
+                name=release_name if release_name else
+                     'Temporary store release {}'
+                     .format(tag_name),
+                message=release_body if release_body else
+                        ('Auto-generated temporary release containing build artifacts of [Travis-CI job #{}]({}).\n\n'
+                        'This release was created by the CI Release Publisher script, which will automatically delete it in the current or following builds.\n\n'
+                        'You should not manually delete this release, unless you don\'t use the CI Release Publisher script anymore.')
+                        .format(travis_job_id, travis_job_web_url),
+                draft=True,
+                prerelease=True,
+                target_commitish=travis_commit if not env.optional('CIRP_GITHUB_REPO_SLUG') else GithubObject.NotSet)
+        create = p.add('Create "{}" draft release'.format(tag_name_tmp), create_release)
+    draft_release = lambda: create.result if create else release
+    if bundle_artifacts:
+        bundle_name = '{}{}'.format(tag_name, bundle.suffix)
+        upload = p.add('Upload the artifacts to "{}" release as "{}" bundle'.format(tag_name_tmp, bundle_name),
+                       lambda: github.upload_bundle(github_token, artifact_dir, draft_release(), bundle_name, resume=True), [create])
+    elif dedupe_artifacts:
+        # Only the complete store releases of the other jobs, the content of the incomplete ones might never get uploaded
+        other_releases = [r.release for r in stored_releases(index, travis_branch, travis_build_number) if r.job != int(travis_job_number)]
+        manifest_name = '{}{}'.format(tag_name, manifest.suffix)
+        upload = p.add('Upload the artifacts with content not stored by the other {} job(s) to "{}" release along with "{}" manifest'.format(len(other_releases), tag_name_tmp, manifest_name),
+                       lambda: github.upload_deduplicated(github_token, artifact_dir, draft_release(), other_releases, manifest_name, resume=True), [create])
+    else:
+        upload = p.add('Upload the artifacts to "{}" release'.format(tag_name_tmp), lambda: github.upload_artifacts(github_token, artifact_dir, draft_release(), resume=True), [create])
+
+    def rename():
+        r = draft_release()
+        logging.info('Changing the tag name from "{}" to "{}".'.format(tag_name_tmp, tag_name))
+        r.update_release(name=r.title, message=r.body, prerelease=r.prerelease, target_commitish=r.target_commitish, draft=r.draft, tag_name=tag_name)
+    p.add('Change the tag name from "{}" to "{}"'.format(tag_name_tmp, tag_name), rename, [upload])
+    p.run()
 
 @unique
 class CleanupScope(Enum):
@@ -90,11 +129,11 @@ def cleanup_args(parser):
                         help='Cleanup only if the current build has a job that both has failed and doesn\'t have allow_failure set on it, '
                              'i.e. the current build is going to fail once the current stage finishes running.')
 
-def cleanup_with_args(args, releases, github_api_url, travis_api_url):
-    cleanup(releases, enum.arg_choices_to_enum(CleanupScope, args.scope), enum.arg_choices_to_enum(CleanupRelease, args.release),
+def cleanup_with_args(args, index, github_api_url, travis_api_url):
+    cleanup(index, enum.arg_choices_to_enum(CleanupScope, args.scope), enum.arg_choices_to_enum(CleanupRelease, args.release),
             args.on_nonallowed_failure, args.github_api_url, travis_api_url)
 
-def cleanup(releases, scopes, release_completenesses, on_nonallowed_failure, github_api_url, travis_api_url):
+def cleanup(index, scopes, release_completenesses, on_nonallowed_failure, github_api_url, travis_api_url):
     github_token         = env.required('CIRP_GITHUB_ACCESS_TOKEN') if env.optional('CIRP_GITHUB_ACCESS_TOKEN') else env.required('GITHUB_ACCESS_TOKEN')
     github_repo_slug     = env.required('CIRP_GITHUB_REPO_SLUG') if env.optional('CIRP_GITHUB_REPO_SLUG') else env.required('TRAVIS_REPO_SLUG')
     travis_repo_slug     = env.required('TRAVIS_REPO_SLUG')
@@ -127,58 +166,41 @@ def cleanup(releases, scopes, release_completenesses, on_nonallowed_failure, git
         if not r.draft:
             return False
 
-        info = None
-        if not info and CleanupRelease.COMPLETE in release_completenesses:
-            info = _break_tag_name(r.tag_name)
-        if not info and CleanupRelease.INCOMPLETE in release_completenesses:
-            info = _break_tag_name_tmp(r.tag_name)
-
-        if not info:
-            return False
-
-        if info['branch'] != travis_branch:
-            return False
-
         result = False
         if not result and CleanupScope.CURRENT_JOB in scopes:
-            result = int(info['build_number']) == int(travis_build_number) and int(info['job_number']) == int(travis_job_number)
+            result = r.build == int(travis_build_number) and r.job == int(travis_job_number)
         if not result and CleanupScope.CURRENT_BUILD in scopes:
-            result = int(info['build_number']) == int(travis_build_number)
+            result = r.build == int(travis_build_number)
         if not result and CleanupScope.PREVIOUS_FINISHED_BUILDS in scopes:
-            result = int(info['build_number']) < int(travis_build_number) and info['build_number'] not in branch_unfinished_build_numbers
+            result = r.build < int(travis_build_number) and str(r.build) not in branch_unfinished_build_numbers
         return result
 
+    releases = []
+    if CleanupRelease.COMPLETE in release_completenesses:
+        releases.extend(index.find(release_index.Kind.STORE, travis_branch))
+    if CleanupRelease.INCOMPLETE in release_completenesses:
+        releases.extend(index.find(release_index.Kind.STORE_TMP, travis_branch))
     releases_to_delete = [r for r in releases if should_delete(r)]
 
     # Sort for a better presentation when printing
-    releases_to_delete = sorted(releases_to_delete, key=lambda r: not not _break_tag_name(r.tag_name))
-    releases_to_delete = sorted(releases_to_delete, key=lambda r: int(_break_tag_name(r.tag_name)['job_number'] if _break_tag_name(r.tag_name)
-                                                                      else _break_tag_name_tmp(r.tag_name)['job_number']))
-    releases_to_delete = sorted(releases_to_delete, key=lambda r: int(_break_tag_name(r.tag_name)['build_number'] if _break_tag_name(r.tag_name)
-                                                                      else _break_tag_name_tmp(r.tag_name)['build_number']))
-
-    for release in releases_to_delete:
-        try:
-            github.delete_release_with_tag(release, github_token, github_api_url, github_repo_slug)
-        except Exception as e:
-            logging.warning('{}: {}'.format(type(e).__name__, e))
-
-def download(releases, artifact_dir):
+    releases_to_delete = sorted(releases_to_delete, key=lambda r: (r.build, r.job, r.kind == release_index.Kind.STORE))
+
+    github.delete_releases_with_tags([r.release for r in releases_to_delete], github_token, github_api_url, github_repo_slug)
+
+# Returns the records of the temporary store releases created during the build, sorted by the job number
+def stored_releases(index, travis_branch, travis_build_number):
+    releases_stored = [r for r in index.find(release_index.Kind.STORE, travis_branch, travis_build_number, current_build=True) if r.draft]
+    return sorted(releases_stored, key=lambda r: r.job)
+
+def download(index, artifact_dir):
     github_token        = env.required('CIRP_GITHUB_ACCESS_TOKEN') if env.optional('CIRP_GITHUB_ACCESS_TOKEN') else env.required('GITHUB_ACCESS_TOKEN')
     travis_branch       = env.required('TRAVIS_BRANCH')
     travis_build_number = env.required('TRAVIS_BUILD_NUMBER')
 
     logging.info('* Downloading temporary store releases created during this build.')
 
-    # FIXME(nurupo): once Python 3.8 is out, use Assignemnt Expression to prevent expensive _break_tag_name() calls https://www.python.org/dev/peps/pep-0572/
-    releases_stored = [r for r in releases if r.draft and
-                       _break_tag_name(r.tag_name) and
-                       _break_tag_name(r.tag_name)['branch'] == travis_branch and
-                       int(_break_tag_name(r.tag_name)['build_number']) == int(travis_build_number)]
-    # Sort for a better presentation when printing
-    releases_stored = sorted(releases_stored, key=lambda r: int(_break_tag_name(r.tag_name)['job_number']))
+    releases_stored = stored_releases(index, travis_branch, travis_build_number)
     if not releases_stored:
         logging.info('Couldn\'t find any temporary store releases for this build.')
         return
-    for release in releases_stored:
-        github.download_artifcats(github_token, release, artifact_dir)
+    github.download_artifacts(github_token, [r.release for r in releases_stored], artifact_dir)
@@ -3,7 +3,10 @@
 from enum import Enum, unique
 import requests
 
+from . import aio
+from . import cache
 from . import config
+from . import parallel
 from .requests_retry import requests_retry
 
 # Apparently there is no Traivis API python library that supports the latest API version (v3).
@@ -17,11 +20,41 @@ class Travis:
 
     def __init__(self, travis_api_url, travis_token=None, github_token=None):
         self._api_url = travis_api_url
+        self._github_token = None if travis_token else github_token
+        # Copy the headers, so that the token doesn't end up being set for all instances
+        self._headers = dict(Travis._headers)
         if travis_token or github_token:
-            self._headers['Authorization'] = 'token {}'.format(travis_token if travis_token else Travis._github_token_to_travis_token(github_token, travis_api_url))
+            self._headers['Authorization'] = 'token {}'.format(travis_token if travis_token else self._travis_token())
         else:
             raise ValueError('Either travis_token or github_token must be provided')
 
+    # Returns a Travis-CI token for the GitHub token, exchanging the GitHub token only once per job
+    def _travis_token(self, refresh=False):
+        token_cache = cache.Cache(self._api_url, self._github_token)
+        if refresh:
+            token_cache.invalidate('travis_token')
+        travis_token = token_cache.get('travis_token')
+        if not travis_token:
+            travis_token = Travis._github_token_to_travis_token(self._github_token, self._api_url)
+            token_cache.set('travis_token', travis_token)
+        return travis_token
+
+    def _get(self, url, params=None):
+        response = requests_retry(self._api_url).get(url, headers=self._headers, params=params, timeout=config.timeout)
+        if response.status_code == 401 and self._github_token:
+            # The cached Travis-CI token might have been revoked, get a new one
+            self._headers['Authorization'] = 'token {}'.format(self._travis_token(refresh=True))
+            response = requests_retry(self._api_url).get(url, headers=self._headers, params=params, timeout=config.timeout)
+        return response
+
+    async def _get_async(self, client, url, params=None):
+        response = await client.request('GET', url, headers=self._headers, params=params)
+        if response.status_code == 401 and self._github_token:
+            # The cached Travis-CI token might have been revoked, get a new one
+            self._headers['Authorization'] = 'token {}'.format(self._travis_token(refresh=True))
+            response = await client.request('GET', url, headers=self._headers, params=params)
+        return response
+
     @classmethod
     def _github_token_to_travis_token(cls, github_token, travis_api_url):
         # We have to use API 2.1 to get Travis-CI token based on GitHub token.
@@ -34,7 +67,7 @@ class Travis:
             'User-Agent': cls._headers['User-Agent'],
         }
         # API doc: https://docs.travis-ci.com/api/?http#with-a-github-token
-        response = requests_retry().post('{}/auth/github'.format(travis_api_url), headers=headers, params={'github_token': github_token}, timeout=config.timeout)
+        response = requests_retry(travis_api_url).post('{}/auth/github'.format(travis_api_url), headers=headers, params={'github_token': github_token}, timeout=config.timeout)
         return response.json()['access_token']
 
     @unique
@@ -54,7 +87,7 @@ class Travis:
             # We use a different API endpoint here because it gives the last non-PR build number, which is exactly what we want.
             # If we used the 'builds' endpoint, Travis would include PRs into it.
             # API doc: https://developer.travis-ci.com/resource/branch
-            response = requests_retry().get('{}/repo/{}/branch/{}'.format(self._api_url, _repo_slug, _branch_name), headers=self._headers, timeout=config.timeout)
+            response = self._get('{}/repo/{}/branch/{}'.format(self._api_url, _repo_slug, _branch_name))
             return response.json()['last_build']['number']
         params = {
             'sort_by': 'created_at:desc,id:desc',
@@ -62,7 +95,7 @@ class Travis:
             'limit': 1,
             'branch.name': _branch_name,
         }
-        response = requests_retry().get('{}/repo/{}/builds'.format(self._api_url, _repo_slug), headers=self._headers, params=params, timeout=config.timeout)
+        response = self._get('{}/repo/{}/builds'.format(self._api_url, _repo_slug), params=params)
         json = response.json()
         if json['@pagination']['count'] > 0:
             return json['builds'][0]['number']
@@ -71,45 +104,64 @@ class Travis:
     # Returns a list of build numbers of all builds that have not finished for a branch.
     # "not finished" basically means that a build is active (queued/running). it could be a restarted build too.
     # Note that the returned build numbers are str, not int.
+    # Not cached, as the releases of the builds missing from it get deleted, and a build can be restarted at any moment.
     def branch_unfinished_build_numbers(self, repo_slug, branch_name):
         _repo_slug = requests.utils.quote(repo_slug, safe='')
         _branch_name = requests.utils.quote(branch_name, safe='')
         # There is no good way to request all builds for a branch, you can request only last 10 with
         # https://developer.travis-ci.com/resource/branch end point, which is not good enough, so we
         # just request all builds in general, sort them by unfinished first and filter by branch ourselves.
-        build_numbers = []
         limit = 100 # Doesn't seem like the API allows to set this any higher, it caps at 100
-        offset = 0
-        count = offset + 1 # Just something to make the while condition true for the first run, it gets overwritten in the loop
-        # `count` is how many there are builds in total and `offset` is how far are we in.
-        while offset < count:
-            params = {
+        def params(offset):
+            return {
                 # This will put all builds that have not finished yet first as their 'finished_at' is null
                 'sort_by': 'finished_at:desc',
                 'offset': offset,
                 'limit': limit,
                 'branch.name': _branch_name,
+                # We don't want to include PRs, have the server filter them out instead of paging through them. We
+                # don't filter by the build state though, as we don't want to miss any state a restarted build can be in.
+                'event_type': ','.join([e.name.lower() for e in Travis.EventType if e != Travis.EventType.ANY]),
             }
-            # API doc: https://developer.travis-ci.com/resource/builds
-            response = requests_retry().get('{}/repo/{}/builds'.format(self._api_url, _repo_slug), headers=self._headers, params=params, timeout=config.timeout)
-            json = response.json()
-            offset += json['@pagination']['limit']
-            count = json['@pagination']['count']
-            # We don't want to include PRs
+        # API doc: https://developer.travis-ci.com/resource/builds
+        url = '{}/repo/{}/builds'.format(self._api_url, _repo_slug)
+        def page(offset):
+            return self._get(url, params=params(offset)).json()
+        async def page_async(client, offset):
+            return (await self._get_async(client, url, params=params(offset))).json()
+        def pages(offsets):
+            if config.engine == 'asyncio':
+                return aio.run(lambda client: aio.run_until_error(lambda offset: page_async(client, offset), offsets, config.page_concurrency))
+            return parallel.run_until_error(page, offsets, config.page_concurrency)
+        build_numbers = []
+        # Returns True if there is no point in looking at the further pages
+        def add(json):
+            # Filter out PRs regardless, just in case
             branch_builds = [build for build in json['builds'] if build['event_type'] != 'pull_request']
             build_numbers.extend([build['number'] for build in branch_builds if build['finished_at'] is None])
             # If we find a finished build, then there is no point in looking any further as we sort
             # them by `finished_at` field -- there would be no unfinished builds any further.
-            if any(build['finished_at'] is not None for build in branch_builds):
-                break
+            return any(build['finished_at'] is not None for build in branch_builds)
+        json = page(0)
+        if add(json):
+            return build_numbers
+        # `count` is how many there are builds in total. Now that we know it, fetch the rest of the pages a few at a time
+        # in parallel, still stopping once we have come across a finished build.
+        limit = json['@pagination']['limit']
+        offsets = list(range(limit, json['@pagination']['count'], limit))
+        for i in range(0, len(offsets), config.page_concurrency):
+            for json in pages(offsets[i:i+config.page_concurrency]):
+                if add(json):
+                    return build_numbers
         return build_numbers
 
     # Returns True if the build has a job that both has failed and doesn't have allow_failure set on it.
+    # Not cached, as a job of the build can fail at any moment.
     def build_has_failed_nonallowfailure_job(self, build_id):
         # API doc: https://developer.travis-ci.com/resource/build
         # API doc: https://developer.travis-ci.com/resource/jobs
         params = {
             'include': 'job.allow_failure,job.state',
         }
-        response = requests_retry().get('{}/build/{}'.format(self._api_url, build_id), headers=self._headers, params=params, timeout=config.timeout)
+        response = self._get('{}/build/{}'.format(self._api_url, build_id), params=params)
         return any([j for j in response.json()['jobs'] if j['state'] == 'failed' and not j['allow_failure']])
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import json
+import threading
+
+import pytest
+
+# Handles the pooled keep-alive connections in their own threads, so that they don't block the shutdown
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+# Base of the stand-ins for the APIs, speaking HTTP/1.1 so that the clients keep the connections alive
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, status, body, headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, status, body):
+        self.send(status, json.dumps(body).encode('utf-8'), {'Content-Type': 'application/json'})
+
+# Starts a local server of the handler class, which sees `state` as self.server.state. Returns the state, with the URL
+# of the server added to it as 'url'. The servers are shut down at the end of the test.
+@pytest.fixture
+def fake_server():
+    servers = []
+    def start(handler, state=None):
+        server = _Server(('127.0.0.1', 0), handler)
+        server.state = state if state is not None else {}
+        server.state['url'] = 'http://127.0.0.1:{}'.format(server.server_port)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server.state
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+import run
+
+def test_run():
+    commands = run.run(releases=3, assets_per_release=1, jobs=2, artifacts=2, artifact_size=1000)
+    assert [c['command'] for c in commands] == ['store', 'store', 'collect', 'publish', 'cleanup_store', 'cleanup_publish']
+    assert all(c['github_requests'] > 0 and c['peak_rss'] > 0 for c in commands)
+    # Each job uploads its artifacts and the collect downloads all of them
+    assert all(c['bytes_sent'] >= 2*1000 for c in commands[:2])
+    assert commands[2]['bytes_received'] >= 4*1000
+
+def test_run_incremental():
+    commands = {incremental: run.run(releases=3, assets_per_release=1, jobs=2, artifacts=2, artifact_size=100000, previous_latest_release=True, incremental=incremental)
+                for incremental in [False, True]}
+    # The latest release gets only the changed first artifact of each job uploaded, out of the 4 artifacts
+    assert commands[False][3]['bytes_sent'] - commands[True][3]['bytes_sent'] > 100000
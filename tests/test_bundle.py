@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import tarfile
+
+import pytest
+
+from ci_release_publisher import bundle, exception
+
+def write(path, data):
+    with open(str(path), 'wb') as f:
+        f.write(data)
+
+def test_reader(tmp_path):
+    files = {'a': b'a' * 1000, 'empty': b'', 'block': b'b' * tarfile.BLOCKSIZE, 'long-name-' * 20: os.urandom(10000), 'unicodé': b'u'}
+    for name, data in files.items():
+        write(tmp_path / name, data)
+    reader = bundle.Reader(str(tmp_path), sorted(files))
+    data = reader.read(reader.size + 1)
+    assert len(data) == reader.size and reader.read(1) == b''
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+        assert {m.name: tar.extractfile(m).read() for m in tar} == files
+    # Rewinds to generate the same tar again, e.g. for a retried upload
+    reader.seek(0)
+    assert b''.join(iter(lambda: reader.read(777), b'')) == data
+
+def test_reader_truncated(tmp_path):
+    write(tmp_path / 'a', b'a' * 1000)
+    reader = bundle.Reader(str(tmp_path), ['a'])
+    write(tmp_path / 'a', b'a')
+    with pytest.raises(exception.CIReleasePublisherError):
+        reader.read(reader.size)
+
+def test_extract(tmp_path):
+    src = tmp_path / 'src'
+    dst = tmp_path / 'dst'
+    src.mkdir()
+    dst.mkdir()
+    write(src / 'a', b'a')
+    write(src / 'b', b'b' * 100000)
+    reader = bundle.Reader(str(src), ['a', 'b'])
+    assert bundle.extract(reader, str(dst), 4096) == ['a', 'b']
+    assert sorted(os.listdir(str(dst))) == ['a', 'b']
+
+@pytest.mark.parametrize('name', ['../a', 'dir/a', '/a'])
+def test_extract_outside(tmp_path, name):
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode='w') as tar:
+        info = tarfile.TarInfo(name)
+        info.size = 1
+        tar.addfile(info, io.BytesIO(b'a'))
+    data.seek(0)
+    with pytest.raises(exception.CIReleasePublisherError):
+        bundle.extract(data, str(tmp_path), 4096)
+    assert os.listdir(str(tmp_path)) == []
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import pytest
+
+from ci_release_publisher import cache, config
+
+@pytest.fixture(autouse=True)
+def home(tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    monkeypatch.setenv('TRAVIS_JOB_ID', '123')
+    monkeypatch.setattr(config, 'cache', True)
+
+def test_get_set():
+    c = cache.Cache('https://api.travis-ci.org', 'token')
+    assert c.get('name') is None
+    c.set('name', ['1', '2'])
+    assert c.get('name') == ['1', '2']
+    assert cache.Cache('https://api.travis-ci.org', 'token').get('name') == ['1', '2']
+    assert cache.Cache('https://api.travis-ci.org', 'other token').get('name') is None
+    assert cache.Cache('https://api.travis-ci.com', 'token').get('name') is None
+
+def test_ttl(monkeypatch):
+    c = cache.Cache('https://api.travis-ci.org', 'token')
+    c.set('name', False)
+    assert c.get('name', 30) is False
+    now = cache.time.time()
+    monkeypatch.setattr(cache.time, 'time', lambda: now + 60)
+    assert c.get('name', 30) is None
+    assert c.get('name') is False
+
+def test_invalidate():
+    c = cache.Cache('https://api.travis-ci.org', 'token')
+    c.set('name', 'value')
+    c.invalidate('name')
+    assert c.get('name') is None
+    c.invalidate('name')
+
+def test_disabled(monkeypatch):
+    c = cache.Cache('https://api.travis-ci.org', 'token')
+    c.set('name', 'value')
+    monkeypatch.setattr(config, 'cache', False)
+    assert c.get('name') is None
+
+def test_no_job(tmp_path, monkeypatch):
+    # Nothing is kept on disk outside of a CI job
+    monkeypatch.delenv('TRAVIS_JOB_ID')
+    c = cache.Cache('https://api.travis-ci.org', 'token')
+    c.set('name', 'value')
+    assert c.get('name') is None
+    assert not os.path.exists(str(tmp_path / '.cache'))
+
+def test_prune(tmp_path, monkeypatch):
+    cache.Cache('https://api.travis-ci.org', 'token').set('name', 'value')
+    monkeypatch.setenv('TRAVIS_JOB_ID', '124')
+    cache.Cache('https://api.travis-ci.org', 'token').set('name', 'value')
+    root = tmp_path / '.cache' / 'ci-release-publisher'
+    assert sorted(os.listdir(str(root))) == ['123', '124']
+    # The directory of the other job is removed once it's older than a job can run
+    old = cache.time.time() - cache.Cache._max_age - 1
+    os.utime(str(root / '123'), (old, old))
+    cache.Cache('https://api.travis-ci.org', 'token').set('other', 'value')
+    assert os.listdir(str(root)) == ['124']
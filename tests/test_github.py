@@ -0,0 +1,710 @@
+# -*- coding: utf-8 -*-
+
+from urllib.parse import parse_qs, urlsplit
+import datetime
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from ci_release_publisher import aio, config, github, manifest
+from ci_release_publisher.requests_retry import requests_retry
+from conftest import FakeHandler
+
+# Stand-in for the GitHub asset download and upload endpoints
+class ArtifactHandler(FakeHandler):
+    def do_GET(self):
+        state = self.server.state
+        state['requests'].append(('GET', self.path, dict(self.headers)))
+        if self.path in state['api']:
+            return self.send_json(200, state['api'][self.path])
+        data = state['files'][self.path]
+        etag = '"{}"'.format(hashlib.sha256(data).hexdigest())
+        start = 0
+        # A range of a changed artifact is not sent
+        if self.headers.get('Range') and not state['ignore_range'] and self.headers.get('If-Range', etag) == etag:
+            start = int(self.headers['Range'][len('bytes='):-1])
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, len(data) - 1, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(data) - start))
+        if self.path in state['drop_after']:
+            # Send only a part of the artifact and drop the connection
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.wfile.write(data[start:start + state['drop_after'].pop(self.path)])
+            self.close_connection = True
+            return
+        self.end_headers()
+        self.wfile.write(data[start:])
+
+    def do_DELETE(self):
+        self.server.state['requests'].append(('DELETE', self.path, dict(self.headers)))
+        self.send_response(204)
+        self.end_headers()
+
+    def do_POST(self):
+        state = self.server.state
+        state['requests'].append(('POST', self.path, dict(self.headers)))
+        length = int(self.headers.get('Content-Length', 0))
+        path = urlsplit(self.path).path
+        if path == '/api/graphql':
+            cursor = json.loads(self.rfile.read(length).decode('utf-8'))['variables']['cursor']
+            page = state['graphql'][int(cursor or 0)]
+            return self.send_json(200, {'data': {'repository': {'releases': page}}})
+        if path in state['fail_uploads']:
+            state['fail_uploads'].remove(path)
+            self.rfile.read(min(length, 64*1024))
+            self.send_response(400)
+            self.send_header('Content-Length', '0')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.close_connection = True
+            return
+        body = self.rfile.read(length)
+        with state['lock']:
+            state['uploads'][(path, parse_qs(urlsplit(self.path).query)['name'][0])] = body
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+@pytest.fixture
+def server(fake_server):
+    return fake_server(ArtifactHandler, {
+        'files': {},
+        'drop_after': {},
+        'ignore_range': False,
+        'fail_uploads': set(),
+        'uploads': {},
+        'graphql': [],
+        'api': {},
+        'requests': [],
+        'lock': threading.Lock(),
+    })
+
+class Asset:
+    def __init__(self, server, release_id, name, data, digest=True):
+        self.name = name
+        self.size = len(data)
+        self.state = 'uploaded'
+        self.content_type = 'application/octet-stream'
+        self.digest = 'sha256:{}'.format(hashlib.sha256(data).hexdigest()) if digest else None
+        self.url = '{}/assets/{}/{}'.format(server['url'], release_id, name)
+        self.deleted = False
+        self.data = data
+        server['files']['/assets/{}/{}'.format(release_id, name)] = data
+
+    def delete_asset(self):
+        self.deleted = True
+
+    def update_asset(self, name, label=''):
+        self.name = name
+        return self
+
+class Release:
+    def __init__(self, server, id, tag_name, assets=None, draft=True, created_at=None):
+        self.id = id
+        self.tag_name = tag_name
+        self.title = tag_name
+        self.body = ''
+        self.prerelease = True
+        self.draft = draft
+        self.created_at = created_at
+        self.upload_url = '{}/upload/{}{{?name,label}}'.format(server['url'], id)
+        self.assets = [Asset(server, id, name, data) for name, data in (assets or {}).items()]
+        self.deleted = False
+
+    def get_assets(self):
+        return [asset for asset in self.assets if not asset.deleted]
+
+    def update_release(self, name, message, draft, prerelease, target_commitish, tag_name):
+        # Like PyGithub, return the updated release as a new object
+        release = Release.__new__(Release)
+        release.__dict__.update(self.__dict__)
+        release.title = name
+        release.body = message
+        release.draft = draft
+        release.prerelease = prerelease
+        release.tag_name = tag_name
+        return release
+
+    def delete_release(self):
+        if self.tag_name.startswith('fail'):
+            raise Exception('Failed to delete "{}"'.format(self.tag_name))
+        self.deleted = True
+
+class Repo:
+    def __init__(self, server):
+        self.server = server
+        self.created = []
+
+    def create_git_release(self, tag, name, message, draft, prerelease, target_commitish):
+        release = Release(self.server, 100 + len(self.created), tag)
+        self.created.append(release)
+        return release
+
+def write(path, data):
+    with open(str(path), 'wb') as f:
+        f.write(data)
+
+def read(path):
+    with open(str(path), 'rb') as f:
+        return f.read()
+
+# Reads and discards the uploaded artifacts, counting the bytes received
+class UploadHandler(FakeHandler):
+    received = []
+
+    def do_POST(self):
+        remaining = int(self.headers['Content-Length'])
+        while remaining > 0:
+            remaining -= len(self.rfile.read(min(remaining, 1024*1024)))
+        UploadHandler.received.append((self.headers['Content-Length'], self.headers.get('Transfer-Encoding')))
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+upload_script = '''
+import logging, resource, sys
+from ci_release_publisher import config, github
+
+class Release:
+    tag_name = "release"
+    upload_url = sys.argv[1] + "/upload{?name,label}"
+
+config.user_agent = "test"
+logging.basicConfig(level=logging.INFO)
+github.upload_artifact("token", Release(), sys.argv[2])
+'''
+
+def test_upload_artifact_memory(fake_server, tmp_path):
+    resource = pytest.importorskip('resource')
+    artifact_size = 1024*1024*1024
+    artifact = tmp_path / 'artifact.bin'
+    # Sparse, doesn't take any disk space
+    with open(str(artifact), 'wb') as f:
+        f.truncate(artifact_size)
+    server = fake_server(UploadHandler)
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    subprocess.check_call([sys.executable, '-c', upload_script, server['url'], str(artifact)], env=env)
+    assert UploadHandler.received == [(str(artifact_size), None)]
+    # ru_maxrss is in kilobytes on Linux, but in bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    assert max_rss < artifact_size / 8
+
+def test_download_artifacts(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'download_concurrency', 3)
+    releases = [
+        Release(server, 1, 'store-1', {'a': b'a1', 'b': b'b1'}),
+        Release(server, 2, 'store-2', {'b': b'b2', 'c': b'c2'}),
+    ]
+    github.download_artifacts('token', releases, str(tmp_path))
+    assert sorted(os.listdir(str(tmp_path))) == ['a', 'b', 'c']
+    # The artifact of a latter release wins and the overwritten one isn't downloaded at all
+    assert read(tmp_path / 'b') == b'b2'
+    assert sorted(path for method, path, headers in server['requests']) == ['/assets/1/a', '/assets/2/b', '/assets/2/c']
+
+def test_netrc_ignored(server, tmp_path, monkeypatch):
+    netrc = tmp_path / 'netrc'
+    write(netrc, b'machine 127.0.0.1 login user password password\n')
+    monkeypatch.setenv('NETRC', str(netrc))
+    server['files']['/repos/owner/repo'] = b'{}'
+    url = '{}/repos/owner/repo'.format(server['url'])
+    requests_retry(url).get(url, headers={'Authorization': 'token a'}, timeout=config.timeout)
+    method, path, headers = server['requests'][-1]
+    assert headers['Authorization'] == 'token a'
+
+def test_connection_class():
+    connection = github._HTTPSRequestsConnectionClass('api.github.com', timeout=15)
+    assert connection.session is requests_retry('https://api.github.com')
+    assert (connection.protocol, connection.host, connection.port, connection.timeout) == ('https', 'api.github.com', 443, 15)
+    # Doesn't create a session and an adapter of its own
+    assert not hasattr(connection, 'adapter')
+
+def test_delete_releases_with_tags(server, monkeypatch):
+    monkeypatch.setattr(config, 'delete_concurrency', 3)
+    deleted_tags = []
+    class Ref:
+        def __init__(self, ref):
+            self.ref = ref
+        def delete(self):
+            deleted_tags.append(self.ref)
+    class TagRepo:
+        def get_git_ref(self, ref):
+            return Ref(ref)
+    monkeypatch.setattr(github, 'repo', lambda *args: TagRepo())
+    releases = [
+        Release(server, 1, 'draft-1'),
+        Release(server, 2, 'fail-2', draft=False),
+        Release(server, 3, 'published-3', draft=False),
+        Release(server, 4, 'draft-4'),
+    ]
+    # A failed deletion doesn't stop the rest
+    github.delete_releases_with_tags(releases, 'token', 'https://api.github.com', 'owner/repo')
+    assert [r.deleted for r in releases] == [True, False, True, True]
+    # Only the tags of the deleted published releases are deleted
+    assert deleted_tags == ['tags/published-3']
+
+def test_resume_upload(server, tmp_path):
+    write(tmp_path / 'same', b'same')
+    write(tmp_path / 'changed', b'new')
+    write(tmp_path / 'missing', b'missing')
+    release = Release(server, 1, 'release', {'same': b'same', 'changed': b'old', 'extra': b'extra'})
+    partial = Asset(server, 1, 'partial', b'partial')
+    partial.state = 'starter'
+    release.assets.append(partial)
+    write(tmp_path / 'partial', b'partial')
+    artifacts = github._resume_upload(str(tmp_path), release, ['changed', 'missing', 'partial', 'same'])
+    assert artifacts == ['changed', 'missing', 'partial']
+    assert sorted(asset.name for asset in release.get_assets()) == ['same']
+
+def test_latest_draft_release(server):
+    assert github.latest_draft_release([]) is None
+    releases = [
+        Release(server, 1, 'a', created_at=datetime.datetime(2020, 1, 1)),
+        Release(server, 2, 'b', created_at=datetime.datetime(2020, 1, 3)),
+        Release(server, 3, 'c', created_at=datetime.datetime(2020, 1, 5), draft=False),
+    ]
+    assert github.latest_draft_release(releases) is releases[1]
+
+def test_download_artifact(server, tmp_path):
+    asset = Asset(server, 1, 'artifact', os.urandom(100000))
+    assert github.download_artifact('token', asset, str(tmp_path)) == str(tmp_path / 'artifact')
+    assert read(tmp_path / 'artifact') == server['files']['/assets/1/artifact']
+    assert os.listdir(str(tmp_path)) == ['artifact']
+
+def test_download_artifact_empty(server, tmp_path):
+    asset = Asset(server, 1, 'empty', b'')
+    github.download_artifact('token', asset, str(tmp_path))
+    assert read(tmp_path / 'empty') == b''
+    assert os.listdir(str(tmp_path)) == ['empty']
+
+def test_download_artifact_resume(server, tmp_path):
+    data = os.urandom(100000)
+    asset = Asset(server, 1, 'artifact', data)
+    server['drop_after']['/assets/1/artifact'] = 30000
+    github.download_artifact('token', asset, str(tmp_path))
+    assert read(tmp_path / 'artifact') == data
+    assert [headers.get('Range') for method, path, headers in server['requests']] == [None, 'bytes=30000-']
+
+def test_download_artifact_changed(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'download_attempts', 1)
+    old_data = os.urandom(100000)
+    asset = Asset(server, 1, 'artifact', old_data, digest=False)
+    server['drop_after']['/assets/1/artifact'] = 30000
+    with pytest.raises(github.exception.CIReleasePublisherError):
+        github.download_artifact('token', asset, str(tmp_path))
+    # The artifact changes on the server without the asset looking any different
+    data = os.urandom(100000)
+    server['files']['/assets/1/artifact'] = data
+    github.download_artifact('token', asset, str(tmp_path))
+    assert read(tmp_path / 'artifact') == data
+    # The range is asked for only if the artifact is still the one with the ETag of the partial download
+    headers = server['requests'][1][2]
+    assert (headers['Range'], headers['If-Range']) == ('bytes=30000-', '"{}"'.format(sha256(old_data)))
+    assert os.listdir(str(tmp_path)) == ['artifact']
+
+@pytest.mark.parametrize('size', [30000, 100000])
+def test_download_artifact_part_of_other_asset(server, tmp_path, size):
+    # Left over by a download of another asset with the same name, possibly of the same size
+    write(tmp_path / 'artifact.part', os.urandom(size))
+    data = os.urandom(100000)
+    github.download_artifact('token', Asset(server, 1, 'artifact', data, digest=False), str(tmp_path))
+    assert read(tmp_path / 'artifact') == data
+    assert [headers.get('Range') for method, path, headers in server['requests']] == [None]
+
+def test_download_artifact_part_of_replaced_asset(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'download_attempts', 1)
+    asset = Asset(server, 1, 'artifact', os.urandom(100000), digest=False)
+    asset.updated_at = datetime.datetime(2020, 1, 1)
+    server['drop_after']['/assets/1/artifact'] = 30000
+    with pytest.raises(github.exception.CIReleasePublisherError):
+        github.download_artifact('token', asset, str(tmp_path))
+    # Uploaded again under the same name
+    asset = Asset(server, 1, 'artifact', os.urandom(100000), digest=False)
+    asset.updated_at = datetime.datetime(2020, 1, 2)
+    github.download_artifact('token', asset, str(tmp_path))
+    assert read(tmp_path / 'artifact') == server['files']['/assets/1/artifact']
+    assert [headers.get('Range') for method, path, headers in server['requests']] == [None, None]
+
+def test_download_artifact_range_ignored(server, tmp_path):
+    data = os.urandom(100000)
+    asset = Asset(server, 1, 'artifact', data)
+    server['drop_after']['/assets/1/artifact'] = 30000
+    server['ignore_range'] = True
+    github.download_artifact('token', asset, str(tmp_path))
+    # The whole artifact is sent again, which must overwrite what has been downloaded rather than being appended to it
+    assert read(tmp_path / 'artifact') == data
+
+def test_download_artifact_async(server, tmp_path):
+    data = os.urandom(100000)
+    asset = Asset(server, 1, 'artifact', data)
+    server['drop_after']['/assets/1/artifact'] = 30000
+    aio.run(lambda client: github._download_artifact_async(client, 'token', asset, str(tmp_path)))
+    assert read(tmp_path / 'artifact') == data
+    assert [headers.get('Range') for method, path, headers in server['requests']] == [None, 'bytes=30000-']
+    assert os.listdir(str(tmp_path)) == ['artifact']
+
+def test_download_artifact_async_range_ignored(server, tmp_path):
+    data = os.urandom(100000)
+    asset = Asset(server, 1, 'artifact', data)
+    server['drop_after']['/assets/1/artifact'] = 30000
+    server['ignore_range'] = True
+    aio.run(lambda client: github._download_artifact_async(client, 'token', asset, str(tmp_path)))
+    assert read(tmp_path / 'artifact') == data
+
+def test_download_artifact_size_mismatch(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'download_attempts', 2)
+    asset = Asset(server, 1, 'artifact', b'data')
+    asset.size = 10
+    with pytest.raises(github.exception.CIReleasePublisherError):
+        github.download_artifact('token', asset, str(tmp_path))
+    assert not os.path.exists(str(tmp_path / 'artifact'))
+
+def test_download_artifact_digest_mismatch(server, tmp_path):
+    asset = Asset(server, 1, 'artifact', b'data')
+    asset.digest = 'sha256:{}'.format(hashlib.sha256(b'atad').hexdigest())
+    with pytest.raises(github.exception.CIReleasePublisherError):
+        github.download_artifact('token', asset, str(tmp_path))
+    assert os.listdir(str(tmp_path)) == []
+
+def test_from_store_adopt(server):
+    big = os.urandom(300000)
+    releases = [
+        Release(server, 1, 'store-1', {'big': big, 'a': b'old a'}),
+        Release(server, 2, 'store-2', {'a': b'new a', 'b': b'b'}),
+    ]
+    artifacts = github.ReleaseArtifacts('token', releases)
+    artifacts.adoptable = True
+    release = github.create_draft_release(Repo(server), artifacts, '_ci-master-latest', 'Latest', 'Body', False, 'sha')
+    # The release with the most bytes is taken over, with the release information updated
+    assert release.id == 1
+    assert (release.tag_name, release.title, release.body, release.prerelease, release.draft) == ('_ci-master-latest', 'Latest', 'Body', False, True)
+    github.upload_artifacts('token', artifacts, release)
+    # Only the artifacts that are not in the release yet are copied, the outdated one is replaced
+    assert server['uploads'] == {('/upload/1', 'a'): b'new a', ('/upload/1', 'b'): b'b'}
+    assert sorted(asset.name for asset in release.get_assets()) == ['big']
+
+def test_from_store_copy(server, monkeypatch):
+    monkeypatch.setattr(config, 'upload_concurrency', 2)
+    releases = [
+        Release(server, 1, 'store-1', {'a': b'a', 'b': b'old b'}),
+        Release(server, 2, 'store-2', {'b': b'new b'}),
+    ]
+    artifacts = github.ReleaseArtifacts('token', releases)
+    repo = Repo(server)
+    release = github.create_draft_release(repo, artifacts, '_ci-master-5', 'Numbered', 'Body', False, 'sha')
+    assert release is repo.created[0]
+    github.upload_artifacts('token', artifacts, release)
+    assert server['uploads'] == {('/upload/100', 'a'): b'a', ('/upload/100', 'b'): b'new b'}
+    # The store releases are left as they were
+    assert [r.tag_name for r in releases] == ['store-1', 'store-2']
+
+def shared_upload(server, tmp_path, releases, participants):
+    shared = github.SharedArtifacts('token', str(tmp_path), participants)
+    def publish(release):
+        participant = shared.participant()
+        try:
+            if release:
+                github.upload_artifacts('token', participant, release)
+        finally:
+            participant.leave()
+    threads = [threading.Thread(target=publish, args=(release,)) for release in releases]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(60)
+        assert not thread.is_alive()
+
+def test_shared_artifacts(server, tmp_path):
+    data = os.urandom(3*1024*1024 + 1)
+    write(tmp_path / 'big', data)
+    write(tmp_path / 'small', b'small')
+    # The last participant doesn't upload anything
+    shared_upload(server, tmp_path, [Release(server, 1, 'latest'), Release(server, 2, 'numbered'), None], 3)
+    assert server['uploads'] == {
+        ('/upload/1', 'big'): data, ('/upload/1', 'small'): b'small',
+        ('/upload/2', 'big'): data, ('/upload/2', 'small'): b'small',
+    }
+
+def test_shared_artifacts_fallback(server, tmp_path):
+    data = os.urandom(3*1024*1024 + 1)
+    write(tmp_path / 'big', data)
+    server['fail_uploads'].add('/upload/2')
+    shared_upload(server, tmp_path, [Release(server, 1, 'latest'), Release(server, 2, 'numbered')], 2)
+    # The failed upload is done again on its own, without holding up the other one
+    assert server['uploads'] == {('/upload/1', 'big'): data, ('/upload/2', 'big'): data}
+
+def test_shared_artifacts_failure(server, tmp_path, monkeypatch):
+    write(tmp_path / 'artifact', b'artifact')
+    def fail(*args):
+        raise Exception('Failed')
+    monkeypatch.setattr(github.SharedArtifacts, '_upload_all', fail)
+    errors = []
+    def upload(participant, release):
+        try:
+            github.upload_artifacts('token', participant, release)
+        except github.exception.CIReleasePublisherError as e:
+            errors.append(e)
+    shared = github.SharedArtifacts('token', str(tmp_path), 2)
+    threads = []
+    for release in [Release(server, 1, 'latest'), Release(server, 2, 'numbered')]:
+        threads.append(threading.Thread(target=upload, args=(shared.participant(), release)))
+        threads[-1].start()
+    for thread in threads:
+        thread.join(60)
+        assert not thread.is_alive()
+    # Neither participant waits forever when the uploading blows up
+    assert len(errors) == 2
+
+def test_upload_artifact_empty(server, tmp_path, monkeypatch):
+    # Older versions of requests and urllib3 send what requests prepares, so check that rather than what got sent
+    prepared = []
+    send = github.requests.adapters.HTTPAdapter.send
+    def record(self, request, **kwargs):
+        prepared.append(dict(request.headers))
+        return send(self, request, **kwargs)
+    monkeypatch.setattr(github.requests.adapters.HTTPAdapter, 'send', record)
+    write(tmp_path / 'empty', b'')
+    github.upload_artifact('token', Release(server, 1, 'release'), str(tmp_path / 'empty'))
+    assert server['uploads'] == {('/upload/1', 'empty'): b''}
+    for headers in [prepared[-1], server['requests'][-1][2]]:
+        assert headers['Content-Length'] == '0'
+        assert 'Transfer-Encoding' not in headers
+
+def test_graphql_releases(server, monkeypatch):
+    def node(id, tag_name, draft):
+        return {'databaseId': id, 'tagName': tag_name, 'isDraft': draft, 'createdAt': '2020-01-0{}T10:00:00Z'.format(10 - id),
+                'releaseAssets': {'totalCount': 0}}
+    server['graphql'] = [
+        {'pageInfo': {'hasNextPage': True, 'endCursor': '1'}, 'nodes': [node(1, 'ci-master-latest', False), node(2, '_ci-master-latest', True)]},
+        {'pageInfo': {'hasNextPage': False, 'endCursor': None}, 'nodes': [node(3, 'v1.0', False)]},
+    ]
+    fetched = []
+    class ReleaseRepo:
+        def get_release(self, id):
+            fetched.append(id)
+            return Release(server, id, 'full')
+    monkeypatch.setattr(github, 'repo', lambda *args: ReleaseRepo())
+    monkeypatch.setattr(config, 'release_listing', 'graphql')
+    releases = list(github.releases('token', '{}/api/v3'.format(server['url']), 'owner/repo'))
+    assert [(r.id, r.tag_name, r.draft) for r in releases] == [(1, 'ci-master-latest', False), (2, '_ci-master-latest', True), (3, 'v1.0', False)]
+    assert releases[0].created_at == datetime.datetime(2020, 1, 9, 10, tzinfo=datetime.timezone.utc)
+    assert server['requests'][0][2]['Authorization'] == 'bearer token'
+    # The full release is fetched only once something else is needed
+    assert fetched == []
+    assert releases[1].title == 'full'
+    assert fetched == [2]
+
+def test_graphql_release_assets(server, monkeypatch):
+    server['graphql'] = [{'pageInfo': {'hasNextPage': False, 'endCursor': None}, 'nodes': [
+        {'databaseId': id, 'tagName': 'v{}'.format(id), 'isDraft': False, 'createdAt': '2020-01-01T10:00:00Z', 'releaseAssets': {'totalCount': assets}}
+        for id, assets in [(1, 0), (2, 1)]
+    ]}]
+    url = '{}/api/v3'.format(server['url'])
+    asset_url = '{}/repos/owner/repo/releases/assets/5'.format(url)
+    server['api']['/api/v3/repos/owner/repo/releases/2/assets?per_page=100'] = [
+        {'id': 5, 'name': 'a', 'size': 1, 'state': 'uploaded', 'url': asset_url, 'content_type': 'text/plain', 'updated_at': '2020-01-01T10:00:00Z'},
+    ]
+    def no_repo(*args):
+        raise AssertionError('The full release was fetched')
+    monkeypatch.setattr(github, 'repo', no_repo)
+    monkeypatch.setattr(config, 'release_listing', 'graphql')
+    releases = list(github.releases('token', url, 'owner/repo'))
+    del server['requests'][:]
+    # Listed by the release id, and not at all if the release has no assets
+    assert releases[0].get_assets() == []
+    assets = releases[1].get_assets()
+    assert [(a.id, a.name, a.state, a.content_type) for a in assets] == [(5, 'a', 'uploaded', 'text/plain')]
+    assets[0].delete_asset()
+    releases[1].delete_release()
+    assert [(method, path, headers['Authorization']) for method, path, headers in server['requests']] == [
+        ('GET', '/api/v3/repos/owner/repo/releases/2/assets?per_page=100', 'token token'),
+        ('DELETE', '/api/v3/repos/owner/repo/releases/assets/5', 'token token'),
+        ('DELETE', '/api/v3/repos/owner/repo/releases/2', 'token token'),
+    ]
+
+def upload_bundle(server, tmp_path, files, release, resume=False):
+    src = tmp_path / 'src'
+    src.mkdir(exist_ok=True)
+    for name, data in files.items():
+        write(src / name, data)
+    github.upload_bundle('token', str(src), release, 'job.cirp-bundle.tar', resume)
+    return server['uploads'].pop(('/upload/{}'.format(release.id), 'job.cirp-bundle.tar'), None)
+
+@pytest.mark.parametrize('engine', ['threads', 'asyncio'])
+def test_bundle(server, tmp_path, monkeypatch, engine):
+    monkeypatch.setattr(config, 'download_concurrency', 2)
+    monkeypatch.setattr(config, 'engine', engine)
+    async def release_assets(client, github_token, release):
+        return release.get_assets()
+    monkeypatch.setattr(github, '_release_assets_async', release_assets)
+    files = {'a': b'a', 'b': os.urandom(100000)}
+    data = upload_bundle(server, tmp_path, files, Release(server, 1, 'store-1'))
+    # Stored as a single asset, downloaded and extracted in place of the artifacts
+    releases = [Release(server, 1, 'store-1', {'job.cirp-bundle.tar': data}), Release(server, 2, 'store-2', {'c': b'c'})]
+    server['drop_after']['/assets/1/job.cirp-bundle.tar'] = 30000
+    dst = tmp_path / 'dst'
+    dst.mkdir()
+    github.download_artifacts('token', releases, str(dst))
+    assert sorted(os.listdir(str(dst))) == ['a', 'b', 'c']
+    assert read(dst / 'b') == files['b']
+    # An interrupted bundle is downloaded again from the start
+    assert [headers.get('Range') for method, path, headers in server['requests'] if path == '/assets/1/job.cirp-bundle.tar'] == [None, None]
+
+def test_bundle_resume(server, tmp_path):
+    files = {'a': b'a'}
+    data = upload_bundle(server, tmp_path, files, Release(server, 1, 'store-1'))
+    release = Release(server, 1, 'store-1', {'job.cirp-bundle.tar': data, 'other': b'other'})
+    assert upload_bundle(server, tmp_path, files, release, resume=True) is None
+    assert [asset.name for asset in release.get_assets()] == ['job.cirp-bundle.tar']
+    # A changed directory gets bundled and uploaded again
+    assert upload_bundle(server, tmp_path, {'a': b'changed'}, release, resume=True) is not None
+    assert release.get_assets() == []
+
+def test_bundle_from_store(server, tmp_path):
+    data = upload_bundle(server, tmp_path, {'a': b'a'}, Release(server, 1, 'store-1'))
+    artifacts = github.ReleaseArtifacts('token', [Release(server, 1, 'store-1', {'job.cirp-bundle.tar': data})])
+    with pytest.raises(github.exception.CIReleasePublisherError):
+        github.upload_artifacts('token', artifacts, Release(server, 2, 'latest'))
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+def test_dedupe_store(server, tmp_path):
+    write(tmp_path / 'a', b'shared')
+    write(tmp_path / 'b', b'b')
+    write(tmp_path / 'c', b'b')
+    # Stored without a manifest, with GitHub's digests, and with a manifest
+    others = [Release(server, 1, 'job-1', {'shared': b'shared'}),
+              Release(server, 2, 'job-2', {'x': b'x', 'job-2.cirp-manifest.json': manifest.dumps({'x': sha256(b'x'), 'y': sha256(b'x')})})]
+    github.upload_deduplicated('token', str(tmp_path), Release(server, 3, 'job-3'), others, 'job-3.cirp-manifest.json')
+    hashes = {'a': sha256(b'shared'), 'b': sha256(b'b'), 'c': sha256(b'b')}
+    assert server['uploads'] == {('/upload/3', 'b'): b'b', ('/upload/3', 'job-3.cirp-manifest.json'): manifest.dumps(hashes)}
+
+@pytest.mark.parametrize('engine', ['threads', 'asyncio'])
+def test_dedupe_collect(server, tmp_path, monkeypatch, engine):
+    monkeypatch.setattr(config, 'engine', engine)
+    async def release_assets(client, github_token, release):
+        return release.get_assets()
+    monkeypatch.setattr(github, '_release_assets_async', release_assets)
+    releases = [Release(server, 1, 'job-1', {'a': b'shared', 'x': b'x'}),
+                Release(server, 2, 'job-2', {'y': b'y', 'job-2.cirp-manifest.json': manifest.dumps({'b': sha256(b'shared'), 'c': sha256(b'shared'), 'y': sha256(b'y')})})]
+    github.download_artifacts('token', releases, str(tmp_path))
+    assert sorted(os.listdir(str(tmp_path))) == ['a', 'b', 'c', 'x', 'y']
+    assert [read(tmp_path / name) for name in ['a', 'b', 'c']] == [b'shared'] * 3
+    # The same content is downloaded once
+    assert sorted(path for method, path, headers in server['requests']) == ['/assets/1/a', '/assets/1/x', '/assets/2/job-2.cirp-manifest.json', '/assets/2/y']
+
+def test_dedupe_collect_missing(server, tmp_path):
+    releases = [Release(server, 1, 'job-1', {'job-1.cirp-manifest.json': manifest.dumps({'a': sha256(b'gone')})})]
+    with pytest.raises(github.exception.CIReleasePublisherError):
+        github.download_artifacts('token', releases, str(tmp_path))
+
+def test_dedupe_from_store_adopt(server):
+    old_a = os.urandom(1000)
+    releases = [Release(server, 1, 'job-1', {'big': os.urandom(300000), 'a': old_a}),
+                Release(server, 2, 'job-2', {'a': b'new a', 'job-2.cirp-manifest.json': manifest.dumps({'a': sha256(b'new a'), 'b': sha256(old_a)})})]
+    artifacts = github.ReleaseArtifacts('token', releases)
+    artifacts.adoptable = True
+    release = github.create_draft_release(Repo(server), artifacts, '_ci-master-latest', 'Latest', 'Body', False, 'sha')
+    assert release.id == 1
+    github.upload_artifacts('token', artifacts, release)
+    # "a" of the taken over release is replaced only after "b" is copied from it
+    assert server['uploads'] == {('/upload/1', 'b'): old_a, ('/upload/1', 'a'): b'new a'}
+    assert [path for method, path, headers in server['requests'] if method == 'POST'] == ['/upload/1?name=b', '/upload/1?name=a']
+    assert [asset.name for asset in release.get_assets()] == ['big']
+
+# Has the uploaded artifacts show up as its assets
+class UpdatableRelease(Release):
+    def __init__(self, server, *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.server = server
+        self.listed = set()
+
+    def get_assets(self):
+        for (path, name), data in sorted(self.server['uploads'].items()):
+            if path == '/upload/{}'.format(self.id) and (path, name) not in self.listed:
+                self.listed.add((path, name))
+                self.assets.append(Asset(self.server, self.id, name, data))
+        return super().get_assets()
+
+def release_data(release):
+    return {asset.name: asset.data for asset in release.get_assets()}
+
+def test_release_update(server, tmp_path):
+    write(tmp_path / 'same', b'same')
+    write(tmp_path / 'changed', b'new')
+    write(tmp_path / 'new', b'n')
+    # Along with the leftovers of an earlier run of this build and of another build
+    previous = {'same': b'same', 'changed': b'old', 'gone': b'gone', '_cirp-7-new': b'left over', '_cirp-6-x': b'x'}
+    release = UpdatableRelease(server, 1, 'ci-master-latest', previous)
+    update = github.ReleaseUpdate('token', str(tmp_path), release, 'ci-master-latest.cirp-manifest.json', 7)
+    update.diff()
+    assert (update.changed, update.removed) == (['changed', 'new'], ['_cirp-7-new', 'gone'])
+    update.upload()
+    hashes = {'same': sha256(b'same'), 'changed': sha256(b'new'), 'new': sha256(b'n')}
+    assert server['uploads'] == {('/upload/1', '_cirp-7-changed'): b'new', ('/upload/1', '_cirp-7-new'): b'n', ('/upload/1', '_cirp-7-ci-master-latest.cirp-manifest.json'): manifest.dumps(hashes)}
+    # The release keeps the previous artifacts until the update is applied
+    assert {name: data for name, data in release_data(release).items() if not name.startswith('_')} == {'same': b'same', 'changed': b'old', 'gone': b'gone'}
+    update.apply()
+    assert release_data(release) == {'same': b'same', 'changed': b'new', 'new': b'n', 'ci-master-latest.cirp-manifest.json': manifest.dumps(hashes), '_cirp-6-x': b'x'}
+
+def test_release_update_manifest(server, tmp_path):
+    for name in ['a', 'b', 'c']:
+        write(tmp_path / name, name.encode('utf-8'))
+    # Without the digests reported by GitHub it goes by the manifest, and uploads the artifacts it doesn't know about
+    release = UpdatableRelease(server, 1, 'ci-master-latest', {'a': b'a', 'b': b'b', 'c': b'c',
+                                                               'ci-master-latest.cirp-manifest.json': manifest.dumps({'a': sha256(b'a'), 'b': sha256(b'old b')})})
+    for asset in release.assets:
+        asset.digest = None
+    update = github.ReleaseUpdate('token', str(tmp_path), release, 'ci-master-latest.cirp-manifest.json', 7)
+    update.diff()
+    assert (update.changed, update.removed) == (['b', 'c'], [])
+    update.upload()
+    update.apply()
+    assert release_data(release) == {'a': b'a', 'b': b'b', 'c': b'c', 'ci-master-latest.cirp-manifest.json': manifest.dumps({name: sha256(name.encode('utf-8')) for name in ['a', 'b', 'c']})}
+
+def test_release_update_overlapping(server, tmp_path):
+    for build_number in [6, 7]:
+        os.mkdir(str(tmp_path / str(build_number)))
+        write(tmp_path / str(build_number) / 'a', 'build {}'.format(build_number).encode('utf-8'))
+    release = UpdatableRelease(server, 1, 'ci-master-latest', {'a': b'old'})
+    updates = [github.ReleaseUpdate('token', str(tmp_path / str(build_number)), release, 'ci-master-latest.cirp-manifest.json', build_number) for build_number in [6, 7]]
+    for update in updates:
+        update.diff()
+        update.upload()
+    # The older build is no longer the latest one, while the newer one is
+    updates[0].discard()
+    updates[1].apply()
+    assert release_data(release) == {'a': b'build 7', 'ci-master-latest.cirp-manifest.json': manifest.dumps({'a': sha256(b'build 7')})}
+
+def test_release_update_apply_failure(server, tmp_path):
+    for name in ['a', 'b', 'c']:
+        write(tmp_path / name, b'new')
+    release = UpdatableRelease(server, 1, 'ci-master-latest', {'a': b'old', 'b': b'old', 'c': b'old'})
+    update = github.ReleaseUpdate('token', str(tmp_path), release, 'ci-master-latest.cirp-manifest.json', 7)
+    update.diff()
+    update.upload()
+    def fail():
+        raise Exception('Failed to delete')
+    release.assets[1].delete_asset = fail
+    with pytest.raises(github.exception.CIReleasePublisherError):
+        update.apply()
+    # The rest of the artifacts are still replaced, while the manifest is left out, as it doesn't match the release
+    assert {name: data for name, data in release_data(release).items() if not name.startswith('_')} == {'a': b'new', 'b': b'old', 'c': b'new'}
+
+def test_release_update_discard(server, tmp_path):
+    write(tmp_path / 'a', b'new')
+    release = UpdatableRelease(server, 1, 'ci-master-latest', {'a': b'old'})
+    update = github.ReleaseUpdate('token', str(tmp_path), release, 'ci-master-latest.cirp-manifest.json', 7)
+    update.diff()
+    update.upload()
+    update.discard()
+    assert release_data(release) == {'a': b'old'}
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import pytest
+
+from ci_release_publisher import config
+from ci_release_publisher.requests_retry import requests_retry
+from conftest import FakeHandler
+
+# Serves a release listing page, responding with 304 if the client already has it
+class ReleasesHandler(FakeHandler):
+    body = b'[{"tag_name": "ci-master-latest"}]'
+    etag = '"1"'
+    statuses = []
+
+    def do_GET(self):
+        if self.headers.get('If-None-Match') == self.etag:
+            ReleasesHandler.statuses.append(304)
+            self.send_response(304)
+            self.send_header('ETag', self.etag)
+            self.end_headers()
+            return
+        ReleasesHandler.statuses.append(200)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(self.body)))
+        self.send_header('ETag', self.etag)
+        self.send_header('Link', '<{}?page=2>; rel="next"'.format(self.path))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+@pytest.fixture
+def server(fake_server, tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'http_cache_dir', str(tmp_path / 'cache'))
+    ReleasesHandler.statuses = []
+    return fake_server(ReleasesHandler)['url']
+
+def test_not_modified(server):
+    url = '{}/repos/owner/repo/releases'.format(server)
+    for _ in range(3):
+        r = requests_retry(url).get(url, headers={'Authorization': 'token a'}, timeout=config.timeout)
+        assert r.status_code == 200
+        assert r.json() == [{'tag_name': 'ci-master-latest'}]
+        assert 'rel="next"' in r.headers['Link']
+    assert ReleasesHandler.statuses == [200, 304, 304]
+    # Not shared between tokens
+    requests_retry(url).get(url, headers={'Authorization': 'token b'}, timeout=config.timeout)
+    assert ReleasesHandler.statuses == [200, 304, 304, 200]
+
+def test_not_cacheable(server):
+    url = '{}/repos/owner/repo/releases/1'.format(server)
+    requests_retry(url).get(url, timeout=config.timeout)
+    requests_retry(url).get(url, timeout=config.timeout)
+    assert ReleasesHandler.statuses == [200, 200]
+
+def test_eviction(server, monkeypatch):
+    monkeypatch.setattr(config, 'http_cache_max_size', 1)
+    url = '{}/repos/owner/repo/releases'.format(server)
+    requests_retry(url).get(url, timeout=config.timeout)
+    assert os.listdir(config.http_cache_dir) == []
@@ -22,3 +22,39 @@ def test_tag_name_tmp():
         assert latest_release._tag_name_tmp(branch) == expect
         assert latest_release._break_tag_name_tmp(expect)
         assert latest_release._break_tag_name_tmp(expect)['branch'] == branch
+
+class Asset:
+    def __init__(self, name):
+        self.name = name
+        self.deleted = False
+
+    def delete_asset(self):
+        self.deleted = True
+
+class Release:
+    def __init__(self, tag_name, assets):
+        self.tag_name = tag_name
+        self.assets = [Asset(name) for name in assets]
+
+    def get_assets(self):
+        return self.assets
+
+class Index:
+    def __init__(self, release):
+        self.release = release
+
+    def by_tag(self, tag_name, draft=False):
+        return [self.release] if tag_name == self.release.tag_name else []
+
+    def find(self, kind, branch):
+        return []
+
+def test_cleanup_tmp_assets(monkeypatch):
+    for name, value in [('GITHUB_ACCESS_TOKEN', 'token'), ('TRAVIS_REPO_SLUG', 'owner/repo'), ('TRAVIS_BRANCH', 'master'), ('TRAVIS_BUILD_NUMBER', '7')]:
+        monkeypatch.setenv(name, value)
+    for name in ['CIRP_GITHUB_ACCESS_TOKEN', 'CIRP_GITHUB_REPO_SLUG', 'TRAVIS_TAG']:
+        monkeypatch.delenv(name, raising=False)
+    release = Release(latest_release._tag_name('master'), ['a', '_cirp-5-a', '_cirp-7-a', '_cirp-8-a'])
+    latest_release.cleanup(Index(release), ['7', '8'], 'https://api.github.com')
+    # Only the leftovers of the builds that have finished are deleted
+    assert [asset.name for asset in release.assets if asset.deleted] == ['_cirp-5-a']
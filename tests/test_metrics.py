@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+import pytest
+
+from ci_release_publisher import config, metrics
+from ci_release_publisher.requests_retry import requests_retry
+from conftest import FakeHandler
+
+# Fails the first `failures` requests with 503
+class Handler(FakeHandler):
+    failures = 0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        status = 201
+        if Handler.failures:
+            Handler.failures -= 1
+            status = 503
+        self.send_response(status)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'{}')
+
+@pytest.fixture
+def server(fake_server):
+    metrics.reset()
+    return fake_server(Handler)['url']
+
+def test_endpoint():
+    assert metrics.endpoint('GET', 'https://api.github.com/repos/owner/repo/releases?per_page=100&page=2') == 'list releases'
+    assert metrics.endpoint('GET', 'https://github.example.com/api/v3/repos/owner/repo/releases/tags/v1.0') == 'get release by tag'
+    assert metrics.endpoint('POST', 'https://uploads.github.com/repos/owner/repo/releases/1/assets?name=a.zip') == 'upload asset'
+    assert metrics.endpoint('DELETE', 'https://api.github.com/repos/owner/repo/git/refs/tags/ci-master-latest') == 'delete tag'
+    assert metrics.endpoint('GET', 'https://api.travis-ci.com/repo/owner%2Frepo/builds?limit=100') == 'travis builds'
+    assert metrics.endpoint('GET', 'https://objects.githubusercontent.com/github-production-release-asset/1') == 'GET objects.githubusercontent.com'
+
+def test_request(server, tmp_path):
+    Handler.failures = 1
+    url = '{}/repos/owner/repo/releases/1/assets'.format(server)
+    assert requests_retry(url).post(url, data=b'12345', timeout=config.timeout).status_code == 201
+    metrics.log_and_write(str(tmp_path / 'metrics.json'))
+    with open(str(tmp_path / 'metrics.json'), 'r') as f:
+        report = json.load(f)
+    m = report['endpoints']['upload asset']
+    assert (m['requests'], m['retries'], m['errors'], m['bytes_sent'], m['bytes_received']) == (1, 1, 0, 5, 2)
+    assert sum(m['latency_histogram']) == 1
+    assert report['total']['requests'] == 1
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+import pytest
+
+from ci_release_publisher import parallel
+
+def test_run_all():
+    def fn(item):
+        if item % 2:
+            raise ValueError(item)
+    for workers in [1, 3]:
+        failures = parallel.run_all(fn, range(6), workers)
+        assert [(item, str(e)) for item, e in failures] == [(1, '1'), (3, '3'), (5, '5')]
+
+def test_run_all_parallel():
+    # Would time out if the calls didn't run at the same time
+    barrier = threading.Barrier(3, timeout=10)
+    assert parallel.run_all(lambda item: barrier.wait(), range(3), 3) == []
+
+def test_run_until_error():
+    for workers in [1, 3]:
+        assert parallel.run_until_error(lambda item: item * 2, range(5), workers) == [0, 2, 4, 6, 8]
+
+def test_run_until_error_stops():
+    started = []
+    def fn(item):
+        started.append(item)
+        if item == 0:
+            raise ValueError(item)
+        time.sleep(0.2)
+    with pytest.raises(ValueError):
+        parallel.run_until_error(fn, range(100), 2)
+    # The calls that haven't started by the time of the failure are cancelled
+    assert len(started) < 100
+    started.clear()
+    with pytest.raises(ValueError):
+        parallel.run_until_error(fn, range(100), 1)
+    assert started == [0]
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+from ci_release_publisher import config, plan
+
+def test_order():
+    done = []
+    p = plan.Plan()
+    a = p.add('a', lambda: done.append('a') or 1)
+    b = p.add('b', lambda: done.append('b') or a.result + 1, [a])
+    p.add('c', lambda: done.append('c'), [b, None])
+    p.run()
+    assert done == ['a', 'b', 'c']
+    assert b.result == 2
+
+def test_parallel():
+    # Would time out if the independent steps didn't run at the same time
+    barrier = threading.Barrier(3, timeout=10)
+    p = plan.Plan()
+    steps = [p.add(str(i), barrier.wait) for i in range(3)]
+    p.run()
+    assert all(s.state == 'done' for s in steps)
+
+def test_fatal_failure():
+    def fail():
+        raise ValueError('a')
+    p = plan.Plan()
+    a = p.add('a', fail)
+    b = p.add('b', lambda: None, [a])
+    c = p.add('c', lambda: time.sleep(0.2))
+    with pytest.raises(ValueError):
+        p.run()
+    assert [s.state for s in [a, b, c]] == ['failed', 'skipped', 'done']
+
+def test_nonfatal_failure():
+    def fail():
+        raise ValueError('a')
+    p = plan.Plan()
+    a = p.add('a', fail, fatal=False)
+    b = p.add('b', lambda: None, [a])
+    c = p.add('c', lambda: None)
+    p.run()
+    assert [s.state for s in [a, b, c]] == ['failed', 'skipped', 'done']
+
+def test_cancel():
+    def cancel():
+        raise plan.Cancel()
+    p = plan.Plan()
+    a = p.add('a', cancel)
+    b = p.add('b', lambda: None, [a])
+    p.run()
+    assert [s.state for s in [a, b]] == ['cancelled', 'skipped']
+
+def test_dry_run(monkeypatch):
+    monkeypatch.setattr(config, 'dry_run', True)
+    done = []
+    p = plan.Plan()
+    a = p.add('a', lambda: done.append('a'))
+    p.add('b', lambda: done.append('b'), [a])
+    p.run()
+    assert done == []
+
+def test_delete_concurrency(monkeypatch):
+    monkeypatch.setattr(config, 'delete_concurrency', 2)
+    lock = threading.Lock()
+    running = [0]
+    most_running = [0]
+    def delete():
+        with lock:
+            running[0] += 1
+            most_running[0] = max(most_running[0], running[0])
+        time.sleep(0.05)
+        with lock:
+            running[0] -= 1
+    p = plan.Plan()
+    for i in range(6):
+        p.add(str(i), delete, kind='delete')
+    p.run()
+    assert most_running[0] == 2
+
+def test_asyncio_engine(monkeypatch):
+    monkeypatch.setattr(config, 'engine', 'asyncio')
+    monkeypatch.setattr(config, 'delete_concurrency', 2)
+    running = [0]
+    most_running = [0]
+    async def delete(client):
+        running[0] += 1
+        most_running[0] = max(most_running[0], running[0])
+        await asyncio.sleep(0.05)
+        running[0] -= 1
+        return 'async'
+    def fail():
+        raise ValueError('a')
+    p = plan.Plan()
+    deletes = [p.add(str(i), None, kind='delete', afn=delete) for i in range(6)]
+    # Steps without a coroutine run in a thread
+    a = p.add('a', lambda: 'thread', deletes)
+    b = p.add('b', fail, fatal=False)
+    c = p.add('c', lambda: None, [b])
+    p.run()
+    assert most_running[0] == 2
+    assert [s.result for s in deletes + [a]] == ['async'] * 6 + ['thread']
+    assert [s.state for s in [b, c]] == ['failed', 'skipped']
+    p = plan.Plan()
+    p.add('a', fail)
+    with pytest.raises(ValueError):
+        p.run()
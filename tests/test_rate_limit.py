@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+from email.utils import formatdate
+
+import pytest
+
+from ci_release_publisher import rate_limit
+
+# A clock that only moves when waited on, so that it can be checked how long acquire() blocks for
+class Clock:
+    def __init__(self, monkeypatch):
+        self.now = 1000000.0
+        self.waited = 0
+        monkeypatch.setattr(rate_limit.time, 'time', lambda: self.now)
+
+    def wait(self, timeout=None):
+        self.now += timeout
+        self.waited += timeout
+        return False
+
+@pytest.fixture
+def clock(monkeypatch):
+    return Clock(monkeypatch)
+
+def governor(clock):
+    g = rate_limit.Governor('api.github.com')
+    g._cond.wait = clock.wait
+    return g
+
+def headers(clock, remaining, reset_in, limit=5000):
+    return {
+        'X-RateLimit-Limit': str(limit),
+        'X-RateLimit-Remaining': str(remaining),
+        'X-RateLimit-Reset': str(int(clock.now + reset_in)),
+    }
+
+def test_unknown_budget(clock):
+    g = governor(clock)
+    g.acquire()
+    assert clock.waited == 0
+    assert g.budget() == 'Remaining API rate limit budget is unknown.'
+
+def test_plenty_of_budget(clock):
+    g = governor(clock)
+    g.update(headers(clock, 4000, 3600), 200)
+    for _ in range(10):
+        g.acquire()
+    assert clock.waited == 0
+    assert g._remaining == 3990
+
+def test_slow_down(clock):
+    g = governor(clock)
+    g.update(headers(clock, 55, 1000), 200)
+    g.acquire()
+    assert clock.waited == 0
+    # The requests are spread out over the time left until the reset
+    g.acquire()
+    assert clock.waited == pytest.approx(1000 / (54 - rate_limit.Governor._pause_remaining))
+    waited = clock.waited
+    g.acquire()
+    assert clock.waited - waited == pytest.approx((1000 - waited) / (53 - rate_limit.Governor._pause_remaining))
+
+def test_pause(clock):
+    g = governor(clock)
+    g.update(headers(clock, rate_limit.Governor._pause_remaining, 600), 200)
+    g.acquire()
+    # Waits for the reset, after which the budget is unknown again
+    assert clock.waited == pytest.approx(600)
+    assert g._remaining is None
+
+def test_pause_logged_once(clock, caplog):
+    g = governor(clock)
+    g.update(headers(clock, rate_limit.Governor._pause_remaining, 600), 200)
+    caplog.set_level('INFO')
+    # Polled by the asyncio engine, or waited for by several threads
+    for _ in range(3):
+        assert g.try_acquire() > 0
+        clock.now += 10
+    assert len([r for r in caplog.records if r.getMessage().startswith('Waiting')]) == 1
+
+def test_budget(clock):
+    g = governor(clock)
+    clock.now = 1577880000.0
+    g.update(headers(clock, 42, 3723), 200)
+    assert g.budget() == 'Remaining API rate limit budget: 42 out of 5000 request(s), resets at 13:02:03 UTC.'
+
+def test_lowest_remaining_wins(clock):
+    g = governor(clock)
+    reset_headers = headers(clock, 3000, 3600)
+    g.update(reset_headers, 200)
+    g.update(dict(reset_headers, **{'X-RateLimit-Remaining': '3500'}), 200)
+    assert g._remaining == 3000
+    # A new window replaces the budget
+    g.update(headers(clock, 4999, 7200), 200)
+    assert g._remaining == 4999
+
+def test_retry_after(clock):
+    g = governor(clock)
+    g.update({'Retry-After': '30'}, 403)
+    g.acquire()
+    assert clock.waited == pytest.approx(30)
+
+def test_retry_after_date(clock):
+    g = governor(clock)
+    g.update({'Retry-After': formatdate(clock.now + 60, usegmt=True)}, 429)
+    g.acquire()
+    assert clock.waited == pytest.approx(60)
+
+def test_rate_limited(clock):
+    g = governor(clock)
+    g.update(headers(clock, 0, 120), 403)
+    g.acquire()
+    assert clock.waited == pytest.approx(120)
+
+class Response:
+    def __init__(self, status, headers):
+        self.status = status
+        self.headers = headers
+
+    def get_redirect_location(self):
+        return None
+
+class Pool:
+    host = 'rate-limit.test'
+
+def test_retry(clock, monkeypatch):
+    g = governor(clock)
+    monkeypatch.setitem(rate_limit._governors, Pool.host, g)
+    monkeypatch.setattr(rate_limit.retry.Retry, 'sleep', lambda self, response=None: None)
+    retry = rate_limit.Retry(total=3, status_forcelist=[403])
+    # The governor sees the responses that are retried and the retries wait on it
+    retry = retry.increment('GET', '/', response=Response(403, headers(clock, 0, 300)), _pool=Pool())
+    assert isinstance(retry, rate_limit.Retry)
+    assert g._remaining == 0
+    retry.sleep()
+    assert clock.waited == pytest.approx(300)
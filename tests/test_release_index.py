@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+from github import UnknownObjectException
+import datetime
+import pytest
+
+from ci_release_publisher import latest_release, numbered_release, release_index, tag_release, temporary_store_release
+from ci_release_publisher.release_index import Kind
+
+class Release:
+    def __init__(self, id, tag_name, draft=True):
+        self.id = id
+        self.tag_name = tag_name
+        self.draft = draft
+        self.created_at = datetime.datetime(2020, 1, 1)
+
+releases = [
+    Release(1, latest_release._tag_name('master'), draft=False),
+    Release(2, latest_release._tag_name_tmp('master')),
+    Release(3, numbered_release._tag_name('master', '10'), draft=False),
+    Release(4, numbered_release._tag_name('master', '11'), draft=False),
+    Release(5, numbered_release._tag_name_tmp('master', '12')),
+    Release(6, numbered_release._tag_name('dev', '10'), draft=False),
+    Release(7, tag_release._tag_name_tmp('v1.0')),
+    Release(8, temporary_store_release._tag_name('master', '12', '1')),
+    Release(9, temporary_store_release._tag_name('master', '12', '2')),
+    Release(10, temporary_store_release._tag_name_tmp('master', '12', '3')),
+    Release(11, temporary_store_release._tag_name('master', '11', '1')),
+    Release(12, 'v1.0', draft=False),
+]
+
+def test_find():
+    index = release_index.ReleaseIndex(releases)
+    assert [r.id for r in index.find(Kind.LATEST, 'master')] == [1]
+    assert [r.id for r in index.find(Kind.LATEST_TMP, 'master')] == [2]
+    assert [r.id for r in index.find(Kind.NUMBERED, 'master')] == [3, 4]
+    assert [r.id for r in index.find(Kind.NUMBERED, 'master', '11')] == [4]
+    assert [r.id for r in index.find(Kind.NUMBERED_TMP, 'master')] == [5]
+    assert [r.id for r in index.find(Kind.TAG_TMP, 'v1.0')] == [7]
+    assert [r.id for r in index.find(Kind.STORE, 'master', 12)] == [8, 9]
+    assert [r.id for r in index.find(Kind.STORE_TMP, 'master', 12)] == [10]
+    assert index.find(Kind.NUMBERED, 'feature') == []
+
+def test_record():
+    index = release_index.ReleaseIndex(releases)
+    record = index.find(Kind.STORE, 'master', 12)[1]
+    assert (record.branch, record.build, record.job, record.draft, record.id) == ('master', 12, 2, True, 9)
+    assert record.release is releases[8]
+    record = index.find(Kind.LATEST, 'master')[0]
+    assert (record.build, record.job) == (None, None)
+
+def test_by_tag():
+    index = release_index.ReleaseIndex(releases)
+    assert index.by_tag('v1.0') == [releases[11]]
+    assert index.by_tag(numbered_release._tag_name('master', '10')) == [releases[2]]
+    assert index.by_tag('nonexistent') == []
+
+def test_lazy():
+    listed = []
+    def list_releases():
+        listed.append(True)
+        for release in releases:
+            yield release
+    index = release_index.ReleaseIndex(list_releases())
+    # Nothing is listed until the first query and everything is listed only once
+    assert listed == []
+    assert index.by_tag('v1.0') == [releases[11]]
+    assert [r.id for r in index.find(Kind.LATEST, 'master')] == [1]
+    assert listed == [True]
+
+class Commit:
+    def __init__(self, date):
+        self.commit = self
+        self.committer = self
+        self.date = date
+
+class Repo:
+    def __init__(self, published, commit_date):
+        self.published = published
+        self.commit_date = commit_date
+        self.requests = []
+
+    def get_release(self, tag_name):
+        self.requests.append(tag_name)
+        if tag_name not in self.published:
+            raise UnknownObjectException(404)
+        return self.published[tag_name]
+
+    def get_commit(self, sha):
+        self.requests.append(sha)
+        return Commit(self.commit_date)
+
+def listing(releases, listed):
+    for release in releases:
+        listed.append(release.id)
+        yield release
+
+def test_by_tag_published():
+    listed = []
+    repo = Repo({'v1.0': releases[11]}, None)
+    index = release_index.ReleaseIndex(listing(releases, listed), repo)
+    assert index.by_tag('v1.0') == [releases[11]]
+    assert index.by_tag('v2.0') == []
+    assert listed == []
+    # Drafts can't be looked up by the tag
+    assert index.by_tag(tag_release._tag_name_tmp('v1.0'), draft=True) == [releases[6]]
+    assert len(listed) == len(releases)
+    assert repo.requests == ['v1.0', 'v2.0']
+
+def test_current_build(monkeypatch):
+    monkeypatch.setenv('TRAVIS_COMMIT', 'abc')
+    monkeypatch.delenv('CIRP_GITHUB_REPO_SLUG', raising=False)
+    # Newest first, the way GitHub lists them
+    newest = [
+        Release(1, temporary_store_release._tag_name('master', '12', '2')),
+        Release(2, temporary_store_release._tag_name('master', '12', '1')),
+        Release(3, temporary_store_release._tag_name('master', '11', '1')),
+        Release(4, temporary_store_release._tag_name('master', '10', '1')),
+    ]
+    for i, release in enumerate(newest):
+        release.created_at = datetime.datetime(2020, 1, 10 - i)
+    listed = []
+    repo = Repo({}, datetime.datetime(2020, 1, 10))
+    index = release_index.ReleaseIndex(listing(newest, listed), repo)
+    assert [r.id for r in index.find(Kind.STORE, 'master', 12, current_build=True)] == [1, 2]
+    # Stops at the first release older than the commit, minus the leeway for the committer's clock
+    assert listed == [1, 2, 3]
+    assert [r.id for r in index.find(Kind.STORE, 'master', 12, current_build=True)] == [1, 2]
+    assert listed == [1, 2, 3]
+    assert repo.requests == ['abc']
+    assert [r.id for r in index.find(Kind.STORE, 'master')] == [1, 2, 3, 4]
+    assert listed == [1, 2, 3, 4]
+
+def test_current_build_different_repo(monkeypatch):
+    monkeypatch.setenv('CIRP_GITHUB_REPO_SLUG', 'owner/repo')
+    listed = []
+    repo = Repo({}, datetime.datetime(2030, 1, 1))
+    index = release_index.ReleaseIndex(listing(releases, listed), repo)
+    assert [r.id for r in index.find(Kind.STORE, 'master', 12, current_build=True)] == [8, 9]
+    assert len(listed) == len(releases)
+    assert repo.requests == []
+
+def test_current_build_unordered(monkeypatch):
+    monkeypatch.setenv('TRAVIS_COMMIT', 'abc')
+    monkeypatch.delenv('CIRP_GITHUB_REPO_SLUG', raising=False)
+    unordered = [
+        Release(1, temporary_store_release._tag_name('master', '12', '2')),
+        Release(2, temporary_store_release._tag_name('master', '11', '1')),
+        Release(3, temporary_store_release._tag_name('master', '10', '1')),
+        Release(4, temporary_store_release._tag_name('master', '12', '1')),
+    ]
+    for release, day in zip(unordered, [10, 11, 5, 1]):
+        release.created_at = datetime.datetime(2020, 1, day)
+    listed = []
+    index = release_index.ReleaseIndex(listing(unordered, listed), Repo({}, datetime.datetime(2020, 1, 10)))
+    # Once a release comes out of order, the rest of the listing can't be assumed to be older
+    assert [r.id for r in index.find(Kind.STORE, 'master', 12, current_build=True)] == [1, 4]
+    assert listed == [1, 2, 3, 4]
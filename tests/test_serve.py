@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+import pytest
+
+from ci_release_publisher import __main__, config, serve
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    monkeypatch.setenv('CIRP_SERVE_SOCKET', str(tmp_path / 'serve.sock'))
+    monkeypatch.setattr(config, 'http_cache_dir', str(tmp_path / 'cache'))
+    monkeypatch.setenv('CIRP_TEST', 'server')
+    state = {'commands': []}
+    def run(argv):
+        state['commands'].append((argv, os.environ.get('CIRP_TEST'), os.getcwd(), config.dry_run))
+        if argv[0] == 'set':
+            # Set from the command line arguments, mustn't carry over to the next command
+            config.dry_run = True
+        print('out {}'.format(argv[0]))
+        sys.stderr.write('err {}\n'.format(argv[0]))
+        if argv[0] == 'fail':
+            sys.exit(3)
+    thread = threading.Thread(target=serve.serve, args=(run, 1), daemon=True)
+    thread.start()
+    while not os.path.exists(str(tmp_path / 'serve.sock')):
+        time.sleep(0.01)
+    state['thread'] = thread
+    yield state
+    thread.join(10)
+
+def test_forward(server, tmp_path, monkeypatch, capsys):
+    cwd = os.getcwd()
+    for argv, code in [(['set'], 0), (['fail'], 3)]:
+        monkeypatch.setenv('CIRP_TEST', 'a')
+        monkeypatch.chdir(str(tmp_path))
+        assert serve.forward(argv) == code
+        # The client is the same process here, so it sees the environment of the server restored after the command
+        assert (os.environ['CIRP_TEST'], os.getcwd()) == ('server', cwd)
+    assert capsys.readouterr() == ('out set\nout fail\n', 'err set\nerr fail\n')
+    # The commands run with the environment and the working directory of the client
+    assert server['commands'] == [(['set'], 'a', str(tmp_path), False), (['fail'], 'a', str(tmp_path), False)]
+
+def test_idle_timeout(server):
+    server['thread'].join(10)
+    assert not server['thread'].is_alive()
+    # Runs in-process once the server is gone
+    assert serve.forward(['a']) is None
+
+def test_version_mismatch(server):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(serve.socket_path())
+    f = sock.makefile('rwb')
+    serve._send(f, {'version': '0.0.0', 'argv': ['a'], 'env': {}, 'cwd': os.getcwd()})
+    assert json.loads(f.readline().decode('utf-8')) == {'accepted': False}
+    sock.close()
+    assert server['commands'] == []
+
+def test_no_server(tmp_path, monkeypatch):
+    monkeypatch.setenv('CIRP_SERVE_SOCKET', str(tmp_path / 'serve.sock'))
+    assert serve.forward(['a']) is None
+
+@pytest.mark.parametrize('argv, command', [
+    (['publish', '--latest-release-name', 'serve', 'dir'], 'publish'),
+    (['--tag-prefix', 'serve', 'store', 'dir'], 'store'),
+    (['collect', 'serve'], 'collect'),
+    (['serve'], None),
+    (['--dry-run', 'serve', '--idle-timeout', '5'], None),
+    (['--help'], None),
+    (['-h'], None),
+    (['--version'], None),
+    (['publish', '--help'], None),
+    (['--engine', 'unknown', 'store', 'dir'], None),
+    ([], None),
+])
+def test_forwarded_command(argv, command):
+    assert __main__._forwarded_command(argv) == command
+
+def test_forward_serve_option_value(server):
+    # "serve" as an option value doesn't make it run the command in-process
+    with pytest.raises(SystemExit) as e:
+        __main__.main(['publish', '--latest-release-name', 'serve', 'dir'])
+    assert e.value.code == 0
+    assert [argv for argv, env, cwd, dry_run in server['commands']] == [['publish', '--latest-release-name', 'serve', 'dir']]
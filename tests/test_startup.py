@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+import os
+import socket
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from ci_release_publisher import serve
+
+# The start up cost of a command that doesn't need to talk to GitHub, or that is forwarded to a server, measured with
+# `python -X importtime`. Mainly checked by the modules imported, as the timings depend on the machine. The time is
+# only compared to the time of importing the GitHub module on the same machine, which pulls in PyGithub, requests and
+# urllib3 and took about 270ms against about 20ms of the start up without them.
+_heavy_modules = ['github', 'requests', 'urllib3', 'ci_release_publisher.github', 'ci_release_publisher.travis']
+_runner = "import sys; sys.argv[0] = 'ci-release-publisher'; from ci_release_publisher.__main__ import main; main()"
+
+# Returns the names of the imported modules and the time spent importing them, in seconds
+def import_time(args, env=None, code=_runner):
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code] + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             universal_newlines=True, env=dict(os.environ, **(env or {})))
+    modules = []
+    total = 0
+    started = False
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        started = started or name.strip().startswith('ci_release_publisher')
+        modules.append(name.strip())
+        # Only the top level imports, excluding the ones of the interpreter start up
+        if started and not name[1:].startswith(' '):
+            total += int(cumulative) / 1000000
+    return modules, total
+
+@pytest.fixture(scope='module')
+def baseline():
+    modules, total = import_time([], code='import ci_release_publisher.github')
+    assert 'github' in modules
+    return total
+
+def check(baseline, args, env=None):
+    modules, total = import_time(args, env)
+    assert not [m for m in modules if m in _heavy_modules]
+    assert total < baseline / 2
+
+@pytest.mark.parametrize('args', [['--version'], ['--help'], ['--engine', 'none'], ['collect', '--help'], ['cleanup_publish', '--help'], ['serve', '--help']])
+def test_local(baseline, args):
+    check(baseline, args)
+
+@pytest.mark.skipif(not hasattr(socket, 'AF_UNIX'), reason='needs Unix sockets')
+@pytest.mark.parametrize('command', ['store', 'cleanup_store', 'collect', 'publish', 'cleanup_publish'])
+def test_forwarded(baseline, command, tmp_path):
+    path = str(tmp_path / 'serve.sock')
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(1)
+    def accept():
+        sock, _ = server.accept()
+        f = sock.makefile('rwb')
+        f.readline()
+        serve._send(f, {'accepted': True})
+        serve._send(f, {'exit': 0})
+        sock.close()
+    thread = threading.Thread(target=accept, daemon=True)
+    thread.start()
+    try:
+        check(baseline, [command, 'dir'], {'CIRP_SERVE_SOCKET': path})
+    finally:
+        thread.join(10)
+        server.close()
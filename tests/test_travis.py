@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+
+from ci_release_publisher import config, travis
+from conftest import FakeHandler
+
+# Stand-in for the Travis-CI API, with `builds` sorted unfinished first
+class TravisHandler(FakeHandler):
+    def do_POST(self):
+        state = self.server.state
+        state['auth'] += 1
+        self.send_json(200, {'access_token': 'travis-{}'.format(state['auth'])})
+
+    def do_GET(self):
+        state = self.server.state
+        if self.headers['Authorization'] in state['revoked']:
+            return self.send_json(401, {})
+        query = parse_qs(urlsplit(self.path).query)
+        state['requests'].append((urlsplit(self.path).path, query))
+        if urlsplit(self.path).path.startswith('/build/'):
+            return self.send_json(200, {'jobs': [{'state': 'failed', 'allow_failure': False}] if state['failed'] else []})
+        offset = int(query['offset'][0])
+        limit = int(query['limit'][0])
+        builds = state['builds'][offset:offset + limit]
+        self.send_json(200, {'@pagination': {'limit': limit, 'count': len(state['builds'])}, 'builds': builds})
+
+@pytest.fixture
+def server(fake_server, tmp_path, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmp_path))
+    monkeypatch.setenv('TRAVIS_JOB_ID', '1')
+    monkeypatch.delenv('TRAVIS_BUILD_NUMBER', raising=False)
+    monkeypatch.setattr(config, 'cache', True)
+    return fake_server(TravisHandler, {'builds': [], 'requests': [], 'auth': 0, 'revoked': set(), 'failed': False})
+
+def builds(unfinished, finished):
+    return ([{'number': str(n), 'event_type': 'push', 'finished_at': None} for n in range(unfinished)] +
+            [{'number': str(unfinished + n), 'event_type': 'push', 'finished_at': '2020-01-01T00:00:00Z'} for n in range(finished)])
+
+def test_branch_unfinished_build_numbers(server, monkeypatch):
+    monkeypatch.setattr(config, 'page_concurrency', 2)
+    server['builds'] = builds(350, 1000)
+    build_numbers = travis.Travis(server['url'], 'token').branch_unfinished_build_numbers('owner/repo', 'master')
+    assert build_numbers == [str(n) for n in range(350)]
+    # PRs are filtered out by the server
+    assert all(query['event_type'] == ['api,cron,push'] for path, query in server['requests'])
+    # The pages are fetched 2 at a time after the first one and the paging stops at the first finished build
+    assert sorted(int(query['offset'][0]) for path, query in server['requests']) == [0, 100, 200, 300, 400]
+
+def test_branch_unfinished_build_numbers_first_page(server):
+    server['builds'] = builds(5, 1000)
+    assert travis.Travis(server['url'], 'token').branch_unfinished_build_numbers('owner/repo', 'master') == ['0', '1', '2', '3', '4']
+    assert len(server['requests']) == 1
+
+def test_branch_unfinished_build_numbers_all_unfinished(server, monkeypatch):
+    monkeypatch.setattr(config, 'page_concurrency', 3)
+    server['builds'] = builds(250, 0)
+    assert travis.Travis(server['url'], 'token').branch_unfinished_build_numbers('owner/repo', 'master') == [str(n) for n in range(250)]
+    # All of the pages are fetched, without going past the last one
+    assert sorted(int(query['offset'][0]) for path, query in server['requests']) == [0, 100, 200]
+
+def test_branch_unfinished_build_numbers_not_cached(server):
+    # Releases get deleted based on it, a build restarted in the meantime must not be missed
+    server['builds'] = builds(3, 10)
+    assert travis.Travis(server['url'], 'token').branch_unfinished_build_numbers('owner/repo', 'master') == ['0', '1', '2']
+    server['builds'] = builds(4, 10)
+    assert travis.Travis(server['url'], 'token').branch_unfinished_build_numbers('owner/repo', 'master') == ['0', '1', '2', '3']
+    assert len(server['requests']) == 2
+
+def test_build_has_failed_nonallowfailure_job_not_cached(server):
+    assert not travis.Travis(server['url'], 'token').build_has_failed_nonallowfailure_job(1)
+    server['failed'] = True
+    assert travis.Travis(server['url'], 'token').build_has_failed_nonallowfailure_job(1)
+
+def test_travis_token(server):
+    server['builds'] = builds(1, 1)
+    travis.Travis(server['url'], github_token='github')
+    t = travis.Travis(server['url'], github_token='github')
+    # Exchanged only once
+    assert server['auth'] == 1
+    assert t._headers['Authorization'] == 'token travis-1'
+    assert 'Authorization' not in travis.Travis._headers
+    # Exchanged again when revoked
+    server['revoked'].add('token travis-1')
+    assert t.branch_unfinished_build_numbers('owner/repo', 'master') == ['0']
+    assert server['auth'] == 2